@@ -15,65 +15,110 @@ if [[ -z "${DOCKER_VERSION}" ]]; then
     DOCKER_VERSION=18.09.7-0ubuntu1~18.04.4
 fi
 
-# Assuming swap is off
-curl -s https://packages.cloud.google.com/apt/doc/apt-key.gpg | sudo apt-key add -
-sudo apt-add-repository -y "deb http://apt.kubernetes.io/ kubernetes-xenial main"
-
-#Handle /var/lib/dpkg/lock until cloudinit upgrade has finished.
-# Install qemu-guest-agent
-counter=0
-until sudo apt-get update && sudo apt-get install -y qemu-guest-agent
-do
-    sleep $WAIT_PERIOD
-    [[ counter -eq $MAX_RETRIES ]] && echo "Failed!" && exit 1
-    echo "Trying again. Try #$counter"
-    (( counter++ ))
-done
-
-# Install Canonical HWE for 18.04
-DEBIAN_FRONTEND=noninteractive sudo apt-get -yq --install-recommends -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" install linux-generic-hwe-18.04
-DEBIAN_FRONTEND=noninteractive sudo apt-get -yq autoremove
-
-# Install required packages
-if [[ -z "${DOCKER_CE}" ]]; then
-    sudo apt-get install -y docker.io=${DOCKER_VERSION}
-    # Mark packages on hold - upgrade k8s through k8s & not apt
-    sudo apt-mark hold docker.io containerd cgroupfs-mount
+if [[ -n "${OFFLINE_BUNDLE}" ]]; then
+    # Install the pinned package set from the pushed offline bundle, without upstream mirrors.
+    # Handle /var/lib/dpkg/lock until cloudinit upgrade has finished.
+    counter=0
+    until DEBIAN_FRONTEND=noninteractive sudo -E apt-get -yq --no-download --allow-downgrades -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" install "${OFFLINE_BUNDLE}"/packages/*.deb
+    do
+        sleep $WAIT_PERIOD
+        [[ counter -eq $MAX_RETRIES ]] && echo "Failed!" && exit 1
+        echo "Trying again. Try #$counter"
+        (( counter++ ))
+    done
+
+    if [[ -z "${DOCKER_CE}" ]]; then
+        sudo apt-mark hold docker.io containerd cgroupfs-mount
+    else
+        sudo apt-mark hold cgroupfs-mount containerd.io docker-ce docker-ce-cli
+    fi
+    sudo cp "${DAEMON_JSON_LOCATION}/daemon.json" /etc/docker
+
+    # Apply new dockerd settings with cgroupdriver=systemd
+    sudo systemctl daemon-reload && \
+    sudo systemctl restart docker.service && \
+    sudo systemctl status docker.service
+    sudo apt-mark hold kubelet kubeadm kubectl
 else
-    echo -e "Installing Docker CE"
-    sudo apt-get update && \
-    sudo apt-get install -y \
-        apt-transport-https \
-        ca-certificates \
-        curl \
-        software-properties-common && \
-    curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo apt-key add - && \
-    sudo add-apt-repository -y \
-        "deb [arch=amd64] https://download.docker.com/linux/ubuntu \
-        $(lsb_release -cs) \
-        stable" && \
-    sudo apt-get update && \
-    sudo apt-get install -y docker-ce=${DOCKER_VERSION}
-    sudo apt-mark hold cgroupfs-mount containerd.io docker-ce docker-ce-cli
-fi
+    # Assuming swap is off
+    curl -s https://packages.cloud.google.com/apt/doc/apt-key.gpg | sudo apt-key add -
+    sudo apt-add-repository -y "deb http://apt.kubernetes.io/ kubernetes-xenial main"
+
+    #Handle /var/lib/dpkg/lock until cloudinit upgrade has finished.
+    # Install qemu-guest-agent
+    counter=0
+    until sudo apt-get update && sudo apt-get install -y qemu-guest-agent
+    do
+        sleep $WAIT_PERIOD
+        [[ counter -eq $MAX_RETRIES ]] && echo "Failed!" && exit 1
+        echo "Trying again. Try #$counter"
+        (( counter++ ))
+    done
+
+    # Install Canonical HWE for 18.04
+    DEBIAN_FRONTEND=noninteractive sudo apt-get -yq --install-recommends -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" install linux-generic-hwe-18.04
+    DEBIAN_FRONTEND=noninteractive sudo apt-get -yq autoremove
 
-sudo cp "${DAEMON_JSON_LOCATION}/daemon.json" /etc/docker
+    # Install required packages
+    if [[ -z "${DOCKER_CE}" ]]; then
+        sudo apt-get install -y docker.io=${DOCKER_VERSION}
+        # Mark packages on hold - upgrade k8s through k8s & not apt
+        sudo apt-mark hold docker.io containerd cgroupfs-mount
+    else
+        echo -e "Installing Docker CE"
+        sudo apt-get update && \
+        sudo apt-get install -y \
+            apt-transport-https \
+            ca-certificates \
+            curl \
+            software-properties-common && \
+        curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo apt-key add - && \
+        sudo add-apt-repository -y \
+            "deb [arch=amd64] https://download.docker.com/linux/ubuntu \
+            $(lsb_release -cs) \
+            stable" && \
+        sudo apt-get update && \
+        sudo apt-get install -y docker-ce=${DOCKER_VERSION}
+        sudo apt-mark hold cgroupfs-mount containerd.io docker-ce docker-ce-cli
+    fi
 
-DEBIAN_FRONTEND=noninteractive sudo apt-get update && \
-DEBIAN_FRONTEND=noninteractive sudo apt-get dist-upgrade -yq
+    sudo cp "${DAEMON_JSON_LOCATION}/daemon.json" /etc/docker
 
-# Apply new dockerd settings with cgroupdriver=systemd
-sudo systemctl daemon-reload && \
-sudo systemctl restart docker.service && \
-sudo systemctl status docker.service
+    DEBIAN_FRONTEND=noninteractive sudo apt-get update && \
+    DEBIAN_FRONTEND=noninteractive sudo apt-get dist-upgrade -yq
 
-sudo apt-get install -y kubelet=${KUBE_VERSION} kubeadm=${KUBE_VERSION} kubectl=${KUBE_VERSION}
-sudo apt-mark hold kubelet kubeadm kubectl
+    # Apply new dockerd settings with cgroupdriver=systemd
+    sudo systemctl daemon-reload && \
+    sudo systemctl restart docker.service && \
+    sudo systemctl status docker.service
+
+    sudo apt-get install -y kubelet=${KUBE_VERSION} kubeadm=${KUBE_VERSION} kubectl=${KUBE_VERSION}
+    sudo apt-mark hold kubelet kubeadm kubectl
+fi
 
 sudo systemctl status kubelet.service
 
 # Enable start on-boot
 sudo systemctl enable kubelet.service
 sudo systemctl enable docker.service
+
+# Pre-pull control plane images of the pinned version, and the images of PREPULL_MANIFESTS (CNI, dashboard)
+if [[ -n "${PREPULL_IMAGES}" ]]; then
+    counter=0
+    until sudo kubeadm config images pull --kubernetes-version "v${KUBE_VERSION%%-*}"
+    do
+        sleep $WAIT_PERIOD
+        [[ counter -eq $MAX_RETRIES ]] && echo "Failed to pull control plane images!" && break
+        (( counter++ ))
+    done
+    for manifest in ${PREPULL_MANIFESTS}; do
+        curl -sSL "${manifest}" \
+            | grep -E '^\s*-?\s*image:' \
+            | sed -E 's/^\s*-?\s*image:\s*//; s/["'"'"']//g' \
+            | sort -u \
+            | xargs -r -n1 sudo docker pull
+    done
+fi
+
 echo "source <(kubeadm completion bash)" >> "${HOME}"/.bashrc
 echo "source <(kubectl completion bash)" >> "${HOME}"/.bashrc
@@ -0,0 +1,231 @@
+"""
+Offline package bundles: the pinned template package set, resolved once into a tarball of .deb/.rpm files
+with an index, stored in the workspace under .konverge/bundles/<os>-<digest>.tar.gz.
+
+A bundle is pushed once per host over SFTP and installed from there, instead of apt/yum on upstream mirrors.
+"""
+import os
+import json
+import glob
+import time
+import uuid
+import shlex
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+from typing import NamedTuple
+
+import crayons
+
+from konverge.utils import FabricWrapper, FabricWrapperGroup
+
+
+BUNDLE_DIRECTORY = os.path.join('.konverge', 'bundles')
+BUNDLE_REMOTE_DIRECTORY = '/opt/kube/bundle'
+BUNDLE_INDEX = 'index.json'
+BUNDLE_PUSH_WORKERS = 4
+PACKAGE_EXTENSIONS = {'deb': '.deb', 'rpm': '.rpm'}
+
+
+class BundleIndex(NamedTuple):
+    name: str
+    os_type: str
+    package_format: str
+    packages: list
+    files: dict
+    created: float = 0.0
+
+    def to_json(self):
+        return json.dumps(self._asdict(), indent=2, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, content):
+        return cls(**json.loads(content))
+
+
+def bundle_name(os_type, packages):
+    """
+    Content-addressed name: the same pinned package set always maps to the same bundle.
+    """
+    digest = hashlib.sha256('\n'.join(sorted(packages)).encode()).hexdigest()[:12]
+    return f'{os_type}-{digest}'
+
+
+def find_bundle(directory, os_type, packages):
+    """
+    Path of the bundle of this package set in directory, or None if it was not built.
+    """
+    if not packages:
+        return None
+    path = os.path.join(directory, f'{bundle_name(os_type, packages)}.tar.gz')
+    return path if os.path.exists(path) else None
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as package_file:
+        for chunk in iter(lambda: package_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DirectoryMirror:
+    """
+    Pre-resolved packages in a local directory, e.g. a LAN mirror sync or a test stand-in.
+    All package files of the directory are bundled, dependencies are not resolved.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def fetch(self, packages: list, destination, package_format='deb'):
+        extension = PACKAGE_EXTENSIONS[package_format]
+        files = sorted(glob.glob(os.path.join(self.path, f'*{extension}')))
+        basenames = [os.path.basename(filename) for filename in files]
+        for package in packages:
+            # .deb files are named <name>_<version>_<arch>.deb, .rpm files <name>-<version>-<release>.<arch>.rpm
+            prefix = f'{package.replace("=", "_")}_' if package_format == 'deb' else package
+            if not any(basename.startswith(prefix) for basename in basenames):
+                logging.warning(crayons.yellow(f'Package {package} not found in mirror {self.path}'))
+        for filename in files:
+            shutil.copy2(filename, destination)
+        return [os.path.basename(filename) for filename in files]
+
+
+class HostMirror:
+    """
+    Resolve the dependency closure of packages with the package manager of a build host over SSH,
+    e.g. a VM cloned from the template OS image, with the docker and kubernetes repositories configured.
+    """
+    def __init__(self, wrapper: FabricWrapper):
+        self.wrapper = wrapper
+
+    @staticmethod
+    def resolve_command(packages: list, remote_directory, package_format='deb'):
+        specs = ' '.join(shlex.quote(package) for package in packages)
+        if package_format == 'rpm':
+            return f'yumdownloader --resolve --destdir {remote_directory} {specs}'
+        # apt-cache lists names only: requested packages are downloaded by spec, the rest of the closure by name.
+        names = [package.split('=')[0] for package in packages]
+        depends = '--recurse --no-recommends --no-suggests --no-conflicts --no-breaks --no-replaces --no-enhances'
+        closure = f'apt-cache depends {depends} {" ".join(shlex.quote(name) for name in names)} | grep "^[a-z0-9]" | sort -u'
+        exclude = ''.join(f' | grep -vx {shlex.quote(name)}' for name in names)
+        return f'cd {remote_directory} && apt-get download {specs} $({closure}{exclude})'
+
+    def fetch(self, packages: list, destination, package_format='deb'):
+        remote_directory = f'/tmp/konverge-bundle-{uuid.uuid4().hex[:8]}'
+        remote_archive = f'{remote_directory}.tar.gz'
+        print(crayons.cyan(f'Resolving {len(packages)} packages on {self.wrapper.host}'))
+        try:
+            self.wrapper.execute(f'mkdir -p {remote_directory}', hide=True)
+            resolved = self.wrapper.execute(self.resolve_command(packages, remote_directory, package_format), warn=True)
+            if not resolved or not resolved.ok:
+                raise RuntimeError(f'Package resolution on {self.wrapper.host} failed')
+            self.wrapper.execute(f'tar -czf {remote_archive} -C {remote_directory} .', hide=True)
+            local_archive = os.path.join(destination, os.path.basename(remote_archive))
+            self.wrapper.get(remote_archive, local=local_archive)
+            with tarfile.open(local_archive, mode='r:gz') as archive:
+                archive.extractall(destination)
+            os.remove(local_archive)
+        finally:
+            self.wrapper.execute(f'rm -rf {remote_directory} {remote_archive}', hide=True, warn=True)
+        extension = PACKAGE_EXTENSIONS[package_format]
+        return sorted(filename for filename in os.listdir(destination) if filename.endswith(extension))
+
+
+def mirror_factory(source):
+    """
+    A local directory is a DirectoryMirror, anything else an SSH host (~/.ssh/config alias) to resolve packages on.
+    """
+    if os.path.isdir(source):
+        return DirectoryMirror(source)
+    return HostMirror(FabricWrapper(host=source))
+
+
+def build_bundle(directory, os_type, packages: list, mirror, package_format='deb', force=False):
+    """
+    Returns the bundle path. Bundles are built once per package set, unless force.
+    """
+    name = bundle_name(os_type, packages)
+    path = os.path.join(directory, f'{name}.tar.gz')
+    if os.path.exists(path) and not force:
+        print(crayons.green(f'Bundle {name} exists: {path}'))
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f'{name}.', dir=directory)
+    try:
+        package_directory = os.path.join(staging, 'packages')
+        os.makedirs(package_directory)
+        files = mirror.fetch(list(packages), package_directory, package_format=package_format)
+        if not files:
+            raise RuntimeError(f'Mirror returned no {package_format} packages')
+        index = BundleIndex(
+            name=name,
+            os_type=os_type,
+            package_format=package_format,
+            packages=sorted(packages),
+            files={filename: _sha256(os.path.join(package_directory, filename)) for filename in files},
+            created=time.time()
+        )
+        with open(os.path.join(staging, BUNDLE_INDEX), mode='w') as index_file:
+            index_file.write(index.to_json())
+        partial = f'{path}.part'
+        with tarfile.open(partial, mode='w:gz') as archive:
+            archive.add(os.path.join(staging, BUNDLE_INDEX), arcname=BUNDLE_INDEX)
+            archive.add(package_directory, arcname='packages')
+        os.replace(partial, path)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    print(crayons.green(f'Bundle {name}: {len(files)} packages in {path}'))
+    return path
+
+
+def read_index(path):
+    with tarfile.open(path, mode='r:gz') as archive:
+        return BundleIndex.from_json(archive.extractfile(BUNDLE_INDEX).read().decode())
+
+
+def _push(path, index: BundleIndex, remote_directory, wrapper: FabricWrapper):
+    """
+    Skipped if the host already holds this bundle. The archive is uploaded to the login directory, as SFTP runs without sudo.
+    Each step is a separate command, so that each runs with sudo. The bundle index must be on the host afterwards.
+    """
+    installed = wrapper.execute(f'cat {remote_directory}/{BUNDLE_INDEX}', hide=True, warn=True)
+    if installed and installed.ok:
+        try:
+            if BundleIndex.from_json(installed.stdout).name == index.name:
+                return 'present'
+        except (ValueError, TypeError):
+            pass
+    archive = os.path.basename(path)
+    wrapper.put(path, remote=archive)
+    steps = (
+        f'rm -rf {remote_directory}',
+        f'mkdir -p {remote_directory}',
+        f'tar -xzf {archive} -C {remote_directory}',
+        f'rm -f {archive}',
+        f'test -f {remote_directory}/{BUNDLE_INDEX}'
+    )
+    for step in steps:
+        extracted = wrapper.execute(step, hide=True, warn=True)
+        if not extracted or not extracted.ok:
+            raise RuntimeError(f'Cannot extract bundle {index.name} to {remote_directory}: {step} failed')
+    return 'pushed'
+
+
+def push_bundle(path, hosts: dict, remote_directory=BUNDLE_REMOTE_DIRECTORY, max_workers=BUNDLE_PUSH_WORKERS):
+    """
+    Push the bundle to hosts: {name: FabricWrapper with sudo}, in parallel. Returns {name: HostResult}.
+    """
+    index = read_index(path)
+    results = FabricWrapperGroup(hosts, max_workers=max_workers).map(
+        lambda name, wrapper: _push(path, index, remote_directory, wrapper)
+    )
+    for name, result in sorted(results.items()):
+        if result.ok:
+            print(crayons.green(f'Bundle {index.name} {result.result} on {name} in {result.duration:.1f}s'))
+        else:
+            logging.error(crayons.red(f'Bundle {index.name} push to {name} failed: {result.error}'))
+    return results
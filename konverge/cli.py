@@ -7,6 +7,11 @@ from shutil import copyfile
 
 from konverge import VERSION
 from konverge.kubecluster import KubeCluster, KubeClusterStages
+from konverge.concurrency import ConcurrencyLimits
+from konverge.serializers import ClusterAttributesSerializer
+from konverge.cloudinit import CloudinitTemplate
+from konverge.bundle import BUNDLE_DIRECTORY, build_bundle, mirror_factory, push_bundle
+from konverge.utils import FabricWrapper
 from konverge import settings
 
 
@@ -135,7 +140,7 @@ def init(file, pve_file):
 
 
 @cli.command(help='Create K8s Cluster.')
-@click.option('--timeout', '-t', type=click.INT, help='Wait period between phases in seconds. Default: 120 sec.')
+@click.option('--timeout', '-t', type=click.INT, help='Max wait for Proxmox tasks between phases in seconds. Default: 600 sec.')
 @click.option('--dry-run', '-d', is_flag=True, default=False, type=click.BOOL, help='Dry-run (preview) this operation.')
 @click.option(
     '--stage',
@@ -151,7 +156,12 @@ def init(file, pve_file):
         ]
     ),
     help='Creation Stage.')
-def create(timeout, dry_run, stage):
+@click.option('--parallel', '-P', default=1, type=click.INT, help='Max VMs provisioned concurrently. Default: 1 (sequential).')
+@click.option('--per-node', default=1, type=click.INT, help='Max VMs provisioned concurrently per Proxmox node. Default: 1.')
+@click.option('--join-parallel', default=10, type=click.INT, help='Max worker nodes joining concurrently. Default: 10.')
+@click.option('--template-parallel', default=4, type=click.INT, help='Max templates built concurrently, one per Proxmox node. Default: 4.')
+@click.option('--graph', '-g', is_flag=True, default=False, type=click.BOOL, help='Run all stages as a dependency graph of per-VM tasks.')
+def create(timeout, dry_run, stage, parallel, per_node, join_parallel, template_parallel, graph):
     if not _settings_valid():
         return
 
@@ -160,22 +170,27 @@ def create(timeout, dry_run, stage):
         execute_stage = KubeClusterStages.return_value(stage)
 
     cluster = _get_cluster()
+    limits = ConcurrencyLimits(global_limit=parallel, per_node=per_node, joins=join_parallel, templates=template_parallel)
 
     if execute_stage:
         cluster.execute(
             wait_period=timeout,
             dry_run=dry_run,
-            stage=execute_stage
+            stage=execute_stage,
+            limits=limits
         ) if timeout else cluster.execute(
             dry_run=dry_run,
-            stage=execute_stage
+            stage=execute_stage,
+            limits=limits
         )
         return
 
     cluster.execute(
         wait_period=timeout,
-        dry_run=dry_run
-    ) if timeout else cluster.execute(dry_run=dry_run)
+        dry_run=dry_run,
+        limits=limits,
+        graph=graph
+    ) if timeout else cluster.execute(dry_run=dry_run, limits=limits, graph=graph)
 
 
 @cli.command(help='Destroy K8s Cluster.')
@@ -240,15 +255,59 @@ def destroy(timeout, dry_run, stage, templates):
 
 
 @cli.command(help='Apply K8s Cluster (declarative).')
-@click.option('--timeout', '-t', type=click.INT, help='Wait period between phases in seconds. Default: 120 sec.')
+@click.option('--timeout', '-t', type=click.INT, help='Max wait for Proxmox tasks between phases in seconds. Default: 600 sec.')
 @click.option('--dry-run', '-d', is_flag=True, default=False, type=click.BOOL, help='Dry-run (preview) this operation.')
-def apply(timeout, dry_run):
+@click.option('--parallel', '-P', default=1, type=click.INT, help='Max VMs provisioned concurrently. Default: 1 (sequential).')
+@click.option('--per-node', default=1, type=click.INT, help='Max VMs provisioned concurrently per Proxmox node. Default: 1.')
+@click.option('--join-parallel', default=10, type=click.INT, help='Max worker nodes joining concurrently. Default: 10.')
+def apply(timeout, dry_run, parallel, per_node, join_parallel):
     if not _settings_valid():
         return
 
     cluster = _get_cluster()
+    # Apply only clones workers from the existing templates and joins them to the running control plane:
+    # no template is built and there is no leader to bootstrap, so --template-parallel and --graph do not apply here.
+    limits = ConcurrencyLimits(global_limit=parallel, per_node=per_node, joins=join_parallel)
     cluster.execute(
         wait_period=timeout,
         dry_run=dry_run,
-        apply=True
-    ) if timeout else cluster.execute(dry_run=dry_run, apply=True)
\ No newline at end of file
+        apply=True,
+        limits=limits
+    ) if timeout else cluster.execute(dry_run=dry_run, apply=True, limits=limits)
+
+
+@cli.command(help='Build the offline package bundle of the cluster templates.')
+@click.option('--mirror', '-m', required=True, help='Package source: a local directory of .deb/.rpm files, or an SSH host to resolve packages on.')
+@click.option('--push', '-p', multiple=True, help='Push the bundle to this SSH host. Repeatable.')
+@click.option('--force', '-f', is_flag=True, default=False, type=click.BOOL, help='Rebuild the bundle, even if it exists.')
+def bundle(mirror, push, force):
+    if not _settings_valid():
+        return
+
+    config = settings.kube_config.serialize()
+    if not config:
+        return
+
+    attributes = ClusterAttributesSerializer(config)
+    attributes.serialize()
+    cluster = attributes.cluster
+    template = CloudinitTemplate.os_type_factory(cluster.os_type)
+    packages = template.bundle_packages(cluster.version, cluster.docker, cluster.docker_ce)
+    if not packages:
+        logging.error(crayons.red(f'Offline bundles are not supported for OS type {cluster.os_type}'))
+        return
+
+    try:
+        path = build_bundle(
+            os.path.join(settings.WORKDIR, BUNDLE_DIRECTORY),
+            cluster.os_type,
+            packages,
+            mirror_factory(mirror),
+            package_format=template.package_format,
+            force=force
+        )
+    except Exception as bundle_error:
+        logging.error(crayons.red(f'Bundle build failed: {bundle_error}'))
+        return
+    if push:
+        push_bundle(path, {host: FabricWrapper(host=host, sudo=True) for host in push})
@@ -1,22 +1,31 @@
 import os
-import time
+import json
+import hashlib
 import logging
 
 import crayons
+import requests
 
-from konverge.pve import VMAPIClient
+from konverge.pve import VMAPIClient, VMInventory
 from konverge.mixins import CommonVMMixin, ExecuteStagesMixin
 from konverge.utils import (
     VMAttributes,
     FabricWrapper
 )
-from konverge.settings import pve_cluster_config_client
+from konverge.bundle import BUNDLE_DIRECTORY, find_bundle
+from konverge.settings import pve_cluster_config_client, image_cache, BASE_PATH, WORKDIR
+
+
+FINGERPRINT_TAG_PREFIX = 'kfp-'
+FINGERPRINT_FILES = ('daemon.json', 'dashboard-adminuser.yaml')
 
 
 class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
     cls_cloud_image = ''
     full_url = ''
+    checksum_url = ''
     filename = ''
+    package_format = 'deb'
     disk_size_low_limit = 5
 
     def __init__(
@@ -65,6 +74,94 @@ class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
     def full_image_url(self):
         return self.full_url
 
+    def cache_cloudinit_image(self):
+        """
+        Download the cloud image once to the local image cache, verified against checksum_url.
+        Returns the CachedImage, or None on failure.
+        """
+        try:
+            return image_cache.fetch(self.full_image_url, checksum_url=self.checksum_url, filename=self.cloud_image)
+        except (OSError, ValueError, requests.RequestException) as cache_error:
+            logging.error(crayons.red(f'Cannot cache image {self.cloud_image}: {cache_error}'))
+            return None
+
+    def image_checksum(self):
+        """
+        Published sha256 of the cloud image, or the digest of the cached image if the checksum list is unreachable.
+        """
+        checksum = image_cache.expected_checksum(self.cloud_image, self.checksum_url)
+        if checksum:
+            return checksum
+        cached = image_cache.cached(self.full_image_url)
+        return cached.sha256 if cached else None
+
+    def fingerprint(self, kubernetes_version, docker_version, docker_ce=False, image_checksum=None, prepull_manifests=None):
+        """
+        Hash of everything baked into the template: versions, bootstrap scripts, image and disk settings.
+        Equal fingerprints mean interchangeable templates, on any node and for any cluster.
+        """
+        scripts = {}
+        for script in (self.filename, *FINGERPRINT_FILES) if self.preinstall else ():
+            path = os.path.join(BASE_PATH, 'bootstrap', script)
+            if not os.path.exists(path):
+                scripts[script] = None
+                continue
+            with open(path, mode='rb') as script_file:
+                scripts[script] = hashlib.sha256(script_file.read()).hexdigest()
+        inputs = {
+            'os_type': self.vm_attributes.os_type,
+            'image': self.full_image_url,
+            'image_sha256': image_checksum,
+            'preinstall': self.preinstall,
+            'kubernetes': kubernetes_version if self.preinstall else None,
+            'docker': docker_version if self.preinstall else None,
+            'docker_ce': docker_ce if self.preinstall else None,
+            'prepull': sorted(prepull_manifests) if self.preinstall and prepull_manifests is not None else None,
+            'scripts': scripts,
+            'disk_size': self.vm_attributes.disk_size,
+            'scsi': self.vm_attributes.scsi,
+            'storage': getattr(self.vm_attributes.storage_type, 'value', self.vm_attributes.storage_type)
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def fingerprint_tag(fingerprint):
+        return f'{FINGERPRINT_TAG_PREFIX}{fingerprint}'
+
+    def tag_fingerprint(self, fingerprint):
+        """
+        Record the fingerprint as a tag, found in the cached VM inventory, and in the description.
+        Only an exported template is tagged. Returns True if tagged.
+        """
+        vm = self.client.get_vm_inventory(refresh=True).get(self.vmid)
+        if not vm or not VMInventory.is_template(vm):
+            logging.warning(crayons.yellow(f'{self.vm_attributes.name} {self.vmid} is not an exported template. Skip fingerprint tag.'))
+            return False
+        description = f'{self.vm_attributes.description}\nFingerprint: {fingerprint}'
+        self.client.update_vm_config(
+            node=self.vm_attributes.node,
+            vmid=self.vmid,
+            tags=self.fingerprint_tag(fingerprint),
+            description=description
+        )
+        self.client.invalidate_vm_inventory()
+        print(crayons.green(f'Template {self.vm_attributes.name} {self.vmid} fingerprint: {fingerprint}'))
+        return True
+
+    @classmethod
+    def bundle_packages(cls, kubernetes_version, docker_version, docker_ce=False):
+        """
+        Pinned package set installed by the template script, for offline bundles. Empty if not supported.
+        """
+        return ()
+
+    def find_bundle(self, kubernetes_version, docker_version, docker_ce=False):
+        return find_bundle(
+            os.path.join(WORKDIR, BUNDLE_DIRECTORY),
+            self.vm_attributes.os_type,
+            self.bundle_packages(kubernetes_version, docker_version, docker_ce)
+        )
+
     @staticmethod
     def os_type_factory(os_type='ubuntu'):
         options = {
@@ -99,6 +196,12 @@ class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
             print(crayons.green(f'Cloud image: {self.cloud_image} already exists in {self.cloudinit_location}.'))
             return image_filename
 
+        image = self.cache_cloudinit_image()
+        if image:
+            pushed = image_cache.distribute(image, self.cloudinit_location, {self.vm_attributes.node: self.proxmox_node})
+            if all(result.ok for result in pushed.values()):
+                return image_filename
+
         logging.warning(crayons.yellow(f'Cloud image: {self.cloud_image} not found in {self.cloudinit_location}. Downloading {self.full_image_url}'))
         get_image_command = f'rm -vf {self.cloud_image}; wget {self.full_image_url} && mv {self.cloud_image} {self.cloudinit_location}'
         downloaded = self.proxmox_node.execute(get_image_command, warn=True)
@@ -120,6 +223,56 @@ class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
             return True
         return False
 
+    def replicate(self, golden: 'CloudinitTemplate', dry_run=False):
+        """
+        Create this node's template as a full clone of the golden template, instead of building it.
+        Shared storage clones to this node directly. Local storage clones on the golden node,
+        then migrates offline to this node, before export.
+        """
+        shared = golden.storage_details.get('shared', False)
+        source = golden.vm_attributes.node
+        if dry_run:
+            print(
+                crayons.blue(
+                    f'Replicate golden template {golden.vmid} from node {source} to {self.vm_attributes.name} {self.vmid} '
+                    f'on node {self.vm_attributes.node}: {"clone to target" if shared else "clone and migrate"}'
+                )
+            )
+            return self.vmid
+
+        print(crayons.cyan(f'Stage: Clone golden template {golden.vmid} to {self.vm_attributes.name} {self.vmid}'))
+        cloned = self.wait_for_task(
+            self.client.clone_vm_from_template(
+                node=source,
+                source_vmid=golden.vmid,
+                target_vmid=self.vmid,
+                name=self.vm_attributes.name,
+                description=self.vm_attributes.description,
+                pool=self.vm_attributes.pool,
+                full=True,
+                storage=self.vm_attributes.storage_type,
+                target=self.vm_attributes.node if shared else None
+            ),
+            operation='Clone golden template'
+        )
+        if not cloned:
+            raise RuntimeError(f'Clone of golden template {golden.vmid} to {self.vmid} failed')
+
+        if not shared:
+            print(crayons.cyan(f'Stage: Migrate {self.vm_attributes.name} {self.vmid} from node {source} to {self.vm_attributes.node}'))
+            migrated = self.wait_for_task(
+                self.client.migrate_vm(node=source, vmid=self.vmid, target=self.vm_attributes.node),
+                operation='Migrate'
+            )
+            if not migrated:
+                raise RuntimeError(f'Migration of {self.vmid} to node {self.vm_attributes.node} failed')
+
+        print(crayons.cyan(f'Stage: exporting template from VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
+        if not self.export_template():
+            raise RuntimeError(f'Template export of {self.vmid} failed')
+        print(crayons.green(f'Template replicated: {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
+        return self.vmid
+
     def execute(
         self,
         kubernetes_version='1.16.3-00',
@@ -127,7 +280,8 @@ class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
         docker_ce=False,
         storageos_requirements=False,
         destroy=False,
-        dry_run=False
+        dry_run=False,
+        prepull_manifests: list = None
     ):
         if dry_run:
             self.dry_run(destroy=destroy, instance=False)
@@ -139,50 +293,68 @@ class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
 
         if self.disk_size_check():
             logging.error(crayons.red('Aborting operation.'))
-            return self.vmid
+            return None
 
         print(crayons.cyan(f'Stage: Download image: {self.cloud_image}'))
         image_filename = self.download_cloudinit_image()
 
         print(crayons.cyan(f'Stage: Create Base VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
-        logging.warning(crayons.yellow(self.create_vm()))
+        created = self.create_vm()
+        if not created:
+            return None
+        logging.warning(crayons.yellow(created))
 
         print(crayons.cyan('Stage: Import image and get unused storage'))
         if not self.import_cloudinit_image(image_filename):
             logging.error(crayons.red('Operation failed.'))
-            return self.vmid
+            return None
 
         volume = self.get_storage(unused=True)
+        config = self.config_builder()
         print(crayons.cyan(f'Stage: Attach volume to VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
-        logging.warning(crayons.yellow(self.attach_volume_to_vm(volume)))
+        self.attach_volume_to_vm(volume, config=config)
 
         print(crayons.cyan(f'Stage: Add cloudinit drive'))
-        logging.warning(crayons.yellow(self.add_cloudinit_drive()))
+        self.add_cloudinit_drive(config=config)
 
         print(crayons.cyan(f'Stage: Set boot disk'))
-        logging.warning(crayons.yellow(self.set_boot_disk()))
+        self.set_boot_disk(config=config)
 
         print(crayons.cyan(f'Stage: Resize disk'))
-        self.resize_disk()
+        self.resize_disk(config=config)
 
         print(crayons.cyan(f'Stage: Set VGA serial drive'))
-        self.set_vga_display()
+        self.set_vga_display(config=config)
+
+        print(crayons.cyan(f'Stage: Apply config for VM {self.vm_attributes.name} {self.vmid}'))
+        logging.warning(crayons.yellow(config.apply()))
 
         if self.preinstall:
-            self.start_stage(cloudinit=True, wait_minutes=4)
+            if not self.start_stage(cloudinit=True, wait_minutes=4):
+                logging.error(crayons.red(f'VM {self.vm_attributes.name} {self.vmid} is not ready. Abort template export.'))
+                self.stop_stage(cloudinit=True)
+                return None
             print(crayons.cyan(f'Stage: Install kubernetes pre-requisites from file {self.filename}'))
-            self.install_kube(
+            installed = self.install_kube(
                 filename=self.filename,
                 kubernetes_version=kubernetes_version,
                 docker_version=docker_version,
                 docker_ce=docker_ce,
-                storageos_requirements=storageos_requirements
+                storageos_requirements=storageos_requirements,
+                prepull_manifests=prepull_manifests,
+                bundle=self.find_bundle(kubernetes_version, docker_version, docker_ce)
             )
-            time.sleep(5)
+            # The VM is stopped hard: flush its page cache to disk first, instead of waiting a fixed period.
+            FabricWrapper(host=self.vm_attributes.name, sudo=True).execute('sync', hide=True, warn=True)
             self.stop_stage(cloudinit=True)
+            if not installed:
+                logging.error(crayons.red(f'Install on {self.vm_attributes.name} {self.vmid} failed. Abort template export.'))
+                return None
 
         print(crayons.cyan(f'Stage: exporting template from VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
-        self.export_template()
+        if not self.export_template():
+            logging.error(crayons.red(f'Template export of {self.vm_attributes.name} {self.vmid} failed.'))
+            return None
         print(crayons.green(f'Template exported: {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
         return self.vmid
 
@@ -190,6 +362,7 @@ class CloudinitTemplate(CommonVMMixin, ExecuteStagesMixin):
 class UbuntuCloudInitTemplate(CloudinitTemplate):
     cls_cloud_image = 'bionic-server-cloudimg-amd64.img'
     full_url = f'https://cloud-images.ubuntu.com/bionic/current/{cls_cloud_image}'
+    checksum_url = 'https://cloud-images.ubuntu.com/bionic/current/SHA256SUMS'
     filename = 'req_ubuntu.sh'
     disk_size_low_limit = 5
 
@@ -214,6 +387,27 @@ class UbuntuCloudInitTemplate(CloudinitTemplate):
         username = 'ubuntu'
         return template_vmid, username
 
+    @staticmethod
+    def docker_package_version(docker_version):
+        return f'{docker_version}-0ubuntu1~18.04.4' if 'ubuntu' not in docker_version else docker_version
+
+    @classmethod
+    def bundle_packages(cls, kubernetes_version, docker_version, docker_ce=False):
+        docker = f'docker-ce={docker_version}' if docker_ce else f'docker.io={cls.docker_package_version(docker_version)}'
+        return (
+            'qemu-guest-agent',
+            'linux-generic-hwe-18.04',
+            docker,
+            f'kubelet={kubernetes_version}',
+            f'kubeadm={kubernetes_version}',
+            f'kubectl={kubernetes_version}',
+            'keepalived',
+            'netcat',
+            'iproute2',
+            'curl',
+            'wget'
+        )
+
     def execute(
         self,
         kubernetes_version='1.16.3-00',
@@ -221,16 +415,17 @@ class UbuntuCloudInitTemplate(CloudinitTemplate):
         docker_ce=False,
         storageos_requirements=False,
         destroy=False,
-        dry_run=False
+        dry_run=False,
+        prepull_manifests: list = None
     ):
-        suffix = '-0ubuntu1~18.04.4' if 'ubuntu' not in docker_version else ''
-        super().execute(
+        return super().execute(
             kubernetes_version=kubernetes_version,
-            docker_version=f'{docker_version}{suffix}',
+            docker_version=self.docker_package_version(docker_version),
             docker_ce=docker_ce,
             storageos_requirements=storageos_requirements,
             destroy=destroy,
-            dry_run=dry_run
+            dry_run=dry_run,
+            prepull_manifests=prepull_manifests
         )
 
     def install_storageos_requirements(self):
@@ -251,7 +446,9 @@ class UbuntuCloudInitTemplate(CloudinitTemplate):
 class CentosCloudInitTemplate(CloudinitTemplate):
     cls_cloud_image = 'CentOS-7-x86_64-GenericCloud.qcow2'
     full_url = f'https://cloud.centos.org/centos/7/images/{cls_cloud_image}'
+    checksum_url = 'https://cloud.centos.org/centos/7/images/sha256sum.txt'
     filename = 'req_centos.sh'
+    package_format = 'rpm'
     disk_size_low_limit = 10
 
     def _update_description(self):
@@ -282,15 +479,17 @@ class CentosCloudInitTemplate(CloudinitTemplate):
         docker_ce=False,
         storageos_requirements=False,
         destroy=False,
-        dry_run=False
+        dry_run=False,
+        prepull_manifests: list = None
     ):
-        super().execute(
+        return super().execute(
             kubernetes_version=kubernetes_version,
             docker_version=docker_version,
             docker_ce=docker_ce,
             storageos_requirements=storageos_requirements,
             destroy=destroy,
-            dry_run=dry_run
+            dry_run=dry_run,
+            prepull_manifests=prepull_manifests
         )
 
     def install_storageos_requirements(self):
@@ -0,0 +1,180 @@
+"""
+Bounded concurrency helpers for fan-out over Proxmox nodes and VMs.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Any, Callable
+
+import crayons
+
+
+class ConcurrencyLimits(NamedTuple):
+    global_limit: int = 1
+    per_node: int = 1
+    joins: int = 10
+    master_joins: int = 2
+    templates: int = 4
+
+    @property
+    def sequential(self):
+        return self.global_limit <= 1
+
+
+class TaskOutcome(NamedTuple):
+    name: str
+    key: str
+    ok: bool
+    result: Any = None
+    error: Any = None
+    duration: float = 0.0
+
+
+class KeyedLimiter:
+    """
+    One semaphore per key, e.g. per Proxmox node.
+    """
+    def __init__(self, limit=1):
+        self.limit = max(1, limit)
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, key):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[key]
+
+    @contextmanager
+    def acquire(self, key):
+        semaphore = self._semaphore(key)
+        with semaphore:
+            yield
+
+
+def _run_task(name, key, function: Callable, limiter: KeyedLimiter = None):
+    start = time.monotonic()
+    try:
+        if limiter:
+            with limiter.acquire(key):
+                result = function()
+        else:
+            result = function()
+        return TaskOutcome(name=name, key=key, ok=True, result=result, duration=time.monotonic() - start)
+    except Exception as task_error:
+        logging.error(crayons.red(f'{name} failed: {task_error}'))
+        return TaskOutcome(name=name, key=key, ok=False, error=task_error, duration=time.monotonic() - start)
+
+
+def run_concurrently(tasks: list, limits: ConcurrencyLimits = ConcurrencyLimits()):
+    """
+    Run (name, key, callable) tasks with a global worker limit and a per-key limit.
+    Returns one TaskOutcome per task, in submission order. Exceptions are captured, never raised.
+    """
+    if not tasks:
+        return []
+    if limits.sequential:
+        return [_run_task(name, key, function) for name, key, function in tasks]
+
+    limiter = KeyedLimiter(limits.per_node)
+    with ThreadPoolExecutor(max_workers=min(limits.global_limit, len(tasks))) as pool:
+        futures = [
+            pool.submit(_run_task, name, key, function, limiter)
+            for name, key, function in tasks
+        ]
+        return [future.result() for future in futures]
+
+
+def mark_failed(outcomes: list, error='No result'):
+    """
+    Tasks that completed without raising, but returned a falsy result, count as failed.
+    """
+    return [
+        outcome._replace(ok=False, error=error) if outcome.ok and not outcome.result else outcome
+        for outcome in outcomes
+    ]
+
+
+def report_outcomes(outcomes: list, title='Results'):
+    print(crayons.cyan(title))
+    for outcome in outcomes:
+        status = crayons.green('OK') if outcome.ok else crayons.red(f'FAILED: {outcome.error}')
+        print(crayons.white(f'{outcome.name} [{outcome.key}] {outcome.duration:.1f}s: ') + status)
+    return all(outcome.ok for outcome in outcomes)
+
+
+class ThreadOutput:
+    """
+    sys.stdout / sys.stderr proxy: threads inside thread_log() write to their own log file,
+    all other threads to the original stream.
+    """
+    def __init__(self, stream, local: threading.local):
+        self.stream = stream
+        self.local = local
+
+    def _target(self):
+        return getattr(self.local, 'stream', None) or self.stream
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        return self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ThreadLogFilter(logging.Filter):
+    """
+    Root logger records of threads inside thread_log() go to their log file, instead of the root handlers.
+    """
+    def __init__(self, local: threading.local):
+        super().__init__()
+        self.local = local
+
+    def filter(self, record):
+        stream = getattr(self.local, 'stream', None)
+        if not stream:
+            return True
+        stream.write(f'{record.levelname}:{record.name}:{record.getMessage()}\n')
+        return False
+
+
+_thread_streams = threading.local()
+_thread_log_filter = ThreadLogFilter(_thread_streams)
+_thread_output_lock = threading.Lock()
+_thread_output_users = 0
+
+
+@contextmanager
+def thread_log(filename):
+    """
+    Redirect print, logging and fabric output of the current thread to filename, e.g. one log per Proxmox node.
+    """
+    global _thread_output_users
+    with _thread_output_lock:
+        if not _thread_output_users:
+            sys.stdout = ThreadOutput(sys.stdout, _thread_streams)
+            sys.stderr = ThreadOutput(sys.stderr, _thread_streams)
+            logging.getLogger().addFilter(_thread_log_filter)
+        _thread_output_users += 1
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    try:
+        with open(filename, mode='a', buffering=1) as log_file:
+            _thread_streams.stream = log_file
+            try:
+                yield log_file
+            finally:
+                _thread_streams.stream = None
+    finally:
+        with _thread_output_lock:
+            _thread_output_users -= 1
+            if not _thread_output_users:
+                sys.stdout = sys.stdout.stream
+                sys.stderr = sys.stderr.stream
+                logging.getLogger().removeFilter(_thread_log_filter)
@@ -0,0 +1,238 @@
+"""
+Content-addressed cache of cloud images, stored in the workspace under .konverge/images/sha256/<digest>.
+
+Each image is downloaded once, verified against the published checksum list,
+and pushed to the Proxmox nodes over the pooled SSH connections.
+"""
+import os
+import re
+import json
+import shlex
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import NamedTuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+import crayons
+import requests
+
+from konverge.utils import FabricWrapper, FabricWrapperGroup
+
+
+IMAGE_CACHE_DIRECTORY = os.path.join('.konverge', 'images')
+IMAGE_DOWNLOAD_TIMEOUT = 30
+IMAGE_CHUNK_SIZE = 1024 * 1024
+IMAGE_PUSH_WORKERS = 4
+
+
+class HTTPImageSource:
+    def __init__(self, url, timeout=IMAGE_DOWNLOAD_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+
+    def chunks(self):
+        with requests.get(self.url, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                if chunk:
+                    yield chunk
+
+    def read_text(self):
+        response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.text
+
+
+class FileImageSource:
+    def __init__(self, path):
+        self.url = path
+        self.path = url2pathname(urlparse(path).path) if path.startswith('file://') else path
+
+    def chunks(self):
+        with open(self.path, mode='rb') as image_file:
+            for chunk in iter(lambda: image_file.read(IMAGE_CHUNK_SIZE), b''):
+                yield chunk
+
+    def read_text(self):
+        with open(self.path, mode='r') as text_file:
+            return text_file.read()
+
+
+def image_source(url):
+    """
+    http(s):// urls download over HTTP, file:// urls and plain paths read local files.
+    """
+    if urlparse(url).scheme in ('http', 'https'):
+        return HTTPImageSource(url)
+    return FileImageSource(url)
+
+
+def parse_checksums(text, filename):
+    """
+    sha256 digest of filename in a checksum list, GNU (<digest> [*]<filename>) or BSD (SHA256 (<filename>) = <digest>) format.
+    """
+    for line in text.splitlines():
+        gnu = re.match(r'^([0-9a-fA-F]{64})\s+\*?(\S+)$', line.strip())
+        if gnu and os.path.basename(gnu.group(2)) == filename:
+            return gnu.group(1).lower()
+        bsd = re.match(r'^SHA256\s*\((\S+)\)\s*=\s*([0-9a-fA-F]{64})$', line.strip())
+        if bsd and os.path.basename(bsd.group(1)) == filename:
+            return bsd.group(2).lower()
+    return None
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as image_file:
+        for chunk in iter(lambda: image_file.read(IMAGE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CachedImage(NamedTuple):
+    filename: str
+    path: str
+    sha256: str
+    size: int
+
+
+class ImageCache:
+    def __init__(self, directory, source_factory: callable = image_source):
+        """
+        source_factory: Callable(url) returning an object with chunks() and read_text(). Defaults to HTTP and local files.
+        """
+        self.directory = directory
+        self.source_factory = source_factory
+        self.index_filename = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        self._url_locks = {}
+
+    def _url_lock(self, url):
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _blob(self, digest):
+        return os.path.join(self.directory, 'sha256', digest)
+
+    def _read_index(self):
+        if not os.path.exists(self.index_filename):
+            return {}
+        try:
+            with open(self.index_filename, mode='r') as index_file:
+                return json.load(index_file)
+        except ValueError:
+            logging.warning(crayons.yellow(f'Image cache index {self.index_filename} is unreadable. Rebuild.'))
+            return {}
+
+    def _write_index(self, url, image: CachedImage):
+        with self._lock:
+            index = self._read_index()
+            index[url] = {'filename': image.filename, 'sha256': image.sha256, 'size': image.size}
+            temporary = f'{self.index_filename}.tmp'
+            with open(temporary, mode='w') as index_file:
+                json.dump(index, index_file, indent=2, sort_keys=True)
+            os.replace(temporary, self.index_filename)
+
+    def expected_checksum(self, filename, checksum_url=None):
+        """
+        Published sha256 of filename, or None if there is no checksum list or it cannot be read.
+        """
+        if not checksum_url:
+            return None
+        try:
+            checksum = parse_checksums(self.source_factory(checksum_url).read_text(), filename)
+        except (OSError, requests.RequestException) as checksum_error:
+            logging.warning(crayons.yellow(f'Cannot read checksums {checksum_url}: {checksum_error}'))
+            return None
+        if not checksum:
+            logging.warning(crayons.yellow(f'No checksum for {filename} in {checksum_url}'))
+        return checksum
+
+    def cached(self, url, expected=None):
+        """
+        Returns the CachedImage of url, or None. With expected, only an image of that digest matches.
+        """
+        entry = self._read_index().get(url)
+        digest = expected or (entry.get('sha256') if entry else None)
+        if not digest or not os.path.exists(self._blob(digest)):
+            return None
+        filename = entry.get('filename') if entry else os.path.basename(urlparse(url).path)
+        return CachedImage(filename=filename, path=self._blob(digest), sha256=digest, size=os.path.getsize(self._blob(digest)))
+
+    def fetch(self, url, checksum_url=None, filename=None):
+        """
+        Returns the CachedImage of url, downloaded once and verified against checksum_url.
+        Raises ValueError on a checksum mismatch.
+        """
+        filename = filename or os.path.basename(urlparse(url).path)
+        with self._url_lock(url):
+            expected = self.expected_checksum(filename, checksum_url)
+            image = self.cached(url, expected)
+            if image:
+                print(crayons.green(f'Cloud image: {filename} cached: {image.sha256}'))
+                return image
+
+            print(crayons.cyan(f'Downloading {url} to image cache {self.directory}'))
+            os.makedirs(os.path.join(self.directory, 'sha256'), exist_ok=True)
+            digest = hashlib.sha256()
+            size = 0
+            descriptor, temporary = tempfile.mkstemp(prefix=f'{filename}.', suffix='.part', dir=self.directory)
+            try:
+                with os.fdopen(descriptor, mode='wb') as part_file:
+                    for chunk in self.source_factory(url).chunks():
+                        digest.update(chunk)
+                        part_file.write(chunk)
+                        size += len(chunk)
+                checksum = digest.hexdigest()
+                if expected and checksum != expected:
+                    raise ValueError(f'Checksum mismatch for {filename}: expected {expected}, downloaded {checksum}')
+                if not expected:
+                    logging.warning(crayons.yellow(f'Cloud image: {filename} has no published checksum. Cached unverified.'))
+                os.replace(temporary, self._blob(checksum))
+            finally:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+
+            image = CachedImage(filename=filename, path=self._blob(checksum), sha256=checksum, size=size)
+            self._write_index(url, image)
+            print(crayons.green(f'Cloud image: {filename} cached: {checksum} ({size} bytes)'))
+            return image
+
+    @staticmethod
+    def _push(image: CachedImage, remote_directory, wrapper: FabricWrapper):
+        """
+        Upload over SFTP to a partial file, then move it in place. Skipped if the remote file has the same digest.
+        A sudo user uploads to its home directory first: SFTP runs without sudo.
+        """
+        remote_path = os.path.join(remote_directory, image.filename)
+        existing = wrapper.execute(f'sha256sum {shlex.quote(remote_path)}', hide=True, warn=True)
+        if existing and existing.ok and existing.stdout.split()[:1] == [image.sha256]:
+            return 'present'
+        part = f'{image.filename}.part' if wrapper.sudo else f'{remote_path}.part'
+        wrapper.put(image.path, remote=part)
+        moved = wrapper.execute(f'mv -f {shlex.quote(part)} {shlex.quote(remote_path)}', hide=True, warn=True)
+        if not moved or not moved.ok:
+            raise RuntimeError(f'Cannot move {part} to {remote_path}')
+        return 'pushed'
+
+    def distribute(self, image: CachedImage, remote_directory, nodes: dict, shared=False, max_workers=IMAGE_PUSH_WORKERS):
+        """
+        Push image to remote_directory on nodes: {name: FabricWrapper}, in parallel.
+        On shared storage, one node receives the image for all. Returns {name: HostResult}.
+        """
+        if shared and nodes:
+            name = sorted(nodes.keys())[0]
+            nodes = {name: nodes[name]}
+            print(crayons.white(f'Shared image storage: push {image.filename} through node {name} only'))
+        results = FabricWrapperGroup(nodes, max_workers=max_workers).map(
+            lambda name, wrapper: self._push(image, remote_directory, wrapper)
+        )
+        for name, result in sorted(results.items()):
+            if result.ok:
+                print(crayons.green(f'Cloud image: {image.filename} {result.result} on {name} in {result.duration:.1f}s'))
+            else:
+                logging.error(crayons.red(f'Cloud image: {image.filename} push to {name} failed: {result.error}'))
+        return results
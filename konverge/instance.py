@@ -1,7 +1,7 @@
 import logging
 import crayons
 
-from konverge.pve import VMAPIClient
+from konverge.pve import VMAPIClient, VMConfigBuilder
 from konverge.mixins import CommonVMMixin, ExecuteStagesMixin
 from konverge.utils import (
     VMAttributes,
@@ -72,8 +72,7 @@ class InstanceClone(CommonVMMixin, ExecuteStagesMixin):
     def generate_vmid_and_username(self, id_prefix, preinstall=True, external: set = None):
         start = int(f'{id_prefix}01')
         end = int(f'{id_prefix + 1}00')
-        vmids = [vm.get('vmid') for vm in self.client.get_cluster_vms(node=self.vm_attributes.node)]
-        allocated_ids = set(int(vmid) for vmid in vmids) if vmids else None
+        allocated_ids = set(self.client.get_vm_inventory().vmids)
         if external:
             [allocated_ids.add(item) for item in external]
 
@@ -106,12 +105,19 @@ class InstanceClone(CommonVMMixin, ExecuteStagesMixin):
             full=True,
             storage=self.vm_attributes.storage_type
         )
+        created = self.wait_for_task(created, operation='Clone')
         if not self.log_create_delete(created):
             return created
         self.add_ssh_config_entry()
         return created
 
-    def set_instance_resources(self):
+    def set_instance_resources(self, config: VMConfigBuilder = None):
+        if config:
+            return config.set(
+                memory=self.vm_attributes.memory,
+                balloon=self.vm_attributes.memory,
+                cores=self.vm_attributes.cpus
+            )
         return self.client.update_vm_config(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -120,7 +126,7 @@ class InstanceClone(CommonVMMixin, ExecuteStagesMixin):
             cores=self.vm_attributes.cpus
         )
 
-    def set_instance_disk_size(self):
+    def set_instance_disk_size(self, config: VMConfigBuilder = None):
         if self.vm_attributes.disk_size < self.template.vm_attributes.disk_size:
             logging.warning(
                 crayons.yellow(f'Warning: Requested disk size {self.vm_attributes.disk_size} is smaller than template size: {self.template.vm_attributes.disk_size}.') +
@@ -128,7 +134,7 @@ class InstanceClone(CommonVMMixin, ExecuteStagesMixin):
             )
             self.vm_attributes.disk_size = self.template.vm_attributes.disk_size
         if self.vm_attributes.disk_size != self.template.vm_attributes.disk_size:
-            self.resize_disk()
+            self.resize_disk(config=config)
 
     def disable_backups(self, drive_slot=0, all_drives=False):
         if not all_drives:
@@ -179,21 +185,28 @@ class InstanceClone(CommonVMMixin, ExecuteStagesMixin):
             return self.vmid
 
         print(crayons.cyan(f'Stage: Create VM: {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
-        logging.warning(crayons.yellow(self.create_vm()))
+        created = self.create_vm()
+        if not created:
+            raise RuntimeError(f'Clone of VM {self.vm_attributes.name} {self.vmid} failed')
+        logging.warning(crayons.yellow(created))
 
+        config = self.config_builder()
         print(crayons.cyan(f'Stage: Update resource values for VM: {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
-        logging.warning(crayons.yellow(self.set_instance_resources()))
+        self.set_instance_resources(config=config)
 
         print(crayons.cyan(f'Stage: Resize disk for VM: {self.vm_attributes.name} {self.vmid} to {self.vm_attributes.disk_size}'))
-        self.set_instance_disk_size()
-        self.inject_cloudinit_values()
-        self.attach_iface_to_vm() if self.secondary_iface else None
+        self.set_instance_disk_size(config=config)
+        self.inject_cloudinit_values(config=config)
+        self.attach_iface_to_vm(config=config) if self.secondary_iface else None
 
         if self.hotplug_disk_size:
             print(crayons.cyan(f'Enable hotplug for VM: {self.vm_attributes.name} {self.vmid}'))
-            self.enable_hotplug()
+            self.enable_hotplug(config=config)
             print(crayons.cyan(f'Stage: Attach hotplug disk {self.hotplug_disk_size}G to VM: {self.vm_attributes.name} {self.vmid}'))
-            self.attach_hotplug_drive(self.hotplug_disk_size)
+            self.attach_hotplug_drive(self.hotplug_disk_size, config=config)
+
+        print(crayons.cyan(f'Stage: Apply config for VM: {self.vm_attributes.name} {self.vmid}'))
+        logging.warning(crayons.yellow(config.apply()))
 
         if start:
             print(crayons.cyan(f'Start requested - Starting VM: {self.vm_attributes.name} {self.vmid}'))
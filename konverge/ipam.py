@@ -0,0 +1,220 @@
+"""
+Persistent IP allocation ledger, stored in the workspace next to .pve.yml.
+
+Each subnet keeps two bitmaps of its host suffixes:
+- observed: addresses found in use during the last reconciliation (config, arp-scan, cloudinit, loadbalancer range).
+- reserved: addresses handed out by konverge, until released.
+"""
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+
+import crayons
+
+
+LEDGER_FILENAME = '.ipam.json'
+RECONCILE_INTERVAL = 300
+RESERVATION_TTL = 3600
+
+
+class SubnetBitmap:
+    size = 256
+
+    def __init__(self, data: bytes = None):
+        self.bits = bytearray(data) if data else bytearray(self.size // 8)
+
+    @classmethod
+    def from_hex(cls, value):
+        return cls(bytes.fromhex(value)) if value else cls()
+
+    @classmethod
+    def from_suffixes(cls, suffixes):
+        bitmap = cls()
+        for suffix in suffixes:
+            bitmap.set(suffix)
+        return bitmap
+
+    def to_hex(self):
+        return self.bits.hex()
+
+    def is_set(self, suffix):
+        return bool(self.bits[suffix >> 3] & (1 << (suffix & 7)))
+
+    def set(self, suffix):
+        self.bits[suffix >> 3] |= 1 << (suffix & 7)
+
+    def clear(self, suffix):
+        self.bits[suffix >> 3] &= ~(1 << (suffix & 7)) & 0xff
+
+    def union(self, other: 'SubnetBitmap'):
+        return SubnetBitmap(bytes(left | right for left, right in zip(self.bits, other.bits)))
+
+    def first_free(self, start, end):
+        """
+        First unset suffix in range [start, end), or None. The end is exclusive, as in the original range scan.
+        """
+        for suffix in range(start, end):
+            if self.bits[suffix >> 3] == 0xff:
+                continue
+            if not self.is_set(suffix):
+                return suffix
+        return None
+
+
+def split_ip(ip):
+    """
+    Returns (network base, host suffix) of an IPv4 /24 address, or (None, None).
+    """
+    try:
+        network, suffix = str(ip).rsplit('.', 1)
+        suffix = int(suffix)
+    except (ValueError, AttributeError):
+        return None, None
+    if not 0 <= suffix < SubnetBitmap.size:
+        return None, None
+    return network, suffix
+
+
+class IPAllocationLedger:
+    def __init__(self, filename=LEDGER_FILENAME, reconcile_interval=RECONCILE_INTERVAL):
+        self.filename = filename
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Read-modify-write of the ledger file, guarded against threads and concurrent konverge processes.
+        """
+        with self._lock:
+            with open(f'{self.filename}.lock', mode='w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    state = self._read()
+                    yield state
+                    self._write(state)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, mode='r') as ledger_file:
+                return json.load(ledger_file)
+        except (OSError, ValueError) as read_error:
+            logging.warning(crayons.yellow(f'IP ledger {self.filename} unreadable, starting empty: {read_error}'))
+            return {}
+
+    def _write(self, state):
+        temporary = f'{self.filename}.tmp'
+        with open(temporary, mode='w') as ledger_file:
+            json.dump(state, ledger_file, indent=2, sort_keys=True)
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+        os.replace(temporary, self.filename)
+
+    @staticmethod
+    def _subnet(state, network):
+        return state.setdefault(network, {'observed': '', 'reserved': '', 'owners': {}, 'reconciled': 0})
+
+    def needs_reconcile(self, network):
+        with self._lock:
+            subnet = self._read().get(network)
+        if not subnet:
+            return True
+        return time.time() - subnet.get('reconciled', 0) > self.reconcile_interval
+
+    def reconcile(self, network, allocated):
+        """
+        Replace the observed bitmap of network with the allocated set.
+        Expired reservations, which never showed up as observed, are dropped.
+        """
+        suffixes = [suffix for net, suffix in map(split_ip, allocated) if net == network]
+        observed = SubnetBitmap.from_suffixes(suffixes)
+        now = time.time()
+        with self.transaction() as state:
+            subnet = self._subnet(state, network)
+            reserved = SubnetBitmap.from_hex(subnet.get('reserved'))
+            for ip, owner in list(subnet['owners'].items()):
+                _, suffix = split_ip(ip)
+                if not observed.is_set(suffix) and now - owner.get('reserved_at', 0) > RESERVATION_TTL:
+                    logging.warning(crayons.yellow(f'Drop expired IP reservation {ip} of {owner.get("owner")}'))
+                    reserved.clear(suffix)
+                    del subnet['owners'][ip]
+            subnet['observed'] = observed.to_hex()
+            subnet['reserved'] = reserved.to_hex()
+            subnet['reconciled'] = now
+        print(crayons.white(f'IP ledger reconciled for {network}.0/24: {len(suffixes)} allocated'))
+
+    def reconcile_if_stale(self, network, collect: callable):
+        """
+        Only one thread collects and reconciles, the others wait and reuse its result.
+        """
+        with self._lock:
+            if self.needs_reconcile(network):
+                self.reconcile(network, collect())
+
+    def reserve(self, network, start, end, owner='', exclude: set = None):
+        """
+        Atomically reserve the first free address of network in range [start, end).
+        """
+        with self.transaction() as state:
+            subnet = self._subnet(state, network)
+            reserved = SubnetBitmap.from_hex(subnet.get('reserved'))
+            taken = reserved.union(SubnetBitmap.from_hex(subnet.get('observed')))
+            if exclude:
+                for net, suffix in map(split_ip, exclude):
+                    if net == network:
+                        taken.set(suffix)
+            suffix = taken.first_free(start, end)
+            if suffix is None:
+                logging.error(crayons.red(f'Cannot create any more IP addresses in range: {network}.{start} - {network}.{end}'))
+                return None
+            reserved.set(suffix)
+            ip = f'{network}.{suffix}'
+            subnet['reserved'] = reserved.to_hex()
+            subnet['owners'][ip] = {'owner': owner, 'reserved_at': time.time()}
+        print(crayons.green(f'Generated IP: {ip}'))
+        return ip
+
+    def release(self, ip):
+        network, suffix = split_ip(ip)
+        if network is None:
+            return
+        with self.transaction() as state:
+            subnet = state.get(network)
+            if not subnet:
+                return
+            reserved = SubnetBitmap.from_hex(subnet.get('reserved'))
+            observed = SubnetBitmap.from_hex(subnet.get('observed'))
+            reserved.clear(suffix)
+            observed.clear(suffix)
+            subnet['reserved'] = reserved.to_hex()
+            subnet['observed'] = observed.to_hex()
+            subnet['owners'].pop(ip, None)
+        print(crayons.white(f'Released IP: {ip}'))
+
+    def release_owned(self, *owners):
+        """
+        Release every reservation held by owners, e.g. the addresses of a VM whose provisioning failed.
+        """
+        released = []
+        with self.transaction() as state:
+            for network, subnet in state.items():
+                reserved = SubnetBitmap.from_hex(subnet.get('reserved'))
+                for ip, reservation in list(subnet.get('owners', {}).items()):
+                    if reservation.get('owner') not in owners:
+                        continue
+                    _, suffix = split_ip(ip)
+                    reserved.clear(suffix)
+                    subnet['owners'].pop(ip)
+                    released.append(ip)
+                subnet['reserved'] = reserved.to_hex()
+        for ip in released:
+            print(crayons.white(f'Released IP: {ip}'))
+        return released
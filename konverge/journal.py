@@ -0,0 +1,163 @@
+"""
+Write-ahead run journal of cluster tasks, stored in the workspace under .konverge/state/<cluster>.jsonl.
+
+Each task appends a 'started' entry before it runs and a 'done' or 'failed' entry after it completes.
+Every append is fsynced, so after a crash the journal holds:
+- done tasks: skipped on rerun.
+- uncertain tasks, started without an outcome: verified against Proxmox or the cluster, before rerun.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from typing import NamedTuple, Any
+
+import crayons
+
+
+JOURNAL_DIRECTORY = os.path.join('.konverge', 'state')
+
+
+class JournalStatus:
+    started = 'started'
+    done = 'done'
+    failed = 'failed'
+
+
+class JournalEntry(NamedTuple):
+    task: str
+    status: str
+    timestamp: float
+    vmid: Any = None
+    ip: Any = None
+    data: Any = None
+
+    @classmethod
+    def from_line(cls, line):
+        entry = json.loads(line)
+        return cls(
+            task=entry['task'],
+            status=entry['status'],
+            timestamp=entry.get('timestamp', 0),
+            vmid=entry.get('vmid'),
+            ip=entry.get('ip'),
+            data=entry.get('data')
+        )
+
+    def to_line(self):
+        return json.dumps(self._asdict(), sort_keys=True, default=str)
+
+
+class RunJournal:
+    def __init__(self, cluster_name, workdir):
+        self.filename = os.path.join(workdir, JOURNAL_DIRECTORY, f'{cluster_name}.jsonl')
+        self._lock = threading.Lock()
+        self.entries = self.replay()
+
+    def replay(self):
+        """
+        Returns {task: last JournalEntry}. A torn last line, from a crash mid-write, is truncated.
+        """
+        entries = {}
+        if not os.path.exists(self.filename):
+            return entries
+        with open(self.filename, mode='rb+') as journal_file:
+            content = journal_file.read()
+            complete = content.rfind(b'\n') + 1
+            if complete < len(content):
+                logging.warning(crayons.yellow(f'Truncate torn last line of journal {self.filename}'))
+                journal_file.truncate(complete)
+            for number, line in enumerate(content[:complete].decode().splitlines(), start=1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = JournalEntry.from_line(line)
+                except (ValueError, KeyError) as entry_error:
+                    logging.warning(crayons.yellow(f'Skip unreadable journal line {number} of {self.filename}: {entry_error}'))
+                    continue
+                entries[entry.task] = entry
+        if entries:
+            done = len([entry for entry in entries.values() if entry.status == JournalStatus.done])
+            print(crayons.white(f'Journal {self.filename}: {done} of {len(entries)} tasks done'))
+        return entries
+
+    def _append(self, entry: JournalEntry):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, mode='a') as journal_file:
+                journal_file.write(entry.to_line() + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.entries[entry.task] = entry
+        return entry
+
+    def begin(self, task, vmid=None, ip=None, data=None):
+        return self._append(
+            JournalEntry(task=task, status=JournalStatus.started, timestamp=time.time(), vmid=vmid, ip=ip, data=data)
+        )
+
+    def complete(self, task, vmid=None, ip=None, data=None):
+        return self._append(
+            JournalEntry(task=task, status=JournalStatus.done, timestamp=time.time(), vmid=vmid, ip=ip, data=data)
+        )
+
+    def fail(self, task, error=None, vmid=None, ip=None):
+        return self._append(
+            JournalEntry(task=task, status=JournalStatus.failed, timestamp=time.time(), vmid=vmid, ip=ip, data=error)
+        )
+
+    def get(self, task):
+        with self._lock:
+            return self.entries.get(task)
+
+    def done(self, task):
+        entry = self.get(task)
+        return bool(entry) and entry.status == JournalStatus.done
+
+    def completed(self, prefix):
+        """
+        Done tasks of prefix: {task name without prefix: JournalEntry}.
+        """
+        with self._lock:
+            return {
+                task[len(prefix):]: entry
+                for task, entry in self.entries.items()
+                if task.startswith(prefix) and entry.status == JournalStatus.done
+            }
+
+    def uncertain(self):
+        """
+        Tasks started, without a recorded outcome.
+        """
+        with self._lock:
+            return [entry for entry in self.entries.values() if entry.status == JournalStatus.started]
+
+    def verify(self, verifiers: dict):
+        """
+        Resolve uncertain tasks with verifiers: {task prefix: callable(entry) -> bool}.
+        Verified tasks are recorded done, the rest failed, so they run again.
+        """
+        for entry in self.uncertain():
+            verifier = next(
+                (function for prefix, function in verifiers.items() if entry.task.startswith(prefix)),
+                None
+            )
+            try:
+                verified = verifier(entry) if verifier else False
+            except Exception as verify_error:
+                logging.warning(crayons.yellow(f'Cannot verify journal task {entry.task}: {verify_error}'))
+                verified = False
+            if verified:
+                print(crayons.green(f'Journal task {entry.task} verified complete'))
+                self.complete(entry.task, vmid=entry.vmid, ip=entry.ip, data=entry.data)
+            else:
+                logging.warning(crayons.yellow(f'Journal task {entry.task} not verified. It will run again.'))
+                self.fail(entry.task, error='Interrupted', vmid=entry.vmid, ip=entry.ip)
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+                print(crayons.white(f'Journal {self.filename} removed'))
+            self.entries = {}
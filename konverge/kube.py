@@ -1,14 +1,27 @@
 import os
+import json
 import time
 import uuid
 import yaml
 
 import invoke
+from urllib.parse import urlparse
 from typing import NamedTuple, TYPE_CHECKING
 from fabric2 import Result
 
 from konverge.instance import logging, crayons, InstanceClone, FabricWrapper
 from konverge.utils import LOCAL, semver_has_patch_suffix
+from konverge.kubeapi import (
+    kube_api_clients,
+    ReadinessIndex,
+    pod_ready,
+    apiserver_ready,
+    KUBE_READY_TIMEOUT,
+    KUBE_WATCH_TIMEOUT,
+    APISERVER_READY_TIMEOUT
+)
+from konverge.readiness import poll_until
+from konverge.transfer import send_files, read_remote
 from konverge.settings import BASE_PATH, WORKDIR, CNI, KUBE_DASHBOARD_URL, pve_cluster_config_client, vm_client
 
 # Avoid cyclic import
@@ -52,6 +65,7 @@ class KubeProvisioner:
         self.control_plane = control_plane
         self.remote_path = remote_path
         self.dashboard_user = os.path.join(remote_path, 'dashboard-adminuser.yaml')
+        self.certificate_key = None
 
     @staticmethod
     def kube_provisioner_factory(os_type='ubuntu'):
@@ -99,8 +113,8 @@ class KubeProvisioner:
         except Exception as notready:
             logging.warning(crayons.yellow(notready))
             logging.warning(crayons.yellow(f'Retry connection on {self.instance.vm_attributes.name}'))
-            self.instance.self_node = FabricWrapper(host=self.instance.vm_attributes.name)
-            self.instance.self_node_sudo = FabricWrapper(host=self.instance.vm_attributes.name, sudo=True)
+            # Sudo and non-sudo wrappers share the pooled connection.
+            self.instance.self_node.reset()
             return False
 
     def install_kube(
@@ -110,7 +124,7 @@ class KubeProvisioner:
             docker_ce=False,
             storageos_requirements=False
     ):
-        self.instance.install_kube(
+        return self.instance.install_kube(
             filename=self.instance.template.filename,
             kubernetes_version=kubernetes_version,
             docker_version=docker_version,
@@ -121,10 +135,31 @@ class KubeProvisioner:
     def check_install_prerequisites(self):
         raise NotImplementedError
 
+    def get_missing_packages(self, packages: tuple):
+        """
+        Probe all package commands in a single remote call.
+        """
+        commands = ' '.join(package.command for package in packages)
+        output = self.instance.self_node.execute(
+            f'for c in {commands}; do command -v $c >/dev/null 2>&1 || echo $c; done',
+            hide=True
+        ).stdout.split()
+        missing = [package for package in packages if package.command in output]
+        for package in missing:
+            logging.warning(crayons.yellow(f'Package: {package.package} not found.'))
+        return missing
+
+    @property
+    def local_workdir(self):
+        """
+        Per-host bootstrap directory, so that concurrent installs do not overwrite each other's files.
+        """
+        return os.path.join(WORKDIR, '.bootstrap', self.instance.vm_attributes.name)
+
     def generate_keepalived_healthcheck(self, virtual_ip):
         local = LOCAL
         script_file = 'check_apiserver.sh'
-        local_workdir = os.path.join(WORKDIR, '.bootstrap')
+        local_workdir = self.local_workdir
         local_script_path = os.path.join(local_workdir, script_file)
         local.run(f'mkdir -p {local_workdir}')
 
@@ -150,7 +185,7 @@ class KubeProvisioner:
     def generate_keepalived_config(self, virtual_ip, interface, state, priority):
         local = LOCAL
         config_file = 'keepalived.conf'
-        local_workdir = os.path.join(WORKDIR, '.bootstrap')
+        local_workdir = self.local_workdir
         local_config_path = os.path.join(local_workdir, config_file)
         local.run(f'mkdir -p {local_workdir}')
 
@@ -200,7 +235,7 @@ class KubeProvisioner:
 
     def get_control_plane_virtual_ip(self):
         if not self.control_plane.apiserver_ip:
-            self.control_plane.apiserver_ip = self.instance.generate_allowed_ip()
+            self.control_plane.apiserver_ip = self.instance.generate_allowed_ip(owner='apiserver-vip')
         return self.control_plane.apiserver_ip
 
     def install_control_plane_loadbalancer(self, is_leader=False):
@@ -208,7 +243,6 @@ class KubeProvisioner:
             logging.warning(crayons.yellow('Skip install keepalived. Control Plane not Deployed in High Available Mode.'))
             return None
 
-        local = LOCAL
         host = self.instance.vm_attributes.name
 
         remote_path = '/etc/keepalived'
@@ -230,15 +264,19 @@ class KubeProvisioner:
             return None
 
         print(crayons.cyan(f'Sending config files to {host}'))
-        sent1 = local.run(f'scp {local_config_path} {host}:~')
-        sent2 = local.run(f'scp {local_script_path} {host}:~')
+        sent = send_files(
+            self.instance.self_node_sudo,
+            {
+                local_config_path: f'{remote_path}/{config_file}',
+                local_script_path: f'{remote_path}/{script_file}'
+            }
+        )
 
-        if sent1.ok and sent2.ok:
+        if sent:
             self.wait_pkg_lock()
             print(crayons.blue(f'Installing keepalived service on {host}'))
 
             self.check_install_prerequisites()
-            self.instance.self_node.execute(f'sudo mv {config_file} {remote_path} && sudo mv {script_file} {remote_path}')
             self.instance.self_node_sudo.execute(f'chmod 0666 {remote_path}/{config_file}')
 
             restart = self.instance.self_node_sudo.execute(f'systemctl restart keepalived')
@@ -254,13 +292,17 @@ class KubeProvisioner:
         raise NotImplementedError
 
     def bootstrap_control_plane(self, version='1.16'):
+        """
+        Returns True if the control plane is up. For HA, the uploaded certificate key is kept in certificate_key.
+        """
+        self.certificate_key = None
         cni_definitions = self.supported_cnis(networking=self.control_plane.networking)
 
         print(crayons.cyan(f'Building K8s Control-Plane using High Availability: {self.control_plane.ha_masters}'))
         if self.control_plane.ha_masters:
             if not self.control_plane.apiserver_ip:
                 logging.warning(crayons.yellow(f'API Server IP must be provided for HA Control Plane option'))
-                return None
+                return False
 
         print(crayons.cyan(f'Getting Container Networking Definitions for CNI: {self.control_plane.networking}'))
         self.instance.self_node_sudo.execute(f'mkdir -p {self.remote_path}')
@@ -290,20 +332,49 @@ class KubeProvisioner:
         if deployed.failed:
             logging.error(crayons.red(f'Master {self.instance.vm_attributes.name} initialization was not performed correctly.'))
             self.rollback_node()
-            return None
+            return False
 
         print(crayons.green('Initial master deployment success.'))
-        time.sleep(60)
+        if not self.wait_for_apiserver():
+            return False
         self.post_install_steps()
         if not self.deploy_container_networking(cni_definitions):
             logging.error(crayons.red(f'Container networking {self.control_plane.networking} failed to deploy correctly.'))
-            return None
+            return False
 
         master_executor = KubeExecutor(wrapper=self.instance.self_node)
         master_executor.wait_for_running_system_status(namespace='kube-system', remote=True)
         if self.control_plane.ha_masters:
-            return self.get_certificate_key(deployed)
-        return None
+            self.certificate_key = self.get_certificate_key(deployed)
+            if not self.certificate_key:
+                logging.error(crayons.red(f'No certificate key in kubeadm init output of {self.instance.vm_attributes.name}.'))
+                return False
+        return True
+
+    def wait_for_apiserver(self, timeout=APISERVER_READY_TIMEOUT):
+        """
+        Probe API server /readyz on the control plane virtual ip for HA, on the leader ip otherwise.
+        Instances without a known ip are probed from the leader itself, over SSH.
+        """
+        port = self.control_plane.apiserver_port
+        host = self.control_plane.apiserver_ip if self.control_plane.ha_masters else self.instance.allowed_ip
+
+        def remote_probe():
+            readyz = self.instance.self_node.execute(
+                f'curl -sk --max-time 5 https://localhost:{port}/readyz',
+                warn=True,
+                hide=True
+            )
+            return bool(readyz) and readyz.stdout.strip() == 'ok'
+
+        probe = (lambda: apiserver_ready(host, port)) if host else remote_probe
+        print(crayons.cyan(f'Wait for API server {host or self.instance.vm_attributes.name}:{port} to become ready'))
+        ready = poll_until(probe, deadline=timeout, max_interval=5)
+        if ready:
+            print(crayons.green('API server ready.'))
+        else:
+            logging.error(crayons.red(f'API server not ready within {timeout} seconds.'))
+        return ready
 
     def rollback_node(self):
         logging.warning(crayons.yellow(f'Performing Node {self.instance.vm_attributes.name} Rollback.'))
@@ -315,7 +386,7 @@ class KubeProvisioner:
             print(crayons.green('Rollback completed.'))
         else:
             logging.error(crayons.red('Rollback failed'))
-            return
+            return False
         if config_reset.ok:
             print(crayons.green('Config removed.'))
         else:
@@ -324,7 +395,8 @@ class KubeProvisioner:
             print(crayons.green('IPTables reset completed.'))
         else:
             logging.error(crayons.red('IPTables reset failed.'))
-            return
+            return False
+        return True
 
     def post_install_steps(self):
         print(crayons.cyan('Post-Install steps'))
@@ -379,30 +451,36 @@ class KubeProvisioner:
             f'kubeadm join {join_url} --token {join_token} --discovery-token-ca-cert-hash sha256:{cert_hash}'
         )
 
-    def join_node(self, leader: InstanceClone, control_plane_node=False, certificate_key=''):
-        leader_provisioner = KubeProvisioner.kube_provisioner_factory(os_type=leader.vm_attributes.os_type)(
-            instance=leader,
-            control_plane=self.control_plane,
-            remote_path=self.remote_path
-        )
-        if not certificate_key or not leader.allowed_ip:
-            join_command = leader_provisioner.get_join_token_v2(control_plane_node)
-        else:
-            join_command = leader_provisioner.get_join_token(control_plane_node, certificate_key)
+    def join_node(self, leader: InstanceClone, control_plane_node=False, certificate_key='', join_command=None):
+        """
+        join_command: Reuse a join command generated once on the leader, instead of minting a token per node.
+        Returns True if the node joined. Failed joins are rolled back.
+        """
+        if not join_command:
+            leader_provisioner = KubeProvisioner.kube_provisioner_factory(os_type=leader.vm_attributes.os_type)(
+                instance=leader,
+                control_plane=self.control_plane,
+                remote_path=self.remote_path
+            )
+            if not certificate_key or not leader.allowed_ip:
+                join_command = leader_provisioner.get_join_token_v2(control_plane_node)
+            else:
+                join_command = leader_provisioner.get_join_token(control_plane_node, certificate_key)
         if not join_command:
             logging.error(crayons.red('Node Join command not generated. Abort.'))
-            return
+            return False
         print(crayons.white(f'Join command: {join_command}'))
         print(crayons.cyan(f'Joining Node: {self.instance.vm_attributes.name} to the cluster'))
-        join = self.instance.self_node_sudo.execute(join_command)
+        join = self.instance.self_node_sudo.execute(join_command, warn=True)
         if join.failed:
             logging.error(crayons.red(f'Joining Node: {self.instance.vm_attributes.name} failed. Performing Rollback.'))
             self.rollback_node()
-            return
+            return False
 
         if control_plane_node:
             self.post_install_steps()
         print(crayons.green(f'Node: {self.instance.vm_attributes.name} has joined the cluster.'))
+        return True
 
 
 class UbuntuKubeProvisioner(KubeProvisioner):
@@ -413,20 +491,18 @@ class UbuntuKubeProvisioner(KubeProvisioner):
         ip = LinuxPackage(command='ip', package='iproute2')
         curl = LinuxPackage(command='curl', package='curl')
 
-        for package in (wget, nc, ip, curl, keepalived):
-            package_exists = self.instance.self_node.execute(f'command {package.command} -h; echo $?', hide=True)
-            exit_code = package_exists.stdout.split()[-1].strip()
-            if exit_code != '0':
-                logging.warning(crayons.yellow(f'Package: {package.package} not found.'))
-                print(crayons.cyan(f'Installing {package.package}'))
-                self.instance.self_node_sudo.execute(f'apt-get install -y {package.package}')
-
-    def wait_pkg_lock(self):
-        exit_code = False
-        while not exit_code:
-            exit_code = self.instance.self_node_sudo.execute('apt-get update', warn=True).ok
-            print(crayons.white('Waiting 10 secs to acquire dpkg lock.'))
-            time.sleep(10)
+        missing = self.get_missing_packages((wget, nc, ip, curl, keepalived))
+        if missing:
+            packages = ' '.join(package.package for package in missing)
+            print(crayons.cyan(f'Installing {packages}'))
+            self.instance.self_node_sudo.execute(f'apt-get install -y {packages}')
+
+    def wait_pkg_lock(self, max_interval=10):
+        interval = 1
+        while not self.instance.self_node_sudo.execute('apt-get update', warn=True).ok:
+            print(crayons.white(f'Waiting {interval} secs to acquire dpkg lock.'))
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
         print(crayons.green('Dpkg lock released.'))
 
 
@@ -438,13 +514,11 @@ class CentosKubeProvisioner(KubeProvisioner):
         ip = LinuxPackage(command='ip', package='iproute2')
         curl = LinuxPackage(command='curl', package='curl')
 
-        for package in (wget, nc, ip, curl, keepalived):
-            package_exists = self.instance.self_node.execute(f'command {package.command} -h; echo $?', hide=True)
-            exit_code = package_exists.stdout.split()[-1].strip()
-            if exit_code != '0':
-                logging.warning(crayons.yellow(f'Package: {package.package} not found.'))
-                print(crayons.cyan(f'Installing {package.package}'))
-                self.instance.self_node_sudo.execute(f'yum install -y {package.package}')
+        missing = self.get_missing_packages((wget, nc, ip, curl, keepalived))
+        if missing:
+            packages = ' '.join(package.package for package in missing)
+            print(crayons.cyan(f'Installing {packages}'))
+            self.instance.self_node_sudo.execute(f'yum install -y {packages}')
 
     def wait_pkg_lock(self):
         pass
@@ -457,9 +531,14 @@ class KubeConfig:
         custom_cluster_name=None,
         custom_context=None,
         custom_user_name=None,
-        set_current_context=True
+        set_current_context=True,
+        content: str = None
     ):
+        """
+        content: Kubeconfig already read into memory, e.g. from a remote host. config_filename then only names its origin.
+        """
         self.config_filename = config_filename
+        self.content = content
         self.custom_cluster_name = custom_cluster_name
         self.custom_context = custom_context
         self.custom_user_name = custom_user_name
@@ -495,6 +574,14 @@ class KubeConfig:
         return self.config_yaml.get('current-context')
 
     def serialize_config(self):
+        if self.content is not None:
+            try:
+                return yaml.safe_load(self.content)
+            except yaml.YAMLError as yaml_error:
+                print(crayons.red(f'Error: failed to load from {self.config_filename}'))
+                print(crayons.red(f'{yaml_error}'))
+                return None
+
         with open(self.config_filename, mode='r') as local_dump_file:
             try:
                 return yaml.safe_load(local_dump_file)
@@ -587,18 +674,39 @@ class KubeConfig:
 
 
 class KubeExecutor:
-    def __init__(self, wrapper: FabricWrapper = None):
+    def __init__(self, wrapper: FabricWrapper = None, context=None):
+        """
+        context: kubeconfig context of the cluster. API calls default to it, instead of the current-context.
+        """
         self.wrapper = wrapper
+        self.context = context
         self.local = LOCAL
         self.dashboard_user = os.path.join(BASE_PATH, 'dashboard-adminuser.yaml')
-        self.host = self.wrapper.connection.original_host if self.wrapper else None
+        self.host = self.wrapper.host if self.wrapper else None
         self.home = os.path.expanduser('~')
+        self.kube_config = os.path.join(self.home, '.kube', 'config')
         self.remote = self.wrapper.execute('echo $HOME', hide=True).stdout.strip() if self.wrapper else None
 
+    def api(self, context=None):
+        """
+        Kubernetes API client of the local kubeconfig context: the executor context, or current-context if it has none.
+        None if not configured.
+        """
+        return kube_api_clients.get(config_filename=self.kube_config, context=context or self.context)
+
+    def use_context(self, context):
+        """
+        Switch to the cluster context, for API calls and for the local kubectl and helm commands.
+        """
+        if not context:
+            return
+        self.context = context
+        self.local.run(f'HOME={self.home} kubectl config use-context {context}', hide=True, warn=True)
+
     def remove_cluster_node(self, instance: InstanceClone):
         print(crayons.cyan(f'Removing node {instance.vm_attributes.name}'))
-        remove = self.local.run(f'HOME={self.home} kubectl delete node {instance.vm_attributes.name}', warn=True)
-        if remove.ok:
+        api = self.api()
+        if api and api.delete_node(instance.vm_attributes.name):
             print(crayons.green(f'Node {instance.vm_attributes.name} removed from cluster.'))
         else:
             logging.warning(crayons.yellow(f'Node {instance.vm_attributes.name} was not found or not removed from cluster.'))
@@ -626,21 +734,19 @@ class KubeExecutor:
         remote_kube = os.path.join(self.remote, '.kube')
         local_config_base = os.path.join(local_kube, 'config')
         remote_config_base = os.path.join(remote_kube, 'config')
-        local_dump_folder = os.path.join(WORKDIR, 'dump')
-        local_dump = os.path.join(local_dump_folder, self.host, 'config.yaml')
-
-        self.local.run(f'mkdir -p {local_dump_folder} && mkdir -p {os.path.join(local_dump_folder, self.host)}')
-        self.local.run(f'scp {self.host}:{remote_config_base} {local_dump}')
 
         remote_kube_config = KubeConfig(
-            config_filename=local_dump,
+            config_filename=f'{self.host}:{remote_config_base}',
             custom_cluster_name=custom_cluster_name,
             custom_context=custom_context,
             custom_user_name=custom_user_name,
-            set_current_context=set_current_context
+            set_current_context=set_current_context,
+            content=read_remote(self.wrapper, remote_config_base)
         )
-        remote_config_yaml = remote_kube_config.serialize_config()
-        self.local.run(f'rm -rf {local_dump_folder}')
+        remote_config_yaml = remote_kube_config.config_yaml
+        if not remote_config_yaml:
+            logging.error(crayons.red(f'Abort: no kubeconfig read from {self.host}:{remote_config_base}'))
+            return
 
         current_context = remote_kube_config.current_context
         print(crayons.cyan('Current Context: ') + f'{current_context}')
@@ -725,6 +831,7 @@ class KubeExecutor:
             print(crayons.blue(f'Performing rollback of {local_config_base}'))
             self.local.run(f'mv {local_config_base}.bak {local_config_base}')
             print(crayons.green('Rollback complete'))
+        kube_api_clients.invalidate()
 
     # Use str type annotation for cluster, to avoid cyclic import.
     def unset_local_cluster_config(self, cluster: 'ClusterAttributesSerializer'):
@@ -738,6 +845,7 @@ class KubeExecutor:
         self.local.run(f'HOME={self.home} kubectl config delete-cluster {cluster_name}')
         self.local.run(f'HOME={self.home} kubectl config delete-context {context}')
         self.local.run(f'HOME={self.home} kubectl config unset users.{user}')
+        kube_api_clients.invalidate()
 
     def cluster_exists(self, cluster: 'ClusterAttributesSerializer'):
         local_kube = os.path.join(self.home, '.kube')
@@ -753,74 +861,139 @@ class KubeExecutor:
     def is_cluster_reachable(self, cluster: 'ClusterAttributesSerializer'):
         if not self.cluster_exists(cluster):
             return False
-        exit_code = self.local.run(f'HOME={self.home} kubectl cluster-info; echo $?', hide=True)
-        exit_code = exit_code.stdout.split()[-1].strip()
-        return exit_code == '0'
+        api = self.api(context=cluster.cluster.context)
+        return bool(api) and api.is_reachable()
 
     def get_control_plane_virtual_ip(self, cluster: 'ClusterAttributesSerializer'):
         if not self.is_cluster_reachable(cluster):
             return None
-        context = cluster.cluster.context
-        self.local.run(f'HOME={self.home} kubectl config use-context {context}')
-        cluster_info = self.local.run(f'HOME={self.home} kubectl cluster-info | head -n 1').stdout.strip()
-        if 'is running at ' in cluster_info:
-            return cluster_info.split('https://')[-1].split(':')[0]
+        self.use_context(cluster.cluster.context)
+        return urlparse(self.api().server).hostname
 
     def get_node_names(self, cluster: 'ClusterAttributesSerializer'):
         if not self.is_cluster_reachable(cluster):
             return []
-        context = cluster.cluster.context
-        self.local.run(f'HOME={self.home} kubectl config use-context {context}')
-        nodes = self.local.run(f'HOME={self.home} kubectl get nodes -o jsonpath=\'{{.items[*].metadata.name}}\'', hide=True).stdout.strip()
-        return nodes.split()
-
-    def wait_for_running_system_status(self, namespace='kube-system', remote=False, poll_interval=1):
-        runner = LOCAL.run if not remote else self.wrapper.execute
-        prepend = f'HOME={self.home} ' if not remote else ''
-
-        awk_table_1 = 'awk \'{print $1}\''
-        awk_table_2 = 'awk \'{print $2}\''
-        non_running_command = f'kubectl get pods -n {namespace} --field-selector=status.phase!=Running'
-        running_command = f'kubectl get pods -n {namespace} --field-selector=status.phase=Running | {awk_table_1}'
-        running_command_current_desired = f'kubectl get pods -n {namespace} --field-selector=status.phase=Running | {awk_table_2}'
-
-        pods_not_ready = 'initial'
-        while pods_not_ready:
-            print(crayons.white(f'Wait for all {namespace} pods to enter "Running" phase'))
-            pods_not_ready = runner(command=f'{prepend}{non_running_command}').stdout.strip()
-            time.sleep(poll_interval)
-        print(crayons.green(f'All {namespace} pods entered "Running" phase.'))
-
-        all_complete = False
-        while not all_complete:
-            print(crayons.white(f'Wait for all {namespace} pods to reach "Desired" state'))
-            names_table = runner(command=f'{prepend}{running_command}', hide=True).stdout.strip()
-            current_to_desired_table = runner(command=f'{prepend}{running_command_current_desired}', hide=True).stdout.strip()
-            clean_table = current_to_desired_table.split()[1:]
-            names = names_table.split()[1:]
-            complete_table = []
-            state_table = [
-                {
-                    'name': names[clean_table.index(entry)],
-                    'current': int(entry.split('/')[0]),
-                    'desired': int(entry.split('/')[1]),
-                    'complete': False
-                }
-                for entry in clean_table
-            ]
-            for state_entry in state_table:
-                complete = state_entry.get('current') == state_entry.get('desired')
-                state_entry['complete'] = complete
-                complete_table.append(complete)
-                print(
-                    crayons.white(f'Name: {state_entry.get("name")} Complete: ') + (
-                        crayons.green(f'{complete}') if complete else crayons.red(f'{complete}')
-                    )
-                )
-
-            all_complete = all(complete_table)
-            time.sleep(poll_interval)
-        print(crayons.green(f'All {namespace} pods reached "Desired" state.'))
+        self.use_context(cluster.cluster.context)
+        return self.api().get_node_names()
+
+    def wait_for_running_system_status(self, namespace='kube-system', remote=False, poll_interval=1, timeout=KUBE_READY_TIMEOUT):
+        """
+        Wait until every pod of namespace is Running with all containers ready, and every node is Ready.
+        remote: Query the leader over SSH, before the local kubeconfig exists.
+        Returns False if the desired state is not reached within timeout seconds.
+        """
+        print(crayons.white(f'Wait for all {namespace} pods to enter "Running" phase and reach "Desired" state'))
+        ready = self._poll_ready_remote(
+            namespace, poll_interval=poll_interval, timeout=timeout
+        ) if remote else self._watch_ready(namespace, timeout=timeout)
+        if ready:
+            print(crayons.green(f'All {namespace} pods reached "Desired" state.'))
+        else:
+            logging.error(crayons.red(f'{namespace} pods did not reach "Desired" state within {timeout} seconds.'))
+        return ready
+
+    @staticmethod
+    def _print_pending(index: ReadinessIndex):
+        for pending in index.pending():
+            print(crayons.white(f'Name: {pending} Complete: ') + crayons.red('False'))
+
+    def _poll_ready_remote(self, namespace, poll_interval=1, timeout=KUBE_READY_TIMEOUT):
+        """
+        One kubectl JSON query per poll for nodes and pods, with backoff.
+        """
+        index = ReadinessIndex()
+
+        def probe():
+            listed = self.wrapper.execute(f'kubectl get nodes,pods -n {namespace} -o json', warn=True, hide=True)
+            if not listed or not listed.ok:
+                return False
+            try:
+                index.replace_list(json.loads(listed.stdout).get('items', []))
+            except ValueError:
+                return False
+            self._print_pending(index)
+            return index.ready
+
+        return poll_until(probe, deadline=timeout, initial_interval=poll_interval, max_interval=10)
+
+    def _watch_ready(self, namespace, timeout=KUBE_READY_TIMEOUT):
+        """
+        List pods and nodes, then watch pods (or nodes, once pods are ready) until the index is ready.
+        The watch is relisted when the stream closes or its resourceVersion expires.
+        """
+        api = self.api()
+        if not api:
+            logging.error(crayons.red(f'No Kubernetes API client for {self.kube_config}'))
+            return False
+        index = ReadinessIndex()
+        paths = {'Pod': f'/api/v1/namespaces/{namespace}/pods', 'Node': '/api/v1/nodes'}
+        expires = time.monotonic() + timeout
+        interval = 1
+        while time.monotonic() < expires:
+            pods, pods_version = api.list_resource(paths['Pod'])
+            nodes, nodes_version = api.list_resource(paths['Node'])
+            if pods is None or nodes is None:
+                time.sleep(min(interval, max(0, expires - time.monotonic())))
+                interval = min(interval * 2, 10)
+                continue
+            index.replace('Pod', pods)
+            index.replace('Node', nodes)
+            if index.ready:
+                return True
+            self._print_pending(index)
+
+            kind = 'Node' if pods and not [pod for pod in index.pods.values() if not pod_ready(pod)] else 'Pod'
+            remaining = int(expires - time.monotonic())
+            if remaining <= 0:
+                break
+            for event_type, item in api.watch(
+                    paths[kind],
+                    pods_version if kind == 'Pod' else nodes_version,
+                    timeout_seconds=min(KUBE_WATCH_TIMEOUT, max(1, remaining))
+            ):
+                index.apply(event_type, item, kind=kind)
+                if index.ready:
+                    return True
+        return False
+
+    def wait_for_namespace(self, name, local=True, timeout=APISERVER_READY_TIMEOUT):
+        if local:
+            api = self.api()
+            probe = lambda: bool(api) and api.namespace_active(name)
+        else:
+            def probe():
+                phase = self.wrapper.execute(f'kubectl get namespace {name} -o jsonpath={{.status.phase}}', warn=True, hide=True)
+                return bool(phase) and phase.stdout.strip() == 'Active'
+        ready = poll_until(probe, deadline=timeout, max_interval=5)
+        if not ready:
+            logging.error(crayons.red(f'Namespace {name} not active within {timeout} seconds.'))
+        return ready
+
+    def wait_for_pods(self, namespace=None, label_selector=None, timeout=KUBE_READY_TIMEOUT):
+        """
+        Wait until at least one pod matches label_selector, and all matching pods are ready.
+        """
+        api = self.api()
+
+        def probe():
+            pods = api.list_pods(namespace=namespace, label_selector=label_selector) if api else None
+            return bool(pods) and all(pod_ready(pod) for pod in pods)
+
+        ready = poll_until(probe, deadline=timeout, max_interval=10)
+        if not ready:
+            logging.error(crayons.red(f'Pods {label_selector} not ready within {timeout} seconds.'))
+        return ready
+
+    def wait_for_nodes_removed(self, names: list, timeout=APISERVER_READY_TIMEOUT):
+        api = self.api()
+        removed = poll_until(
+            lambda: bool(api) and not set(names) & set(api.get_node_names()),
+            deadline=timeout,
+            max_interval=5
+        )
+        if not removed:
+            logging.warning(crayons.yellow(f'Nodes still registered after {timeout} seconds: {", ".join(names)}'))
+        return removed
 
     def deploy_dashboard(self, remote_path='/opt/kube', local=True):
         """
@@ -828,6 +1001,7 @@ class KubeExecutor:
         """
         prepend = f'HOME={self.home} ' if local else ''
         run = self.local.run if local else self.wrapper.execute
+        self.use_context(self.context) if local else None
         bootstrap_path = os.path.join(BASE_PATH, 'bootstrap') if local else os.path.join(remote_path, 'bootstrap')
         user_creation = f'{bootstrap_path}/dashboard-adminuser.yaml'
 
@@ -836,7 +1010,9 @@ class KubeExecutor:
         if dashboard.ok:
             print(crayons.green(f'Kubernetes Dashboard deployed successfully.'))
             print(crayons.cyan('Deploying User admin-user with role-binding: cluster-admin'))
-            time.sleep(30)
+            if not self.wait_for_namespace('kubernetes-dashboard', local=local):
+                logging.error(crayons.red('User admin-user was not created correctly.'))
+                return
 
             user_role = run(command=f'{prepend}kubectl apply -f {user_creation}')
             if user_role.ok:
@@ -849,6 +1025,7 @@ class KubeExecutor:
     def get_dashboard_token(self, user='admin-user', local=True):
         prepend = f'HOME={self.home} ' if local else ''
         run = self.local.run if local else self.wrapper.execute
+        self.use_context(self.context) if local else None
         awk_routine = "'{print $1}'"
         command = f"{prepend}kubectl -n kubernetes-dashboard describe secret $({prepend}kubectl -n kubernetes-dashboard get secret | grep {user} | awk {awk_routine})"
         print(crayons.white(command))
@@ -856,18 +1033,18 @@ class KubeExecutor:
         return token.stdout.strip() if token.ok else None
 
     def apply_label_node(self, role, instance_name):
-        prepend = f'HOME={self.home}'
-        label_node = f'node-role.kubernetes.io/{role}='
-        labeled = self.local.run(f'{prepend} kubectl label nodes {instance_name} {label_node}', warn=True)
-        if labeled.ok:
-            print(crayons.green(f'Added label {label_node} to {instance_name}'))
+        label_node = f'node-role.kubernetes.io/{role}'
+        api = self.api()
+        if api and api.label_node(instance_name, {label_node: ''}):
+            print(crayons.green(f'Added label {label_node}= to {instance_name}'))
         else:
-            logging.warning(crayons.yellow(f'Label {label_node} already exists on {instance_name}'))
+            logging.warning(crayons.yellow(f'Label {label_node}= not applied to {instance_name}'))
 
     def helm_install_v2(self, patch=True, helm=True, tiller=True):
         prepend = f'HOME={self.home}'
         helm_script = 'https://git.io/get_helm.sh'
 
+        self.use_context(self.context)
         current_context = self.get_current_context()
         if not current_context:
             return
@@ -896,14 +1073,11 @@ class KubeExecutor:
                     print(crayons.green('Rollback completed'))
                 return
 
-            tiller_ready = ''
-            while not tiller_ready:
-                print(crayons.white('Ping for tiller ready'))
-                tiller_ready = self.local.run(f'{prepend} kubectl get pod --namespace kube-system -l app=helm,name=tiller --field-selector=status.phase=Running').stdout.strip()
-                time.sleep(1)
+            print(crayons.white('Ping for tiller ready'))
+            if not self.wait_for_pods(namespace='kube-system', label_selector='app=helm,name=tiller'):
+                return
             print(crayons.green(f'Helm initialized with Tiller for context: {current_context}'))
             self.wait_for_running_system_status()
-            time.sleep(10)
             print(crayons.magenta('You might need to run "helm init --client-only to initialize repos"'))
             self.local.run(f'{prepend} helm init --client-only')
 
@@ -983,6 +1157,7 @@ class KubeExecutor:
             return
 
         print(crayons.cyan(f'Deploying MetalLB'))
+        self.use_context(self.context)
         metal_install = self.local.run(f'{prepend} helm install --name metallb -f {file} stable/metallb --version={version}')
         if metal_install.failed:
             logging.error(crayons.red('MetalLB installation failed.Rolling Back'))
@@ -991,6 +1166,7 @@ class KubeExecutor:
                 print(crayons.green('Rollback completed'))
                 return
         print(crayons.green('MetalLB installed'))
+        self.wait_for_pods(label_selector='app=metallb')
 
     def helm_exists(self, command_prefix):
         exit_code = self.local.run(f'{command_prefix} helm version ; echo $?').stdout.split()[-1].strip()
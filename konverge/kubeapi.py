@@ -0,0 +1,367 @@
+"""
+In-process Kubernetes API client, used by KubeExecutor instead of a kubectl process per operation.
+
+The kubeconfig is read once per context. Requests share one HTTPS session,
+so the TLS connection to the API server is kept alive across calls.
+"""
+import os
+import json
+import base64
+import atexit
+import logging
+import tempfile
+import warnings
+import threading
+
+import yaml
+import crayons
+import requests
+from urllib3.exceptions import InsecureRequestWarning
+
+
+KUBE_API_TIMEOUT = 10
+KUBE_WATCH_TIMEOUT = 30
+KUBE_READY_TIMEOUT = 600
+APISERVER_READY_TIMEOUT = 300
+
+
+def _resolve_data(entry: dict, key, base_path):
+    """
+    Kubeconfig credentials are either inline base64 (<key>-data) or a file path (<key>), relative to the kubeconfig.
+    Returns the content bytes, or None.
+    """
+    data = entry.get(f'{key}-data')
+    if data:
+        return base64.b64decode(data)
+    path = entry.get(key)
+    if path:
+        with open(os.path.join(base_path, os.path.expanduser(path)), mode='rb') as credential_file:
+            return credential_file.read()
+    return None
+
+
+def current_context(config_filename=None):
+    """
+    current-context of a kubeconfig, ~/.kube/config by default. None if it cannot be read.
+    """
+    config_filename = config_filename or os.path.join(os.path.expanduser('~'), '.kube', 'config')
+    try:
+        with open(config_filename, mode='r') as config_file:
+            return (yaml.safe_load(config_file) or {}).get('current-context')
+    except (OSError, yaml.YAMLError):
+        return None
+
+
+def apiserver_ready(host, port=6443, timeout=5):
+    """
+    Unauthenticated /readyz probe, /healthz on API servers without /readyz. kubeadm allows anonymous access to both.
+    The serving certificate is not verified: no kubeconfig with the cluster CA exists yet.
+    """
+    for path in ('/readyz', '/healthz'):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', InsecureRequestWarning)
+                response = requests.get(f'https://{host}:{port}{path}', verify=False, timeout=timeout)
+        except requests.RequestException:
+            return False
+        if response.status_code == 404:
+            continue
+        return response.ok and response.text.strip() == 'ok'
+    return False
+
+
+class KubeAPIClient:
+    def __init__(
+            self,
+            server,
+            certificate_authority: bytes = None,
+            client_certificate: bytes = None,
+            client_key: bytes = None,
+            token=None,
+            insecure=False,
+            timeout=KUBE_API_TIMEOUT
+    ):
+        self.server = server.rstrip('/')
+        self.timeout = timeout
+        self._files = []
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json'})
+        if token:
+            self.session.headers.update({'Authorization': f'Bearer {token}'})
+        if insecure:
+            self.session.verify = False
+        elif certificate_authority:
+            self.session.verify = self._credential_file(certificate_authority)
+        if client_certificate and client_key:
+            self.session.cert = (self._credential_file(client_certificate), self._credential_file(client_key))
+        atexit.register(self.close)
+
+    @classmethod
+    def from_kubeconfig(cls, config_filename=None, context=None, timeout=KUBE_API_TIMEOUT):
+        """
+        Build a client from a kubeconfig context. Defaults to ~/.kube/config and its current-context.
+        Returns None if the kubeconfig or context cannot be resolved.
+        """
+        config_filename = config_filename or os.path.join(os.path.expanduser('~'), '.kube', 'config')
+        try:
+            with open(config_filename, mode='r') as config_file:
+                config = yaml.safe_load(config_file) or {}
+        except (OSError, yaml.YAMLError) as config_error:
+            logging.error(crayons.red(f'Cannot read kubeconfig {config_filename}: {config_error}'))
+            return None
+
+        context = context or config.get('current-context')
+        find = lambda entries, name: next(
+            (entry.get(entries[:-1]) for entry in config.get(entries) or [] if entry.get('name') == name),
+            None
+        )
+        context_obj = find('contexts', context)
+        if not context_obj:
+            logging.error(crayons.red(f'Context {context} not found in {config_filename}'))
+            return None
+        cluster = find('clusters', context_obj.get('cluster')) or {}
+        user = find('users', context_obj.get('user')) or {}
+        if not cluster.get('server'):
+            logging.error(crayons.red(f'No server for context {context} in {config_filename}'))
+            return None
+
+        base_path = os.path.dirname(os.path.abspath(config_filename))
+        try:
+            return cls(
+                server=cluster.get('server'),
+                certificate_authority=_resolve_data(cluster, 'certificate-authority', base_path),
+                client_certificate=_resolve_data(user, 'client-certificate', base_path),
+                client_key=_resolve_data(user, 'client-key', base_path),
+                token=user.get('token'),
+                insecure=bool(cluster.get('insecure-skip-tls-verify')),
+                timeout=timeout
+            )
+        except OSError as credential_error:
+            logging.error(crayons.red(f'Cannot read credentials of context {context}: {credential_error}'))
+            return None
+
+    def _credential_file(self, content: bytes):
+        """
+        requests loads certificates from files only: credentials are written once, readable by the owner only.
+        """
+        descriptor, path = tempfile.mkstemp(prefix='konverge-kube-', suffix='.pem')
+        with os.fdopen(descriptor, mode='wb') as credential_file:
+            credential_file.write(content)
+        self._files.append(path)
+        return path
+
+    def close(self):
+        self.session.close()
+        for path in self._files:
+            if os.path.exists(path):
+                os.remove(path)
+        self._files = []
+
+    def request(self, method, path, **kwargs):
+        """
+        Returns the decoded JSON response, or None on a connection or HTTP error.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, f'{self.server}{path}', **kwargs)
+        except requests.RequestException as request_error:
+            logging.warning(crayons.yellow(f'Kubernetes API {method} {path} failed: {request_error}'))
+            return None
+        if not response.ok:
+            logging.warning(crayons.yellow(f'Kubernetes API {method} {path}: {response.status_code} {response.reason}'))
+            return None
+        return response.json() if response.content else {}
+
+    def is_reachable(self):
+        try:
+            return self.session.get(f'{self.server}/version', timeout=self.timeout).ok
+        except requests.RequestException:
+            return False
+
+    def list_nodes(self, label_selector=None):
+        nodes = self.request('GET', '/api/v1/nodes', params={'labelSelector': label_selector} if label_selector else None)
+        return nodes.get('items', []) if nodes else []
+
+    def get_node_names(self):
+        return [node.get('metadata', {}).get('name') for node in self.list_nodes()]
+
+    def patch_node(self, name, patch: dict):
+        return self.request(
+            'PATCH',
+            f'/api/v1/nodes/{name}',
+            json=patch,
+            headers={'Content-Type': 'application/merge-patch+json'}
+        )
+
+    def label_node(self, name, labels: dict):
+        """
+        Merge labels into node metadata. A None value removes the label.
+        """
+        return self.patch_node(name, {'metadata': {'labels': labels}}) is not None
+
+    def delete_node(self, name):
+        return self.request('DELETE', f'/api/v1/nodes/{name}') is not None
+
+    def namespace_active(self, name):
+        namespace = self.request('GET', f'/api/v1/namespaces/{name}')
+        return bool(namespace) and namespace.get('status', {}).get('phase') == 'Active'
+
+    def list_resource(self, path, **params):
+        """
+        Returns (items, resourceVersion) of a list request, or (None, None).
+        """
+        listed = self.request('GET', path, params=params or None)
+        if listed is None:
+            return None, None
+        return listed.get('items', []), listed.get('metadata', {}).get('resourceVersion')
+
+    def watch(self, path, resource_version, timeout_seconds=KUBE_WATCH_TIMEOUT, **params):
+        """
+        Yield (event type, object) from a watch stream, until the server closes it.
+        Stops on errors, ERROR events included (e.g. 410 Gone for an expired resourceVersion): relist and watch again.
+        """
+        params.update(
+            watch='1',
+            resourceVersion=resource_version,
+            timeoutSeconds=timeout_seconds,
+            allowWatchBookmarks='true'
+        )
+        try:
+            with self.session.get(
+                    f'{self.server}{path}',
+                    params=params,
+                    stream=True,
+                    timeout=(self.timeout, timeout_seconds + self.timeout)
+            ) as response:
+                if not response.ok:
+                    logging.warning(crayons.yellow(f'Kubernetes API watch {path}: {response.status_code} {response.reason}'))
+                    return
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    event = json.loads(line)
+                    if event.get('type') == 'ERROR':
+                        return
+                    yield event.get('type'), event.get('object', {})
+        except (requests.RequestException, ValueError) as watch_error:
+            logging.warning(crayons.yellow(f'Kubernetes API watch {path} interrupted: {watch_error}'))
+
+    def list_pods(self, namespace=None, field_selector=None, label_selector=None):
+        """
+        Returns pod items, or None if the API request failed. All namespaces when namespace is None.
+        """
+        path = f'/api/v1/namespaces/{namespace}/pods' if namespace else '/api/v1/pods'
+        params = {}
+        if field_selector:
+            params['fieldSelector'] = field_selector
+        if label_selector:
+            params['labelSelector'] = label_selector
+        pods = self.request('GET', path, params=params)
+        return pods.get('items', []) if pods is not None else None
+
+
+def pod_ready_containers(pod: dict):
+    """
+    Returns (ready, total) containers of a pod, as in the kubectl READY column.
+    """
+    statuses = pod.get('status', {}).get('containerStatuses') or []
+    containers = pod.get('spec', {}).get('containers') or statuses
+    return len([status for status in statuses if status.get('ready')]), len(containers)
+
+
+def pod_ready(pod: dict):
+    """
+    Completed pods count as ready, running pods once all containers are ready.
+    """
+    phase = pod.get('status', {}).get('phase')
+    ready, total = pod_ready_containers(pod)
+    return phase == 'Succeeded' or (phase == 'Running' and ready == total)
+
+
+def node_ready(node: dict):
+    conditions = node.get('status', {}).get('conditions') or []
+    return any(condition.get('type') == 'Ready' and condition.get('status') == 'True' for condition in conditions)
+
+
+class ReadinessIndex:
+    """
+    In-memory pods and nodes keyed by metadata.uid, fed by list and watch responses.
+    """
+    def __init__(self):
+        self.pods = {}
+        self.nodes = {}
+
+    def _store(self, kind):
+        return self.nodes if kind == 'Node' else self.pods
+
+    def replace(self, kind, items: list):
+        store = self._store(kind)
+        store.clear()
+        for item in items:
+            store[item.get('metadata', {}).get('uid')] = item
+
+    def replace_list(self, items: list):
+        """
+        Mixed List of kind Node and Pod items, e.g. from kubectl get nodes,pods -o json.
+        """
+        self.replace('Node', [item for item in items if item.get('kind') == 'Node'])
+        self.replace('Pod', [item for item in items if item.get('kind') == 'Pod'])
+
+    def apply(self, event_type, item: dict, kind='Pod'):
+        if event_type == 'BOOKMARK':
+            return
+        store = self._store(kind)
+        uid = item.get('metadata', {}).get('uid')
+        if event_type == 'DELETED':
+            store.pop(uid, None)
+        else:
+            store[uid] = item
+
+    def pending(self):
+        """
+        Names and states of pods and nodes not ready.
+        """
+        pending = []
+        for pod in self.pods.values():
+            if not pod_ready(pod):
+                ready, total = pod_ready_containers(pod)
+                pending.append(f'pod/{pod.get("metadata", {}).get("name")} {pod.get("status", {}).get("phase")} {ready}/{total}')
+        for node in self.nodes.values():
+            if not node_ready(node):
+                pending.append(f'node/{node.get("metadata", {}).get("name")} NotReady')
+        return pending
+
+    @property
+    def nodes_ready(self):
+        return all(node_ready(node) for node in self.nodes.values())
+
+    @property
+    def ready(self):
+        return bool(self.pods) and not self.pending()
+
+
+class KubeAPIClientCache:
+    """
+    One client per (kubeconfig, context), created on first use.
+    Without a context, the current-context of the kubeconfig at call time is used, so a context switch is never pinned.
+    """
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, config_filename=None, context=None):
+        context = context or current_context(config_filename)
+        key = (config_filename, context)
+        with self._lock:
+            if self._clients.get(key) is None:
+                self._clients[key] = KubeAPIClient.from_kubeconfig(config_filename=config_filename, context=context)
+            return self._clients[key]
+
+    def invalidate(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close() if client else None
+            self._clients = {}
+
+
+kube_api_clients = KubeAPIClientCache()
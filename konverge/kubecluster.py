@@ -2,13 +2,20 @@ import typing
 
 from konverge.kuberunner import serializers, kube_runner_factory
 from konverge.kube import KubeProvisioner
+from konverge.concurrency import ConcurrencyLimits, run_concurrently, report_outcomes, mark_failed
+from konverge.pve import TASK_TIMEOUT
+from konverge.queries import VMQuery
+from konverge.readiness import VMReadiness, wait_until_ready
+from konverge.scheduler import TaskGraph, GraphExecutor
+from konverge.journal import RunJournal
 from konverge.files import KubeClusterConfigFile
-from konverge.utils import VMCategory, sleep_intervals, HelmVersion, KubeClusterStages
+from konverge.utils import VMCategory, sleep_intervals, HelmVersion, KubeClusterStages, FabricWrapperGroup
 
 
 class KubeCluster:
     def __init__(self, config: KubeClusterConfigFile):
         self.config = config.serialize()
+        self.limits = ConcurrencyLimits()
         self.cluster = serializers.ClusterAttributesSerializer(self.config)
         self.control_plane = serializers.ControlPlaneSerializer(self.config)
 
@@ -17,7 +24,8 @@ class KubeCluster:
 
         self.templates = serializers.ClusterTemplateSerializer(
             config=self.config.get(VMCategory.template.value),
-            cluster_attributes=self.cluster.cluster
+            cluster_attributes=self.cluster.cluster,
+            networking=self.control_plane.control_plane.networking
         )
         self.templates.serialize()
 
@@ -38,6 +46,7 @@ class KubeCluster:
         ]
         [worker.serialize() for worker in self.workers]
 
+        self.journal = RunJournal(self.cluster.cluster.name, serializers.settings.WORKDIR)
         self.runners = self._generate_runners()
         self.provisioners = self._generate_provisioners()
         self.executor = None
@@ -57,12 +66,113 @@ class KubeCluster:
         print(serializers.crayons.cyan(f'Sleep for {wait_period} seconds. Reason: {reason}'))
         sleep_intervals(wait_period)
 
+    @staticmethod
+    def wait_for_tasks(reason='N/A', timeout=TASK_TIMEOUT, dry_run=False):
+        """
+        Wait on all Proxmox tasks issued so far (clone, create, start, destroy), instead of a fixed period.
+        Returns False if any task failed or timed out.
+        """
+        if dry_run:
+            return True
+        tracker = serializers.settings.vm_client.tasks
+        pending = tracker.pending
+        print(serializers.crayons.cyan(f'Waiting for {len(pending)} Proxmox tasks. Reason: {reason}'))
+        results = tracker.wait_all(pending, timeout=timeout or TASK_TIMEOUT)
+        failed = [result for result in results.values() if not result.ok]
+        if failed:
+            serializers.logging.error(serializers.crayons.red(f'{len(failed)} of {len(results)} Proxmox tasks failed.'))
+            return False
+        return True
+
+    def wait_for_ready(self, workers_only=False, dry_run=False):
+        """
+        Probe all cluster VMs concurrently, until SSH is reachable and cloud-init has finished.
+        """
+        if dry_run:
+            return True
+        instances = [] if workers_only else list(self.masters.instances)
+        for worker in self.workers:
+            instances.extend(worker.instances)
+        probes = [VMReadiness.from_instance(instance) for instance in instances if instance.vmid]
+        print(serializers.crayons.cyan(f'Waiting for {len(probes)} VMs to become ready.'))
+        results = wait_until_ready(probes)
+        not_ready = [name for name, result in results.items() if not result.ready]
+        if not_ready:
+            serializers.logging.error(serializers.crayons.red(f'VMs not ready: {", ".join(not_ready)}'))
+            return False
+        return True
+
     def _generate_runners(self):
-        return {
+        runners = {
             VMCategory.template.value: kube_runner_factory(self.templates),
             VMCategory.masters.value: kube_runner_factory(self.masters),
             VMCategory.workers.value: [kube_runner_factory(worker) for worker in self.workers]
         }
+        for runner in [runners[VMCategory.template.value], runners[VMCategory.masters.value], *runners[VMCategory.workers.value]]:
+            runner.journal = self.journal
+        return runners
+
+    def _verify_clone(self, entry):
+        """
+        A clone interrupted before its cloudinit config was applied is destroyed, so the rerun clones it again.
+        """
+        name = entry.task.split(':', 1)[1]
+        client = serializers.settings.vm_client
+        vm = client.get_vm_inventory(refresh=True).get(entry.vmid)
+        if not vm or vm.get('name') != name:
+            return False
+        config = client.get_vm_config(node=vm.get('node'), vmid=entry.vmid, current=False)
+        if config and config.get('ipconfig0'):
+            return True
+        serializers.logging.warning(serializers.crayons.yellow(f'Destroy partially provisioned VM {name} {entry.vmid}'))
+        if vm.get('status') == 'running':
+            client.tasks.wait(client.stop_vm(node=vm.get('node'), vmid=entry.vmid))
+        client.tasks.wait(client.destroy_vm(node=vm.get('node'), vmid=entry.vmid))
+        return False
+
+    def _verify_join(self, entry):
+        name = entry.task.split(':', 1)[1]
+        leader = self.provisioners.get(VMCategory.masters.value).get('leader')
+        nodes = leader.instance.self_node.execute('kubectl get nodes -o name', warn=True, hide=True)
+        return bool(nodes) and nodes.ok and f'node/{name}' in nodes.stdout.split()
+
+    def recover(self, dry_run=False):
+        """
+        Check tasks interrupted in a previous run, against Proxmox and the cluster.
+        """
+        uncertain = self.journal.uncertain()
+        if not uncertain:
+            return
+        print(serializers.crayons.cyan(f'Recovering {len(uncertain)} interrupted tasks from journal {self.journal.filename}'))
+        if dry_run:
+            [print(serializers.crayons.white(f'Verify task: {entry.task}')) for entry in uncertain]
+            return
+        self.journal.verify(
+            {
+                'clone:': self._verify_clone,
+                'join:': self._verify_join
+            }
+        )
+
+    def _run_stage(self, stage: KubeClusterStages, function: callable, replay=True, dry_run=False):
+        """
+        Run a stage recorded in the journal. With replay, a stage done in a previous run is skipped.
+        Returns False if the stage did not complete.
+        """
+        if dry_run:
+            return function() is not False
+        task = f'stage:{stage.value}'
+        if replay and self.journal.done(task):
+            print(serializers.crayons.cyan(f'Stage {stage.value} done in a previous run. Skip.'))
+            return True
+        self.journal.begin(task)
+        try:
+            completed = function() is not False
+        except Exception as stage_error:
+            self.journal.fail(task, error=str(stage_error))
+            raise
+        self.journal.complete(task) if completed else self.journal.fail(task, error='Stage did not complete')
+        return completed
 
     def _generate_provisioners(self):
         provisioner = KubeProvisioner.kube_provisioner_factory(
@@ -94,6 +204,20 @@ class KubeCluster:
             }
         }
 
+    def query(self, known: dict = None):
+        """
+        Resolve templates, masters and all worker groups in one bulk query.
+        known: {instance name: journal entry} of completed clones, resolved from the journal instead of Proxmox configs.
+        Provisioners are regenerated, to reference the resolved instances.
+        """
+        serializers.ClusterQuery(client=serializers.settings.vm_client).execute(
+            self.templates,
+            self.masters,
+            *self.workers,
+            known=known
+        )
+        self.provisioners = self._generate_provisioners()
+
     def _generate_executor(self, destroy=False, dry_run=False):
         """
         Lazy load KubeExecutor with remote feature, until leader is online.
@@ -121,42 +245,290 @@ class KubeCluster:
             print(serializers.crayons.green(f'KubeExecutor generated successfully (dry-run)'))
             print()
             # return dummy executor
-            return serializers.KubeExecutor()
+            return serializers.KubeExecutor(context=self.cluster.cluster.context)
 
         self._wait_for_masters_alive() if not destroy else None
         return serializers.KubeExecutor(
-            leader.self_node
-        ) if not destroy else serializers.KubeExecutor()
+            leader.self_node,
+            context=self.cluster.cluster.context
+        ) if not destroy else serializers.KubeExecutor(context=self.cluster.cluster.context)
+
+    def _wait_for_alive(self, provisioners: list, wait_period=10, role='Node'):
+        """
+        Probe all nodes concurrently each round, until every node responds. Connections of unresponsive nodes are reset.
+        """
+        pending = {provisioner.instance.vm_attributes.name: provisioner for provisioner in provisioners}
+        while pending:
+            group = FabricWrapperGroup(
+                {name: provisioner.instance.self_node for name, provisioner in pending.items()}
+            )
+            results = group.run('uptime', timeout=wait_period, warn=True, hide=True)
+            for name in group.failed(results):
+                pending[name].instance.self_node.reset()
+            pending = {name: pending[name] for name in group.failed(results)}
+            if pending:
+                self.wait(wait_period=wait_period, reason=f'{role} {", ".join(pending.keys())} not yet responsive.')
 
     def _wait_for_masters_alive(self):
         leader = self.provisioners.get(VMCategory.masters.value).get('leader')
-        while not leader.is_alive():
-            self.wait(wait_period=30, reason=f'Leader {leader.instance.vm_attributes.name} is not yet responsive.')
+        masters = [leader]
         if self.control_plane.control_plane.ha_masters:
-            join = self.provisioners.get(VMCategory.masters.value).get('join')
-            for master in join:
-                while not master.is_alive():
-                    self.wait(
-                        wait_period=30,
-                        reason=f'Master {master.instance.vm_attributes.name} is not yet responsive.'
-                    )
+            masters.extend(self.provisioners.get(VMCategory.masters.value).get('join'))
+        self._wait_for_alive(masters, wait_period=30, role='Master')
 
     def _wait_for_workers_alive(self):
         roles = self.provisioners.get(VMCategory.workers.value)
-        for _, workers in roles.items():
-            for worker in workers:
-                while not worker.is_alive():
-                    self.wait(
-                        wait_period=10,
-                        reason=f'Worker {worker.instance.vm_attributes.name} is not yet responsive.'
-                    )
+        workers = [worker for _, group in roles.items() for worker in group]
+        self._wait_for_alive(workers, wait_period=10, role='Worker')
+
+    @staticmethod
+    def _rollback_nodes(provisioners: list, dry_run=False):
+        """
+        Rollback nodes concurrently. Returns names of nodes that failed rollback.
+        """
+        for provisioner in provisioners:
+            print(serializers.crayons.cyan(f'Rollback node: {provisioner.instance.vm_attributes.name}'))
+        if dry_run or not provisioners:
+            return []
+        by_name = {provisioner.instance.vm_attributes.name: provisioner for provisioner in provisioners}
+        group = FabricWrapperGroup({name: provisioner.instance.self_node for name, provisioner in by_name.items()})
+        results = group.map(lambda name, _: by_name[name].rollback_node())
+        failed = group.failed(results)
+        for name in failed:
+            serializers.logging.error(serializers.crayons.red(f'Rollback failed on {name}: {results[name].error}'))
+        return failed
 
     def create(self, disable_backups=False, dry_run=False, workers_only=False):
+        """
+        Returns False if a template build failed: no instance is cloned from a missing or broken template.
+        """
         for category, runners in self.runners.items():
             if category == VMCategory.workers.value:
-                [runner.create(disable_backups=disable_backups, dry_run=dry_run) for runner in runners]
-            else:
-                runners.create(disable_backups=disable_backups, dry_run=dry_run) if not workers_only else None
+                [runner.create(disable_backups=disable_backups, dry_run=dry_run, limits=self.limits) for runner in runners]
+            elif not workers_only:
+                outcomes = runners.create(
+                    disable_backups=disable_backups,
+                    dry_run=dry_run,
+                    limits=self.limits
+                )
+                if category == VMCategory.template.value and not all(outcome.ok for outcome in (outcomes or {}).values()):
+                    serializers.logging.error(serializers.crayons.red('Template build failed. Abort cluster create.'))
+                    return False
+        return True
+
+    @staticmethod
+    def _checked(result, error):
+        """
+        Graph tasks fail by raising: turn a falsy phase result into an exception.
+        """
+        if not result:
+            raise RuntimeError(error)
+        return result
+
+    def _clone_task(self, runner, instance, state, index, disable_backups=False):
+        vmid = runner.provision(instance, disable_backups=disable_backups, start=False)
+        runner.record(instance, state, index, vmid)
+        return vmid
+
+    def _start_task(self, instance):
+        started = instance.wait_for_task(instance.start_vm(), operation='Start')
+        return self._checked(started, f'VM {instance.vm_attributes.name} failed to start')
+
+    def _ready_task(self, instance):
+        readiness = VMReadiness.from_instance(instance).wait()
+        return self._checked(readiness.ready, f'VM {instance.vm_attributes.name} not ready')
+
+    def _join_task(self, provisioner, **join):
+        """
+        join_node rolls back a failed join itself. A join that raises is rolled back here, before the task fails.
+        """
+        name = provisioner.instance.vm_attributes.name
+        try:
+            joined = provisioner.join_node(**join)
+        except Exception:
+            self._rollback_nodes([provisioner])
+            raise
+        return self._checked(joined, f'kubeadm join failed on {name}')
+
+    def build_create_graph(self, disable_backups=False):
+        """
+        Full cluster create as a graph of per-VM and per-node tasks.
+        A worker joins as soon as it is ready and the leader is initialized, without waiting on the other VMs.
+        """
+        graph = TaskGraph()
+        context = {}
+        template_runner = self.runners.get(VMCategory.template.value)
+        graph.add(
+            'templates',
+            lambda: self._checked(
+                all(outcome.ok for outcome in template_runner.create(disable_backups=disable_backups, limits=self.limits).values()),
+                'Template build failed'
+            )
+        )
+
+        runners = [self.runners.get(VMCategory.masters.value), *self.runners.get(VMCategory.workers.value)]
+        cloned = set()
+        for runner in runners:
+            for instance, state, index in runner.pending():
+                name = instance.vm_attributes.name
+                graph.add(
+                    f'clone:{name}',
+                    lambda runner=runner, instance=instance, state=state, index=index: self._clone_task(
+                        runner, instance, state, index, disable_backups=disable_backups
+                    ),
+                    requires=['templates'],
+                    groups=['clone', f'clone:{instance.vm_attributes.node}']
+                )
+                graph.add(f'start:{name}', lambda instance=instance: self._start_task(instance), requires=[f'clone:{name}'])
+                cloned.add(name)
+        for runner in runners:
+            for instance in runner.serializer.instances:
+                name = instance.vm_attributes.name
+                graph.add(
+                    f'ready:{name}',
+                    lambda instance=instance: self._ready_task(instance),
+                    requires=[f'start:{name}'] if name in cloned else []
+                )
+
+        leader = self.provisioners.get(VMCategory.masters.value).get('leader')
+        join = self.provisioners.get(VMCategory.masters.value).get('join')
+        leader_name = leader.instance.vm_attributes.name
+        ha = self.is_control_plane_ha
+
+        def install_leader_loadbalancer():
+            self._checked(self.install_loadbalancer(), 'Control plane loadbalancer install failed')
+            return self.control_plane.control_plane.apiserver_ip
+
+        def restore_apiserver_ip(apiserver_ip):
+            self.control_plane.control_plane.apiserver_ip = apiserver_ip
+
+        def init_leader():
+            self._checked(leader.bootstrap_control_plane(self.cluster.cluster.version), 'Leader initialization failed')
+            if ha:
+                context['certificate_key'] = leader.certificate_key
+            return True
+
+        def master_join_command():
+            # The certificate key is not journaled: on rerun, certificates are uploaded again by get_join_token_v2.
+            context['masters'] = self._checked(
+                leader.get_join_token(
+                    control_plane_node=True,
+                    certificate_key=context.get('certificate_key')
+                ) if leader.instance.allowed_ip and context.get('certificate_key') else leader.get_join_token_v2(
+                    control_plane_node=True
+                ),
+                'Master join command not generated'
+            )
+            return True
+
+        def worker_join_command():
+            context['workers'] = self._checked(
+                leader.get_join_token_v2(control_plane_node=False),
+                'Worker join command not generated'
+            )
+            return True
+
+        def generate_executor():
+            self.executor = serializers.KubeExecutor(leader.instance.self_node, context=self.cluster.cluster.context)
+            return True
+
+        joins = []
+        if ha:
+            graph.add(
+                f'lb:{leader_name}',
+                install_leader_loadbalancer,
+                requires=[f'ready:{leader_name}'],
+                journaled=True,
+                restore=restore_apiserver_ip
+            )
+            graph.add(f'init:{leader_name}', init_leader, requires=[f'lb:{leader_name}'], journaled=True)
+            graph.add('join-command:masters', master_join_command, requires=[f'init:{leader_name}'])
+            for master in join:
+                name = master.instance.vm_attributes.name
+                graph.add(
+                    f'lb:{name}',
+                    lambda master=master: self._checked(
+                        master.install_control_plane_loadbalancer(is_leader=False),
+                        f'Keepalived install failed on {master.instance.vm_attributes.name}'
+                    ),
+                    requires=[f'ready:{name}', f'lb:{leader_name}'],
+                    journaled=True
+                )
+                # Stacked etcd members are added one at a time by kubeadm: throttled by the master-join group.
+                graph.add(
+                    f'join:{name}',
+                    lambda master=master: self._join_task(
+                        master,
+                        leader=leader.instance,
+                        control_plane_node=True,
+                        certificate_key=context.get('certificate_key'),
+                        join_command=context.get('masters')
+                    ),
+                    requires=['join-command:masters', f'lb:{name}'],
+                    groups=['master-join'],
+                    journaled=True
+                )
+                joins.append(f'join:{name}')
+        else:
+            graph.add(f'init:{leader_name}', init_leader, requires=[f'ready:{leader_name}'], journaled=True)
+
+        graph.add('executor', generate_executor, requires=[f'init:{leader_name}'])
+        graph.add('join-command:workers', worker_join_command, requires=[f'init:{leader_name}'])
+        for _, group in self.provisioners.get(VMCategory.workers.value).items():
+            for worker in group:
+                name = worker.instance.vm_attributes.name
+                graph.add(
+                    f'join:{name}',
+                    lambda worker=worker: self._join_task(worker, leader=leader.instance, join_command=context.get('workers')),
+                    requires=['join-command:workers', f'ready:{name}'],
+                    groups=['worker-join'],
+                    journaled=True
+                )
+                joins.append(f'join:{name}')
+
+        graph.add('kubeconfig', lambda: self.add_local_cluster_config(), requires=['executor'])
+        # Labels are applied through the local kubeconfig context of this cluster.
+        graph.add('label', lambda: self.label_workers(), requires=['kubeconfig', *joins], journaled=True)
+        if self.cluster.cluster.dashboard:
+            graph.add(
+                'dashboard',
+                lambda: self.executor.deploy_dashboard(local=False),
+                requires=['kubeconfig', *joins],
+                journaled=True
+            )
+        graph.add('helm', lambda: self.helm_install(), requires=['kubeconfig', *joins], journaled=True)
+        if self.cluster.cluster.loadbalancer:
+            graph.add('metallb', lambda: self.executor.metallb_install(), requires=['kubeconfig', *joins], journaled=True)
+        return graph
+
+    def graph_limits(self, graph: TaskGraph):
+        limits = {
+            'clone': self.limits.global_limit,
+            'master-join': self.limits.master_joins,
+            'worker-join': self.limits.joins
+        }
+        for task in graph.tasks.values():
+            for group in task.groups:
+                if group.startswith('clone:'):
+                    limits[group] = self.limits.per_node
+        return limits
+
+    def execute_graph(self, disable_backups=False, dry_run=False):
+        """
+        Returns True if every task of the create graph completed.
+        """
+        graph = self.build_create_graph(disable_backups=disable_backups)
+        if dry_run:
+            title = f'Create graph: {len(graph)} tasks'
+            print()
+            print(serializers.crayons.green(title))
+            print(serializers.crayons.green('=' * len(title)))
+            graph.describe()
+            print()
+            return True
+        executor = GraphExecutor(graph, group_limits=self.graph_limits(graph), journal=self.journal)
+        executor.run()
+        return executor.report()
 
     def destroy(self, template=False, dry_run=False, apply=False, provisioners: list = None):
         if apply:
@@ -179,6 +551,8 @@ class KubeCluster:
 
     def install_loadbalancer(self, dry_run=False):
         """
+        Install keepalived on the leader, which holds the virtual ip for kubeadm init.
+        Secondary masters are installed concurrently with the leader init, in boostrap_control_plane.
         :return: True if phase is successful.
         """
         if dry_run:
@@ -204,13 +578,16 @@ class KubeCluster:
                 )
                 return False
             self.control_plane.control_plane.apiserver_ip = apiserver_ip
-        for master in join:
-            print(serializers.crayons.cyan(f'Setup keepalived and join master node: {master.instance.vm_attributes.name}'))
-            master.install_control_plane_loadbalancer(is_leader=False) if not dry_run else None
-        print(serializers.crayons.green('Successfully installed Control Plane Loadbalancer (dry-run)')) if dry_run else None
+        if dry_run:
+            for master in join:
+                print(serializers.crayons.cyan(f'Setup keepalived and join master node: {master.instance.vm_attributes.name}'))
+            print(serializers.crayons.green('Successfully installed Control Plane Loadbalancer (dry-run)'))
         return True
 
     def boostrap_control_plane(self, dry_run=False):
+        """
+        :return: True if the leader is initialized. Failed master joins are reported, without failing the phase.
+        """
         leader = self.provisioners.get(VMCategory.masters.value).get('leader')
         join = self.provisioners.get(VMCategory.masters.value).get('join')
 
@@ -229,20 +606,79 @@ class KubeCluster:
             serializers.logging.error(
                 serializers.crayons.red('Abort bootstrapping control plane phase.')
             )
-            return
+            return False
 
         print(serializers.crayons.cyan(f'Boostrap Leader master node: {leader.instance.vm_attributes.name}'))
-        cert_key = leader.bootstrap_control_plane(self.cluster.cluster.version) if not dry_run else None
-        if self.is_control_plane_ha:
-            for master in join:
+        if dry_run:
+            for master in join if self.is_control_plane_ha else []:
                 print(serializers.crayons.cyan(f'Join master node: {master.instance.vm_attributes.name}'))
-                master.join_node(
-                    leader=leader.instance,
-                    control_plane_node=True,
-                    certificate_key=cert_key
-                ) if not dry_run else None
-        print(serializers.crayons.green('Successfully Bootstrapped Control Plane (dry-run)')) if dry_run else None
+            print(serializers.crayons.green('Successfully Bootstrapped Control Plane (dry-run)'))
+            print()
+            return True
+        if not self.is_control_plane_ha:
+            initialized = leader.bootstrap_control_plane(self.cluster.cluster.version)
+            if not initialized:
+                serializers.logging.error(serializers.crayons.red('Leader initialization failed.'))
+            print()
+            return initialized
+
+        # Leader kubeadm init runs while keepalived is installed on the secondary masters.
+        tasks = [
+            (
+                leader.instance.vm_attributes.name,
+                leader.instance.vm_attributes.node,
+                lambda: leader.bootstrap_control_plane(self.cluster.cluster.version)
+            )
+        ]
+        for master in join:
+            print(serializers.crayons.cyan(f'Setup keepalived on master node: {master.instance.vm_attributes.name}'))
+            tasks.append(
+                (
+                    f'keepalived {master.instance.vm_attributes.name}',
+                    master.instance.vm_attributes.node,
+                    lambda master=master: master.install_control_plane_loadbalancer(is_leader=False)
+                )
+            )
+        outcomes = mark_failed(
+            run_concurrently(tasks, limits=ConcurrencyLimits(global_limit=len(tasks), per_node=len(tasks)))
+        )
+        report_outcomes(outcomes, title='Leader init & keepalived results')
+        leader_init, keepalived = outcomes[0], outcomes[1:]
+        cert_key = leader.certificate_key
+        if not leader_init.ok:
+            serializers.logging.error(serializers.crayons.red('Leader initialization failed. Abort joining master nodes.'))
+            return False
+
+        join_command = leader.get_join_token(
+            control_plane_node=True,
+            certificate_key=cert_key
+        ) if leader.instance.allowed_ip else leader.get_join_token_v2(control_plane_node=True)
+        masters = [master for master, outcome in zip(join, keepalived) if outcome.ok]
+        for master, outcome in zip(join, keepalived):
+            if not outcome.ok:
+                serializers.logging.error(
+                    serializers.crayons.red(f'Skip joining {master.instance.vm_attributes.name}: keepalived install failed.')
+                )
+        # Stacked etcd members are added one at a time by kubeadm: throttle concurrent control plane joins.
+        outcomes = run_concurrently(
+            [
+                (
+                    master.instance.vm_attributes.name,
+                    master.instance.vm_attributes.node,
+                    lambda master=master: master.join_node(
+                        leader=leader.instance,
+                        control_plane_node=True,
+                        certificate_key=cert_key,
+                        join_command=join_command
+                    )
+                )
+                for master in masters
+            ],
+            limits=ConcurrencyLimits(global_limit=self.limits.master_joins, per_node=self.limits.master_joins)
+        )
+        report_outcomes(mark_failed(outcomes, error='kubeadm join failed'), title='Master join results') if outcomes else None
         print()
+        return True
 
     def rollback_control_plane(self, dry_run=False):
         if dry_run:
@@ -255,17 +691,17 @@ class KubeCluster:
         leader = self.provisioners.get(VMCategory.masters.value).get('leader')
         join = self.provisioners.get(VMCategory.masters.value).get('join')
         if self.is_control_plane_ha:
-            for master in join:
-                print(serializers.crayons.cyan(f'Rollback master node: {master.instance.vm_attributes.name}'))
-                master.rollback_node() if not dry_run else None
-            wait = 0 if dry_run else 60
-            self.wait(wait_period=wait, reason='Wait for Rollback to complete')
+            # kubeadm reset removes the etcd member before it returns: the leader is reset right after.
+            self._rollback_nodes(join, dry_run=dry_run)
         print(serializers.crayons.cyan(f'Rollback leader master node: {leader.instance.vm_attributes.name}'))
         leader.rollback_node() if not dry_run else None
         print(serializers.crayons.green('Successfully removed master nodes (dry-run)')) if dry_run else None
         print()
 
     def join_workers(self, dry_run=False):
+        """
+        Returns a TaskOutcome per joining worker, or None if the join command was not generated.
+        """
         if dry_run:
             title = f'Join Worker Nodes.'
             horizontal_sep = '=' * len(title)
@@ -277,16 +713,43 @@ class KubeCluster:
         workers = self.provisioners.get(VMCategory.workers.value)
         self._wait_for_workers_alive() if not dry_run else None
 
+        joined = set(self.executor.get_node_names(self.cluster)) if not dry_run else set()
+        pending = []
         for role, group in workers.items():
             for worker in group:
                 worker_name = worker.instance.vm_attributes.name
-                if worker_name in self.executor.get_node_names(self.cluster):
+                if worker_name in joined:
                     serializers.logging.warning(serializers.crayons.yellow(f'Skip worker {worker_name}. Already joined.'))
                     continue
-                print(serializers.crayons.cyan(f'Joining worker node: {worker.instance.vm_attributes.name}'))
-                worker.join_node(leader=leader.instance, control_plane_node=False) if not dry_run else None
-        print(serializers.crayons.green('Successfully joined worker nodes (dry-run)')) if dry_run else None
+                print(serializers.crayons.cyan(f'Joining worker node: {worker_name}'))
+                pending.append(worker)
+        if dry_run or not pending:
+            print(serializers.crayons.green('Successfully joined worker nodes (dry-run)')) if dry_run else None
+            print()
+            return []
+
+        join_command = leader.get_join_token_v2(control_plane_node=False)
+        if not join_command:
+            serializers.logging.error(serializers.crayons.red('Node Join command not generated. Abort.'))
+            return None
+        outcomes = run_concurrently(
+            [
+                (
+                    worker.instance.vm_attributes.name,
+                    worker.instance.vm_attributes.node,
+                    lambda worker=worker: worker.join_node(leader=leader.instance, join_command=join_command)
+                )
+                for worker in pending
+            ],
+            limits=ConcurrencyLimits(global_limit=self.limits.joins, per_node=self.limits.joins)
+        )
+        outcomes = mark_failed(outcomes, error='kubeadm join failed')
+        # join_node rolls back failed joins itself, only workers that raised are left to roll back.
+        raised = [worker for worker, outcome in zip(pending, outcomes) if isinstance(outcome.error, Exception)]
+        self._rollback_nodes(raised)
+        report_outcomes(outcomes, title='Worker join results')
         print()
+        return outcomes
 
     def rollback_workers(self, dry_run=False, apply=False, provisioners: list = None):
         if dry_run:
@@ -300,19 +763,15 @@ class KubeCluster:
             if not provisioners:
                 serializers.logging.warning(serializers.crayons.yellow('No worker node to rollback.'))
                 return
-            for worker in provisioners:
-                print(serializers.crayons.cyan(f'Rollback worker node: {worker.instance.vm_attributes.name}'))
-                worker.rollback_node() if not dry_run else None
-                self.executor.remove_cluster_node(instance=worker.instance) if not dry_run else None
         else:
             workers = self.provisioners.get(VMCategory.workers.value)
-            for role, group in workers.items():
-                for worker in group:
-                    print(serializers.crayons.cyan(f'Rollback worker node: {worker.instance.vm_attributes.name}'))
-                    worker.rollback_node() if not dry_run else None
-                    self.executor.remove_cluster_node(instance=worker.instance) if not dry_run else None
-        wait = 0 if dry_run else 60
-        self.wait(wait_period=wait, reason='Wait for Rollback to complete')
+            provisioners = [worker for _, group in workers.items() for worker in group]
+        self._rollback_nodes(provisioners, dry_run=dry_run)
+        for worker in provisioners:
+            self.executor.remove_cluster_node(instance=worker.instance) if not dry_run else None
+        self.executor.wait_for_nodes_removed(
+            [worker.instance.vm_attributes.name for worker in provisioners]
+        ) if not dry_run and provisioners else None
         print(serializers.crayons.green('Successfully removed worker nodes (dry-run)')) if dry_run else None
         print()
 
@@ -346,7 +805,7 @@ class KubeCluster:
             return provisioners
 
         for node_name in remove_nodes:
-            query = serializers.VMQuery(
+            query = VMQuery(
                 client=serializers.settings.vm_client,
                 name=node_name,
                 pool=self.cluster.cluster.pool
@@ -543,19 +1002,32 @@ class KubeCluster:
             destroy=False,
             destroy_template=False,
             disable_backups=True,
-            wait_period=120,
+            wait_period=TASK_TIMEOUT,
             stage: typing.Union[KubeClusterStages, None] = None,
             dry_run=False,
-            apply=False
+            apply=False,
+            limits: ConcurrencyLimits = None,
+            graph=False
     ):
+        """
+        graph: Run the full create as a dependency graph of per-VM tasks, instead of sequential stages.
+        """
+        if limits:
+            self.limits = limits
+        resume = bool(self.journal.entries) and not destroy and not apply
         if self.exists and not destroy:
-            if not apply:
+            if not apply and not resume:
                 serializers.logging.warning(
                     serializers.crayons.yellow(f'Cluster {self.cluster.cluster.name} already exists. Abort...')
                 )
                 return
             self.executor = self._generate_executor(dry_run=dry_run, destroy=destroy) if apply else None
 
+        if resume:
+            print(serializers.crayons.cyan(f'Resume cluster {self.cluster.cluster.name} from journal {self.journal.filename}'))
+        self.recover(dry_run=dry_run) if not destroy else None
+        # On resume, clones completed in the journal are trusted: only the uncertain tail was verified against Proxmox.
+        self.query(known=self.journal.completed('clone:') if resume else None)
         stagemsg = f' Stage: {stage.value}' if stage else ''
         dry = ' (dry-run)' if dry_run else ''
         action = 'destroyed' if destroy else ('updated' if apply else 'created')
@@ -565,8 +1037,29 @@ class KubeCluster:
         stage_bootstrap = serializers.crayons.yellow(f'Running Stage: {KubeClusterStages.bootstrap.value}')
         stage_join = serializers.crayons.yellow(f'Running Stage: {KubeClusterStages.join.value}')
         stage_post_installs = serializers.crayons.yellow(f'Running Stage: {KubeClusterStages.post_installs.value}')
-        wait_create = 0 if dry_run else wait_period
-        wait_bootstrap = 0 if dry_run else 60
+        clear_journal = self.journal.clear if not dry_run else lambda: None
+
+        def create_stage():
+            if not self.create(disable_backups=disable_backups, dry_run=dry_run):
+                return False
+            if not self.wait_for_tasks(reason='Create & Start Cluster VMs', timeout=wait_period, dry_run=dry_run):
+                return False
+            return self.wait_for_ready(dry_run=dry_run)
+
+        def bootstrap_stage():
+            bootstrapped = self.boostrap_control_plane(dry_run=dry_run)
+            if not bootstrapped or dry_run:
+                return bootstrapped
+            # The local kubeconfig is added in post installs: query the leader.
+            return self.executor.wait_for_running_system_status(remote=True)
+
+        def join_stage():
+            outcomes = self.join_workers(dry_run=dry_run)
+            return outcomes is not None and all(outcome.ok for outcome in outcomes)
+
+        def post_installs_stage():
+            self.post_installs(dry_run=dry_run)
+            return True
 
         if destroy:
             print()
@@ -580,6 +1073,7 @@ class KubeCluster:
                 self.destroy(template=destroy_template, dry_run=dry_run)
                 print(stage_post_installs)
                 self.post_destroy(dry_run=dry_run)
+                clear_journal()
                 print(serializers.crayons.green(msg))
                 return
 
@@ -598,6 +1092,7 @@ class KubeCluster:
                 print(stage_output)
                 self.executor = self._generate_executor(destroy=True, dry_run=dry_run)
                 self.post_destroy(dry_run=dry_run)
+            clear_journal()
             print(serializers.crayons.green(msg))
             return
 
@@ -606,46 +1101,60 @@ class KubeCluster:
             provisioners = self.get_downscaled_provisioners(diff_map)
             print(serializers.crayons.cyan('Adding new K8s Nodes...'))
             self.create(disable_backups=disable_backups, dry_run=dry_run, workers_only=True)
+            self.wait_for_tasks(reason='Create & Start new Worker VMs', timeout=wait_period, dry_run=dry_run)
+            self.wait_for_ready(workers_only=True, dry_run=dry_run)
             self.join_workers(dry_run=dry_run)
             self.label_workers(dry_run=dry_run)
             print(serializers.crayons.cyan('Removing K8s Nodes...'))
             self.rollback_workers(dry_run=dry_run, apply=apply, provisioners=provisioners)
             self.destroy(dry_run=dry_run, apply=apply, provisioners=provisioners)
+            clear_journal()
             print(serializers.crayons.green(msg))
             return
 
-        if not stage:
+        if not stage and graph:
             print()
             print(stage_create)
-            self.create(disable_backups=disable_backups, dry_run=dry_run)
-            self.wait(wait_period=wait_create, reason='Create & Start Cluster VMs')
-            self.executor = self._generate_executor(dry_run=dry_run)
-            print(stage_bootstrap)
-            self.boostrap_control_plane(dry_run=dry_run)
-            self.wait(wait_period=wait_bootstrap, reason='Bootstrap Control Plane')
-            print(stage_join)
-            self.join_workers(dry_run=dry_run)
-            print(stage_post_installs)
-            self.post_installs(dry_run=dry_run)
+            if not self.execute_graph(disable_backups=disable_backups, dry_run=dry_run):
+                serializers.logging.error(
+                    serializers.crayons.red(f'Cluster {self.cluster.cluster.name} create did not complete. Rerun to resume.')
+                )
+                return
+            clear_journal()
+            print(serializers.crayons.green(msg))
+            return
+
+        if not stage:
+            stages = [
+                (KubeClusterStages.create, stage_create, create_stage),
+                (KubeClusterStages.bootstrap, stage_bootstrap, bootstrap_stage),
+                (KubeClusterStages.join, stage_join, join_stage),
+                (KubeClusterStages.post_installs, stage_post_installs, post_installs_stage)
+            ]
+            print()
+            for current, stage_title, function in stages:
+                print(stage_title)
+                if current == KubeClusterStages.bootstrap:
+                    self.executor = self._generate_executor(dry_run=dry_run)
+                if not self._run_stage(current, function, dry_run=dry_run):
+                    serializers.logging.error(
+                        serializers.crayons.red(f'Abort: Stage {current.value} did not complete. Rerun to resume.')
+                    )
+                    return
+            clear_journal()
             print(serializers.crayons.green(msg))
             return
 
         print()
-        if stage.value == KubeClusterStages.create.value:
-            print(stage_output)
-            self.create(disable_backups=disable_backups, dry_run=dry_run)
-            self.wait(wait_period=wait_create, reason='Create & Start Cluster VMs')
-        if stage.value == KubeClusterStages.bootstrap.value:
-            print(stage_output)
-            self.executor = self._generate_executor(dry_run=dry_run)
-            self.boostrap_control_plane(dry_run=dry_run)
-            self.wait(wait_period=wait_bootstrap, reason='Bootstrap Control Plane')
-        if stage.value == KubeClusterStages.join.value:
-            print(stage_output)
-            self.executor = self._generate_executor(dry_run=dry_run)
-            self.join_workers(dry_run=dry_run)
-        if stage.value == KubeClusterStages.post_installs.value:
-            print(stage_output)
+        stage_functions = {
+            KubeClusterStages.create.value: create_stage,
+            KubeClusterStages.bootstrap.value: bootstrap_stage,
+            KubeClusterStages.join.value: join_stage,
+            KubeClusterStages.post_installs.value: post_installs_stage
+        }
+        print(stage_output)
+        if stage.value != KubeClusterStages.create.value:
             self.executor = self._generate_executor(dry_run=dry_run)
-            self.post_installs(dry_run=dry_run)
+        # An explicitly requested stage always runs, its outcome is still journaled.
+        self._run_stage(stage, stage_functions[stage.value], replay=False, dry_run=dry_run)
         print(serializers.crayons.green(msg))
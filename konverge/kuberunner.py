@@ -1,12 +1,24 @@
+import os
+import typing
+import threading
+
 from konverge import serializers
+from konverge.cloudinit import FINGERPRINT_TAG_PREFIX
+from konverge.concurrency import ConcurrencyLimits, TaskOutcome, run_concurrently, report_outcomes, mark_failed, thread_log
+from konverge.journal import RunJournal
+
+
+TEMPLATE_LOG_DIRECTORY = os.path.join('.konverge', 'logs')
 
 
 class KubeRunner:
     # TODO: Refactor dry-run blocks if possible.
     allocated_vmids: set = set()
+    allocation_lock = threading.Lock()
 
     def __init__(self, serializer: serializers.ClusterInstanceSerializer):
         self.serializer = serializer
+        self.journal: typing.Union[RunJournal, None] = None
 
     def query(self):
         return self.serializer.query()
@@ -17,20 +29,57 @@ class KubeRunner:
 
     @classmethod
     def set_allocated(cls, vmid):
-        cls.allocated_vmids.add(int(vmid))
+        with cls.allocation_lock:
+            cls.allocated_vmids.add(int(vmid))
 
     @classmethod
     def unset_allocated(cls, vmid):
+        with cls.allocation_lock:
+            cls.allocated_vmids.discard(int(vmid))
+
+    @classmethod
+    def reserve_vmid(cls, instance):
+        """
+        Generate and allocate a vmid atomically, so concurrent clones never share one.
+        """
+        with cls.allocation_lock:
+            vmid, _ = instance.get_vmid_and_username(external=cls.allocated_vmids)
+            if vmid is not None:
+                cls.allocated_vmids.add(int(vmid))
+        return vmid
+
+    def provision(self, instance, disable_backups=False, dry_run=False, start=True):
+        instance.vmid = self.reserve_vmid(instance)
+        if instance.vmid is None:
+            raise RuntimeError(f'No vmid available for {instance.vm_attributes.name} on node {instance.vm_attributes.node}')
+        task = f'clone:{instance.vm_attributes.name}'
+        node = {'node': instance.vm_attributes.node}
+        journal = self.journal if not dry_run else None
+        journal.begin(task, vmid=instance.vmid, data=node) if journal else None
         try:
-            cls.allocated_vmids.remove(int(vmid))
-        except KeyError:
-            pass
+            vmid = instance.execute(start=start, dry_run=dry_run)
+        except Exception as provision_error:
+            self.unset_allocated(instance.vmid)
+            instance.release_reserved_ips() if not dry_run else None
+            journal.fail(task, error=str(provision_error), vmid=instance.vmid) if journal else None
+            raise
+        journal.complete(task, vmid=vmid, ip=instance.allowed_ip, data=node) if journal else None
+        if disable_backups:
+            if dry_run:
+                print(serializers.crayons.blue(f'Disable backup for VM {vmid}: {instance.vm_attributes.name}'))
+            else:
+                instance.disable_backups()
+        return vmid
 
-    def create(self, disable_backups=False, dry_run=False):
+    def pending(self):
+        """
+        Returns (instance, state, index) of instances to be created. Existing instances are skipped.
+        """
         if not self.is_valid:
-            return
+            return []
         exist = self.query()
 
+        pending = []
         for instance in self.serializer.instances:
             state: list = self.serializer.state[instance.vm_attributes.node]
 
@@ -50,19 +99,42 @@ class KubeRunner:
                     serializers.crayons.yellow(f'{instance.vm_attributes.name} exists. Skip create: {member}')
                 )
                 continue
-            instance.vmid, _ = instance.get_vmid_and_username(external=self.allocated_vmids)
-            vmid = instance.execute(start=True, dry_run=dry_run)
-            self.set_allocated(vmid)
-            if disable_backups:
-                if dry_run:
-                    print(serializers.crayons.blue(f'Disable backup for VM {vmid}: {instance.vm_attributes.name}'))
-                else:
-                    instance.disable_backups()
-            state[index] = {
-                'name': instance.vm_attributes.name,
-                'vmid': vmid,
-                'exists': True
-            }
+            pending.append((instance, state, index))
+        return pending
+
+    @staticmethod
+    def record(instance, state, index, vmid):
+        state[index] = {
+            'name': instance.vm_attributes.name,
+            'vmid': vmid,
+            'exists': True
+        }
+
+    def create(self, disable_backups=False, dry_run=False, limits: ConcurrencyLimits = None):
+        """
+        Instances are provisioned concurrently, bounded by limits.global_limit in total
+        and limits.per_node per Proxmox node. Dry-run and default limits run sequentially.
+        Returns a TaskOutcome per provisioned instance.
+        """
+        pending = self.pending()
+        limits = limits if limits and not dry_run else ConcurrencyLimits()
+        outcomes = run_concurrently(
+            [
+                (
+                    instance.vm_attributes.name,
+                    instance.vm_attributes.node,
+                    lambda instance=instance: self.provision(instance, disable_backups=disable_backups, dry_run=dry_run)
+                )
+                for instance, _, _ in pending
+            ],
+            limits=limits
+        )
+        for (instance, state, index), outcome in zip(pending, outcomes):
+            if outcome.ok:
+                self.record(instance, state, index, outcome.result)
+        if outcomes and not limits.sequential:
+            report_outcomes(outcomes, title=f'Provisioning results: {self.serializer.name}')
+        return outcomes
 
     def destroy(self, dry_run=False):
         if not self.query():
@@ -110,30 +182,210 @@ class KubeTemplateRunner(KubeRunner):
             [self.serializer.template_exists(node) for node in self.serializer.nodes]
         ) and self.serializer.hotplug_valid
 
-    def create(self, disable_backups=False, dry_run=False):
+    def build(self, instance, dry_run=False, log_filename=None, golden=None):
+        """
+        Build one template, or replicate it from the golden template.
+        With log_filename, the build output of this thread goes to that file.
+        """
+        build = lambda: instance.replicate(golden, dry_run=dry_run) if golden else instance.execute(
+            kubernetes_version=self.serializer.cluster_attributes.version,
+            docker_version=self.serializer.cluster_attributes.docker,
+            docker_ce=self.serializer.cluster_attributes.docker_ce,
+            dry_run=dry_run,
+            prepull_manifests=self.serializer.prepull_manifests()
+        )
+        if not log_filename:
+            return build()
+        with thread_log(log_filename):
+            return build()
+
+    def golden_template(self):
+        self.serializer: serializers.ClusterTemplateSerializer
+        node = self.serializer.golden_node
+        return next((instance for instance in self.serializer.instances if instance.vm_attributes.node == node), None)
+
+    def build_concurrently(self, instances: list, limits: ConcurrencyLimits, dry_run=False, golden=None):
+        log_filename = lambda node: os.path.join(
+            serializers.settings.WORKDIR, TEMPLATE_LOG_DIRECTORY, f'template-{node}.log'
+        ) if not limits.sequential else None
+        for instance in instances if not limits.sequential else []:
+            print(
+                serializers.crayons.cyan(
+                    f'{"Replicate" if golden else "Build"} template {instance.vm_attributes.name} '
+                    f'on node {instance.vm_attributes.node}. Log: {log_filename(instance.vm_attributes.node)}'
+                )
+            )
+        # A build returns the template vmid, None if any stage failed.
+        return mark_failed(
+            run_concurrently(
+                [
+                    (
+                        instance.vm_attributes.name,
+                        instance.vm_attributes.node,
+                        lambda instance=instance: self.build(
+                            instance, dry_run=dry_run, log_filename=log_filename(instance.vm_attributes.node), golden=golden
+                        )
+                    )
+                    for instance in instances
+                ],
+                limits=limits
+            ),
+            error='Template build failed'
+        )
+
+    def create(self, disable_backups=False, dry_run=False, limits: ConcurrencyLimits = None):
+        """
+        Templates are built concurrently, one per Proxmox node, bounded by limits.templates in total
+        and limits.per_node per node. Concurrent builds log to .konverge/logs/template-<node>.log.
+        In golden mode, only the first node builds its template, all other nodes replicate it.
+        Returns {node: TaskOutcome}.
+        """
         self.serializer: serializers.ClusterTemplateSerializer
         if not self.is_valid:
-            return
+            return {}
 
+        desired = {instance.vm_attributes.node: instance for instance in self.serializer.instances}
+        fingerprints = self.fingerprints()
         exist = self.query()
+        pending = []
+        for index, instance in enumerate(self.serializer.instances):
+            node = instance.vm_attributes.node
+            if self.up_to_date(instance, fingerprints[node], exist, dry_run=dry_run):
+                continue
+            self.serializer.instances[index] = desired[node]
+            pending.append(desired[node])
+
+        golden = self.golden_template()
+        builds = [golden] if golden else pending
+        builds = [instance for instance in builds if instance in pending]
+        replicas = [instance for instance in pending if golden and instance is not golden]
+        if not dry_run:
+            self.prefetch_images(builds)
+
+        limits = limits or ConcurrencyLimits()
+        limits = ConcurrencyLimits(global_limit=1 if dry_run else limits.templates, per_node=limits.per_node)
+        outcomes = self.build_concurrently(builds, limits, dry_run=dry_run)
+        if replicas and all(outcome.ok for outcome in outcomes):
+            outcomes += self.build_concurrently(replicas, limits, dry_run=dry_run, golden=golden)
+        elif replicas:
+            outcomes += [
+                TaskOutcome(
+                    name=instance.vm_attributes.name,
+                    key=instance.vm_attributes.node,
+                    ok=False,
+                    error=f'Golden template {golden.vm_attributes.name} build failed'
+                )
+                for instance in replicas
+            ]
+
+        for instance, outcome in zip(builds + replicas, outcomes):
+            if outcome.ok:
+                self.serializer.state[instance.vm_attributes.node]['exists'] = True
+                self.serializer.state[instance.vm_attributes.node]['vmid'] = outcome.result
+                fingerprint = fingerprints[instance.vm_attributes.node]
+                instance.tag_fingerprint(fingerprint) if fingerprint and not dry_run else None
+        if outcomes and not limits.sequential:
+            report_outcomes(outcomes, title=f'Template build results: {self.serializer.name}')
+        return {outcome.key: outcome for outcome in outcomes}
+
+    def fingerprints(self):
+        """
+        Returns {node: template fingerprint}. Image checksums are looked up once per image.
+        The fingerprint is None (unknown) if the image checksum can neither be fetched nor found in the cache.
+        """
+        checksums = {}
+        fingerprints = {}
         for instance in self.serializer.instances:
             instance: serializers.CloudinitTemplate
-            if exist and self.serializer.template_exists(instance.vm_attributes.node):
+            if instance.full_image_url not in checksums:
+                checksums[instance.full_image_url] = instance.image_checksum()
+            if not checksums[instance.full_image_url]:
                 serializers.logging.warning(
-                    serializers.crayons.yellow(
-                        f'{instance.vm_attributes.name} exists. Skip create: {self.serializer.state[instance.vm_attributes.node]}'
-                    )
+                    serializers.crayons.yellow(f'No checksum for {instance.full_image_url}. Fingerprint of {instance.vm_attributes.name} unknown.')
                 )
+                fingerprints[instance.vm_attributes.node] = None
                 continue
-
-            vmid = instance.execute(
+            fingerprints[instance.vm_attributes.node] = instance.fingerprint(
                 kubernetes_version=self.serializer.cluster_attributes.version,
                 docker_version=self.serializer.cluster_attributes.docker,
                 docker_ce=self.serializer.cluster_attributes.docker_ce,
-                dry_run=dry_run
+                image_checksum=checksums[instance.full_image_url],
+                prepull_manifests=self.serializer.prepull_manifests()
+            )
+        return fingerprints
+
+    def up_to_date(self, instance, fingerprint, exist=True, dry_run=False):
+        """
+        True if the node has a template with this fingerprint: the existing one, or one tagged by another cluster.
+        A template with a different fingerprint is destroyed, to be rebuilt. Untagged templates are kept as they are.
+        With an unknown fingerprint, an existing template is always kept.
+        """
+        node = instance.vm_attributes.node
+        state = self.serializer.state[node]
+        if fingerprint is None:
+            if exist and self.serializer.template_exists(node):
+                serializers.logging.warning(
+                    serializers.crayons.yellow(f'{instance.vm_attributes.name} {instance.vmid} kept: fingerprint unknown.')
+                )
+                return True
+            return False
+        inventory = instance.client.get_vm_inventory()
+        tag = instance.fingerprint_tag(fingerprint)
+        existing = inventory.get(instance.vmid) if exist and self.serializer.template_exists(node) else None
+        tags = inventory.tags(existing) if existing else set()
+
+        if existing and tag in tags:
+            print(serializers.crayons.green(f'{instance.vm_attributes.name} {instance.vmid} is up to date: {fingerprint}'))
+            return True
+        matching = inventory.templates_tagged(tag, node=node)
+        if matching:
+            instance.vmid = int(matching[0].get('vmid'))
+            state['exists'] = True
+            state['vmid'] = instance.vmid
+            print(serializers.crayons.green(f'Reuse template {matching[0].get("name")} {instance.vmid} on node {node}: {fingerprint}'))
+            return True
+        if existing and not any(tag.startswith(FINGERPRINT_TAG_PREFIX) for tag in tags):
+            serializers.logging.warning(
+                serializers.crayons.yellow(f'{instance.vm_attributes.name} exists without fingerprint. Skip create: {state}')
+            )
+            return True
+        if not existing:
+            return False
+
+        serializers.logging.warning(
+            serializers.crayons.yellow(f'{instance.vm_attributes.name} {instance.vmid} is outdated. Rebuild with fingerprint {fingerprint}')
+        )
+        if dry_run:
+            instance.dry_run(destroy=True, instance=False)
+            return False
+        if not instance.wait_for_task(instance.destroy_vm(), operation='Destroy outdated template'):
+            serializers.logging.error(
+                serializers.crayons.red(f'Cannot destroy outdated template {instance.vmid}, e.g. it has linked clones. Keep it.')
+            )
+            return True
+        state['exists'] = False
+        return False
+
+    @staticmethod
+    def prefetch_images(instances: list):
+        """
+        Download each cloud image once to the local cache, then push it to all template nodes in parallel.
+        Nodes that fail fall back to downloading the image themselves, during template create.
+        """
+        images = {}
+        for instance in instances:
+            images.setdefault(instance.full_image_url, []).append(instance)
+        for url, image_instances in images.items():
+            first: serializers.CloudinitTemplate = image_instances[0]
+            image = first.cache_cloudinit_image()
+            if not image:
+                continue
+            serializers.settings.image_cache.distribute(
+                image,
+                first.cloudinit_location,
+                {instance.vm_attributes.node: instance.proxmox_node for instance in image_instances},
+                shared=first.cloudinit_storage_details.get('shared', False)
             )
-            self.serializer.state[instance.vm_attributes.node]['exists'] = True
-            self.serializer.state[instance.vm_attributes.node]['vmid'] = vmid
 
     def destroy(self, dry_run=False):
         self.serializer: serializers.ClusterTemplateSerializer
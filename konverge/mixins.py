@@ -1,8 +1,10 @@
 import os
+import shlex
 import crayons
 import logging
 
-from konverge.pve import VMAPIClient
+from konverge.pve import VMAPIClient, VMConfigBuilder
+from konverge.readiness import VMReadiness, ReadinessDeadlines
 from konverge.utils import (
     VMAttributes,
     FabricWrapper,
@@ -11,11 +13,11 @@ from konverge.utils import (
     get_id_prefix,
     add_ssh_config_entry,
     remove_ssh_config_entry,
-    clear_server_entry,
-    sleep_intervals,
-    LOCAL
+    clear_server_entry
 )
 from konverge import settings
+from konverge.bundle import BUNDLE_REMOTE_DIRECTORY, push_bundle
+from konverge.transfer import send_files
 
 
 class CommonVMMixin:
@@ -62,6 +64,12 @@ class CommonVMMixin:
     def get_vm_config(self):
         return self.client.get_vm_config(node=self.vm_attributes.node, vmid=self.vmid)
 
+    def config_builder(self):
+        """
+        Mixin methods accepting a config builder queue their changes, to be written with a single config.apply().
+        """
+        return VMConfigBuilder(client=self.client, node=self.vm_attributes.node, vmid=self.vmid)
+
     def get_storage_from_config(self, driver):
         config = self.get_vm_config()
         volume = config.get(driver) if config else None
@@ -79,30 +87,42 @@ class CommonVMMixin:
             elif storage_result.get('type') == self.vm_attributes.storage_type.value:
                 return storage_result.get('storage')
 
-    def generate_allowed_ip(self, external: set = None):
-        network = settings.pve_cluster_config_client.get_network_base()
-        loadbalancer = settings.pve_cluster_config_client.loadbalancer_ip_range_to_string_or_list(dash=False)
-        start, end = settings.pve_cluster_config_client.get_allowed_range()
-        allocated = settings.pve_cluster_config_client.get_allocated_ips_from_config(namefilter=self.vm_attributes.node)
+    def collect_allocated_ips(self):
+        allocated = settings.pve_cluster_config_client.get_allocated_ips_from_config()
         # Arp-scan
         allocated.update(self.get_allocated_ips_per_node_interface())
         # Cloudinit allocated, includes stopped vms.
         allocated.update(self.client.get_all_vm_allocated_ips_all_nodes())
         # Include lb range if exists.
-        allocated.update(loadbalancer)
-        allocated.update(external) if external else None
+        allocated.update(settings.pve_cluster_config_client.loadbalancer_ip_range_to_string_or_list(dash=False) or [])
         print(crayons.white(f'All allocated ips: {allocated}'))
+        return allocated
+
+    def generate_allowed_ip(self, external: set = None, owner=None):
+        """
+        Reserve an IP from the workspace ledger. Full rescans only run when the ledger reconciliation is stale.
+        """
+        network = settings.pve_cluster_config_client.get_network_base()
+        start, end = settings.pve_cluster_config_client.get_allowed_range()
+        settings.ip_ledger.reconcile_if_stale(network, self.collect_allocated_ips)
+        return settings.ip_ledger.reserve(
+            network=network,
+            start=start,
+            end=end,
+            owner=owner if owner else self.vm_attributes.name,
+            exclude=external
+        )
+
+    def release_allocated_ips(self):
+        for ip in self.client.get_vm_allocated_ips(node=self.vm_attributes.node, vmid=self.vmid):
+            settings.ip_ledger.release(ip)
 
-        for subnet_ip in range(start, end):
-            generated_ip = f'{network}.{subnet_ip}'
-            if generated_ip in allocated and subnet_ip == end:
-                logging.error(crayons.red(f'Cannot create any more IP addresses in range: {network}.{start} - {network}.{end}'))
-                return None
-            if generated_ip in allocated:
-                logging.warning(crayons.yellow(f'Exists: {generated_ip}'))
-            if generated_ip not in allocated:
-                print(crayons.green(f'Generated IP: {generated_ip}'))
-                return generated_ip
+    def release_reserved_ips(self):
+        """
+        Release the ledger reservations of this VM by owner, without a config lookup: the VM may not exist.
+        """
+        settings.ip_ledger.release_owned(self.vm_attributes.name, f'{self.vm_attributes.name}-secondary')
+        self.allowed_ip = ''
 
     def get_allocated_ips_per_node_interface(self):
         interfaces = self.client.get_cluster_node_bridge_interfaces(self.vm_attributes.node)
@@ -130,12 +150,31 @@ class CommonVMMixin:
         print(crayons.white(f'Allocated running: {allocated_set}'))
         return allocated_set
 
+    def wait_for_task(self, upid, operation='Task'):
+        """
+        Block until the Proxmox task completes. Returns upid on success, None on failure or timeout.
+        Non-task responses pass through unchanged.
+        """
+        result = self.client.tasks.wait(upid)
+        if result is None:
+            return upid
+        if not result.ok:
+            logging.error(
+                crayons.red(f'{operation} VM {self.vm_attributes.name} {self.vmid} failed: {result.exitstatus or result.status}')
+            )
+            return None
+        print(crayons.white(f'{operation} VM {self.vm_attributes.name} {self.vmid} completed in {result.duration:.1f} seconds'))
+        return upid
+
     def create_vm(self):
         pool = self.client.get_or_create_pool(self.vm_attributes.pool)
         print(crayons.cyan(f'Resource pool: {pool}'))
-        created = self.client.create_vm(
-            vm_attributes=self.vm_attributes,
-            vmid=self.vmid
+        created = self.wait_for_task(
+            self.client.create_vm(
+                vm_attributes=self.vm_attributes,
+                vmid=self.vmid
+            ),
+            operation='Create'
         )
         if not self.log_create_delete(created):
             return created
@@ -144,6 +183,7 @@ class CommonVMMixin:
 
     def destroy_vm(self):
         self.remove_ssh_config_entry()
+        self.release_allocated_ips()
         deleted = self.client.destroy_vm(
             node=self.vm_attributes.node,
             vmid=self.vmid
@@ -161,7 +201,16 @@ class CommonVMMixin:
             print(crayons.green(f'{prefix} VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}: Success'))
         return response
 
-    def attach_volume_to_vm(self, volume, root_volume=True, disk_size=5, drive_slot='0'):
+    def attach_volume_to_vm(self, volume, root_volume=True, disk_size=5, drive_slot='0', config: VMConfigBuilder = None):
+        if config:
+            return config.set(
+                **self.client.volume_options(
+                    volume,
+                    scsi=self.vm_attributes.scsi,
+                    disk_size=self.vm_attributes.disk_size if root_volume else disk_size,
+                    drive_slot=drive_slot
+                )
+            )
         return self.client.attach_volume_to_vm(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -171,7 +220,9 @@ class CommonVMMixin:
             drive_slot=drive_slot
         )
 
-    def enable_hotplug(self, hotplug='1'):
+    def enable_hotplug(self, hotplug='1', config: VMConfigBuilder = None):
+        if config:
+            return config.set(hotplug=hotplug)
         return self.client.enable_hotplug(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -185,28 +236,39 @@ class CommonVMMixin:
             disable=True
         )
 
-    def get_unallocated_disk_slots(self):
+    def get_unallocated_disk_slots(self, pending: VMConfigBuilder = None):
+        """
+        Reads the VM config once. Drivers queued in a pending config builder count as allocated.
+        """
         max_drives = 20
         slots = [i for i in range(max_drives)]
+        config = self.get_vm_config() or {}
+        if pending:
+            config = {**config, **pending.options}
         for slot in slots:
             driver = f'scsi{slot}' if self.vm_attributes.scsi else f'virtio{slot}'
-            volume = self.get_storage_from_config(driver)
+            volume = config.get(driver)
             if volume:
                 logging.warning(crayons.yellow(f'Found allocated volume: {driver}'))
             else:
                 print(crayons.green(f'Using Unallocated volume: {driver}'))
                 return slot, driver
 
-    def attach_hotplug_drive(self, disk_size=20):
-        slot, driver = self.get_unallocated_disk_slots()
+    def attach_hotplug_drive(self, disk_size=20, config: VMConfigBuilder = None):
+        slot, driver = self.get_unallocated_disk_slots(pending=config)
         print(crayons.cyan(f'Attaching new volume volume type: {self.storage} on driver: {driver}'))
+        if config:
+            # Proxmox allocates a new volume for STORAGE_ID:SIZE_IN_GiB.
+            return config.set(**{driver: f'{self.storage}:{disk_size}'})
         attach = self.proxmox_node.execute(f'qm set {self.vmid} --{driver} {self.storage}:{disk_size}')
         if attach.failed:
             logging.error(crayons.red(f'Failed to attach {driver} for VM: {self.vmid}'))
             return
         print(crayons.green(f'Attached {driver} for VM: {self.vmid}'))
 
-    def add_cloudinit_drive(self, drive_slot='2'):
+    def add_cloudinit_drive(self, drive_slot='2', config: VMConfigBuilder = None):
+        if config:
+            return config.set(**self.client.cloudinit_drive_options(f'{self.storage}:cloudinit', drive_slot=drive_slot))
         return self.client.add_cloudinit_drive(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -214,7 +276,9 @@ class CommonVMMixin:
             drive_slot=drive_slot
         )
 
-    def set_boot_disk(self):
+    def set_boot_disk(self, config: VMConfigBuilder = None):
+        if config:
+            return config.set(**self.client.boot_disk_options(self.driver, boot=BootMedia.hard_disk))
         return self.client.set_boot_disk(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -222,7 +286,9 @@ class CommonVMMixin:
             driver=self.driver
         )
 
-    def resize_disk(self):
+    def resize_disk(self, config: VMConfigBuilder = None):
+        if config:
+            return config.resize(self.driver, self.vm_attributes.disk_size)
         self.client.resize_disk(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -230,10 +296,12 @@ class CommonVMMixin:
             disk_size=self.vm_attributes.disk_size
         )
 
-    def set_vga_display(self):
+    def set_vga_display(self, config: VMConfigBuilder = None):
         """
         Set VGA display. Many Cloud-Init images rely on this, as it is an requirement for OpenStack images.
         """
+        if config:
+            return config.set(serial0='socket', vga='serial0')
         self.client.update_vm_config(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -255,18 +323,28 @@ class CommonVMMixin:
         if not self.running:
             print(crayons.green(f'VM {self.vmid} is already stopped'))
             return self.vmid
-        return self.client.stop_vm(
-            node=self.vm_attributes.node,
-            vmid=self.vmid
+        return self.wait_for_task(
+            self.client.stop_vm(
+                node=self.vm_attributes.node,
+                vmid=self.vmid
+            ),
+            operation='Stop'
         )
 
     def export_template(self):
-        self.client.export_vm_template(
-            node=self.vm_attributes.node,
-            vmid=self.vmid
+        return self.wait_for_task(
+            self.client.export_vm_template(
+                node=self.vm_attributes.node,
+                vmid=self.vmid
+            ),
+            operation='Export template'
         )
 
-    def inject_cloudinit_values(self, invalidate=False):
+    def inject_cloudinit_values(self, invalidate=False, config: VMConfigBuilder = None):
+        if invalidate and config:
+            options, deleted = self.client.cloudinit_options(ssh_key_content=None, vm_ip=None, gateway=None)
+            config.set(**options).delete(*deleted)
+            return
         if invalidate:
             self.client.inject_vm_cloudinit(
                 node=self.vm_attributes.node,
@@ -289,6 +367,14 @@ class CommonVMMixin:
         gateway = self.vm_attributes.gateway if self.vm_attributes.gateway else settings.pve_cluster_config_client.gateway
 
         print(crayons.blue(f'Inject cloudinit values ipconfig0: ip={self.allowed_ip}, gateway={gateway}, sshkeys: {self.vm_attributes.public_ssh_key}'))
+        if config:
+            options, deleted = self.client.cloudinit_options(
+                ssh_key_content=self.vm_attributes.read_public_key(),
+                vm_ip=self.allowed_ip,
+                gateway=gateway
+            )
+            config.set(**options).delete(*deleted)
+            return
         self.client.inject_vm_cloudinit(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -297,11 +383,13 @@ class CommonVMMixin:
             gateway=gateway
         )
 
-    def attach_iface_to_vm(self):
-        vm_ip = set(self.allowed_ip)
-        secondary_ip = self.generate_allowed_ip(external=vm_ip)
+    def attach_iface_to_vm(self, config: VMConfigBuilder = None):
+        vm_ip = {self.allowed_ip}
+        secondary_ip = self.generate_allowed_ip(external=vm_ip, owner=f'{self.vm_attributes.name}-secondary')
         gateway = self.vm_attributes.gateway if self.vm_attributes.gateway else settings.pve_cluster_config_client.gateway
         print(crayons.blue(f'Inject cloudinit values ipconfig1: ip={secondary_ip}, gateway={gateway} for secondary iface'))
+        if config:
+            return config.set(**self.client.iface_options(iface_ip=secondary_ip, gateway=gateway))
         self.client.attach_iface(
             node=self.vm_attributes.node,
             vmid=self.vmid,
@@ -342,9 +430,16 @@ class CommonVMMixin:
             kubernetes_version='1.16.3-00',
             docker_version='18.09.7',
             docker_ce=False,
-            storageos_requirements=False
+            storageos_requirements=False,
+            prepull_manifests: list = None,
+            bundle=None
     ):
-        local = LOCAL
+        """
+        prepull_manifests: Pull the kubeadm images of kubernetes_version and the images of these manifests
+        into the template. None disables pre-pull.
+        bundle: Local offline package bundle, pushed to the template and installed instead of upstream mirrors.
+        Returns True if the pre-requisites are installed.
+        """
         host = self.vm_attributes.name
         template_host = FabricWrapper(host=host)
         template_host_sudo = FabricWrapper(host=host, sudo=True)
@@ -358,33 +453,49 @@ class CommonVMMixin:
         local_daemon_path = os.path.join(settings.BASE_PATH, f'bootstrap/{daemon_file}')
         remote_path = f'/opt/kube/bootstrap'
         docker_flavour = 'DOCKER_CE=1' if docker_ce else ''
+        prepull = f'PREPULL_IMAGES=1 PREPULL_MANIFESTS={shlex.quote(" ".join(prepull_manifests))}' if prepull_manifests is not None else ''
 
         print(crayons.white(f'Local path: {settings.BASE_PATH}'))
         print(crayons.cyan(f'Copying files {file}, {dashboard_file}, {daemon_file}'))
         template_host_sudo.execute(f'mkdir -p {remote_path}')
         template_host_sudo.execute(f'chown -R $USER:$USER {remote_path}')
-        sent1 = local.run(f'scp {local_path} {host}:{remote_path}')
-        sent2 = local.run(f'scp {local_dashboard_path} {host}:{remote_path}')
-        sent3 = local.run(f'scp {local_daemon_path} {host}:{remote_path}')
-        if not sent1.ok or not sent2.ok or not sent3.ok:
+        sent = send_files(
+            template_host,
+            {
+                local_path: f'{remote_path}/{file}',
+                local_dashboard_path: f'{remote_path}/{dashboard_file}',
+                local_daemon_path: f'{remote_path}/{daemon_file}'
+            }
+        )
+        if not sent:
             logging.error(crayons.red(f'Failed to sent files {file}, {dashboard_file}, {daemon_file}'))
-            return
+            return False
+
+        offline = ''
+        if bundle:
+            print(crayons.cyan(f'Pushing offline package bundle {os.path.basename(bundle)}'))
+            pushed = push_bundle(bundle, {host: template_host_sudo})
+            if pushed[host].ok:
+                offline = f'OFFLINE_BUNDLE={BUNDLE_REMOTE_DIRECTORY}'
+            else:
+                logging.warning(crayons.yellow(f'Offline bundle push to {host} failed. Installing from upstream mirrors.'))
 
         print(crayons.blue(f'Installing kubectl, kubeadm, kubelet & docker CR on {host}.'))
         print(crayons.cyan(f'Kubernetes Version: {kubernetes_version}. Docker Version: {docker_version}'))
         template_host.execute(f'chmod +x {remote_path}/{file}')
         installed = template_host.execute(
-            f'DAEMON_JSON_LOCATION={remote_path} KUBE_VERSION={kubernetes_version} DOCKER_VERSION={docker_version} {docker_flavour} {remote_path}/{file}',
+            f'DAEMON_JSON_LOCATION={remote_path} KUBE_VERSION={kubernetes_version} DOCKER_VERSION={docker_version} {docker_flavour} {prepull} {offline} {remote_path}/{file}',
             warn=True
         )
         if installed.ok:
             print(crayons.green(f'Installed pre-requisites on {host}'))
         else:
             logging.error(crayons.red(f'Pre-requisites on {host} failed to install.'))
-            return
+            return False
 
         if storageos_requirements:
             self.install_storageos_requirements()
+        return True
 
     def install_storageos_requirements(self):
         pass
@@ -424,28 +535,39 @@ class ExecuteStagesMixin:
     vm_attributes: VMAttributes
     vmid: str
     start_vm: callable
+    wait_for_task: callable
     stop_vm: callable
     inject_cloudinit_values: callable
     remove_ssh_config_entry: callable
 
     def start_stage(self, cloudinit=False, wait_minutes=4):
-        wait_period = wait_minutes * 60
-        sleep_interval = 5
-
+        """
+        wait_minutes: Deadline for the VM to accept SSH connections. 0 returns right after start.
+        Returns True once the VM is ready.
+        """
         print(crayons.cyan(f'Stage: Start VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
         if cloudinit:
             self.inject_cloudinit_values()
 
         started = self.start_vm()
+        if started and wait_minutes:
+            started = self.wait_for_task(started, operation='Start')
         if started:
             print(crayons.green(f'Start VM {self.vm_attributes.name} {self.vmid}: Success'))
         else:
             logging.error(crayons.red(f'VM {self.vm_attributes.name} {self.vmid} failed to start'))
-            return
+            return False
+        if not wait_minutes:
+            return True
 
-        print(crayons.cyan(f'Stage: Waiting {wait_period / 60} minutes, for VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node} to initialize.'))
-        sleep_intervals(wait_period=wait_period, sleep_interval=sleep_interval)
-        print(crayons.green(f'VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node} initialized.'))
+        print(crayons.cyan(f'Stage: Waiting up to {wait_minutes} minutes, for VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node} to initialize.'))
+        readiness = VMReadiness.from_instance(
+            self,
+            deadlines=ReadinessDeadlines(ssh=wait_minutes * 60)
+        ).wait()
+        if readiness.ready:
+            print(crayons.green(f'VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node} initialized.'))
+        return readiness.ready
 
     def stop_stage(self, cloudinit=False):
         print(crayons.cyan(f'Stage: Stop VM {self.vm_attributes.name} {self.vmid} on node {self.vm_attributes.node}'))
@@ -1,6 +1,11 @@
+import re
 import logging
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import NamedTuple
 
 import crayons
 
@@ -14,12 +19,265 @@ from konverge.utils import (
     FORMATS,
     VMAttributes,
     BootMedia,
-    BackupMode
+    BackupMode,
+    timed
 )
 
 
+METADATA_CACHE_TTL = 30
+TASK_TIMEOUT = 600
+TASK_POLL_INITIAL = 0.5
+TASK_POLL_MAX = 5
+IP_SCAN_WORKERS = 8
+
+
+class MetadataCache:
+    """
+    TTL-bounded cache for cluster metadata listings (nodes, storages, pools).
+    Shared between API clients, keys are namespaced by the Proxmox host.
+    """
+    def __init__(self, ttl=METADATA_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = fetch()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, *prefix):
+        """
+        Drop all entries whose key starts with prefix. No prefix clears the cache.
+        """
+        with self._lock:
+            if not prefix:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[:len(prefix)] == prefix]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+                'hit_ratio': round(self.hits / total, 2) if total else 0.0
+            }
+
+
+metadata_cache = MetadataCache()
+
+
+class VMInventory:
+    """
+    Immutable snapshot of cluster/resources?type=vm, indexed by vmid, name, node, pool and template flag.
+    """
+    def __init__(self, vms: list):
+        self.created = time.monotonic()
+        self.vms = tuple(MappingProxyType(dict(vm)) for vm in vms)
+        by_vmid = {}
+        by_name = {}
+        by_node = {}
+        by_pool = {}
+        for vm in self.vms:
+            by_vmid[int(vm.get('vmid'))] = vm
+            by_name.setdefault(vm.get('name'), []).append(vm)
+            by_node.setdefault(vm.get('node'), []).append(vm)
+            by_pool.setdefault(vm.get('pool'), []).append(vm)
+        self._by_vmid = MappingProxyType(by_vmid)
+        self._by_name = MappingProxyType({key: tuple(value) for key, value in by_name.items()})
+        self._by_node = MappingProxyType({key: tuple(value) for key, value in by_node.items()})
+        self._by_pool = MappingProxyType({key: tuple(value) for key, value in by_pool.items()})
+        self.templates = tuple(vm for vm in self.vms if self.is_template(vm))
+        self.instances = tuple(vm for vm in self.vms if not self.is_template(vm))
+
+    def __len__(self):
+        return len(self.vms)
+
+    @staticmethod
+    def is_template(vm):
+        return vm.get('template') == 1
+
+    @staticmethod
+    def tags(vm):
+        """
+        Proxmox returns tags as one string, separated by ';' (or ',' on older releases).
+        """
+        return set(tag for tag in re.split(r'[;,\s]+', vm.get('tags') or '') if tag)
+
+    def templates_tagged(self, tag, node=None):
+        return [
+            template for template in self.templates
+            if tag in self.tags(template) and (node is None or template.get('node') == node)
+        ]
+
+    @property
+    def vmids(self):
+        return frozenset(self._by_vmid.keys())
+
+    def get(self, vmid):
+        return self._by_vmid.get(int(vmid)) if vmid is not None else None
+
+    def by_name(self, name):
+        return self._by_name.get(name, ())
+
+    def by_node(self, node):
+        return self._by_node.get(node, ())
+
+    def by_pool(self, pool):
+        return self._by_pool.get(pool, ())
+
+    def split(self, vms=None):
+        vms = self.vms if vms is None else vms
+        return {
+            'templates': [vm for vm in vms if self.is_template(vm)],
+            'instances': [vm for vm in vms if not self.is_template(vm)]
+        }
+
+
+class TaskResult(NamedTuple):
+    upid: str
+    node: str
+    status: str
+    exitstatus: str = None
+    duration: float = 0.0
+
+    @property
+    def ok(self):
+        return self.status == 'stopped' and self.exitstatus == 'OK'
+
+    @property
+    def timed_out(self):
+        return self.status != 'stopped'
+
+
+class ProxmoxTaskTracker:
+    """
+    Polls nodes/{node}/tasks/{upid}/status with adaptive backoff:
+    the poll interval starts at initial_interval and grows up to max_interval while tasks are running.
+    Mutating API calls register their UPIDs, so callers can wait on everything issued so far.
+    Callbacks in on_complete run after a wait in which at least one task finished.
+    """
+    def __init__(self, client: ProxmoxAPI, initial_interval=TASK_POLL_INITIAL, max_interval=TASK_POLL_MAX):
+        self.client = client
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.on_complete = []
+
+    @staticmethod
+    def is_upid(value):
+        return isinstance(value, str) and value.startswith('UPID:')
+
+    @staticmethod
+    def parse_node(upid):
+        """
+        UPID format: UPID:{node}:{pid}:{pstart}:{starttime}:{type}:{id}:{user}:
+        """
+        return upid.split(':')[1]
+
+    def register(self, upid):
+        """
+        Track upid if the response is a task id. Returns the response unchanged.
+        """
+        if self.is_upid(upid):
+            with self._lock:
+                self._pending[upid] = time.monotonic()
+        return upid
+
+    @property
+    def pending(self):
+        with self._lock:
+            return list(self._pending.keys())
+
+    def status(self, upid):
+        return self.client.nodes(self.parse_node(upid)).tasks(upid).status.get()
+
+    def _poll(self, upid, started):
+        try:
+            status = self.status(upid)
+        except ResourceException as status_error:
+            logging.warning(crayons.yellow(f'Task status unavailable for {upid}: {status_error}'))
+            return None
+        if status.get('status') != 'stopped':
+            return None
+        return TaskResult(
+            upid=upid,
+            node=self.parse_node(upid),
+            status='stopped',
+            exitstatus=status.get('exitstatus'),
+            duration=time.monotonic() - started
+        )
+
+    def wait_all(self, upids, timeout=TASK_TIMEOUT):
+        """
+        Wait for all tasks concurrently, in a single polling loop.
+        Returns {upid: TaskResult}. Tasks still running after timeout have a 'running' status.
+        """
+        upids = [upid for upid in upids if self.is_upid(upid)]
+        with self._lock:
+            started = {upid: self._pending.get(upid, time.monotonic()) for upid in upids}
+        results = {}
+        interval = self.initial_interval
+        deadline = time.monotonic() + timeout
+        while len(results) < len(upids):
+            for upid in upids:
+                if upid in results:
+                    continue
+                result = self._poll(upid, started[upid])
+                if result:
+                    results[upid] = result
+            if len(results) == len(upids) or time.monotonic() >= deadline:
+                break
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+            interval = min(interval * 2, self.max_interval)
+
+        for upid in upids:
+            if upid not in results:
+                logging.error(crayons.red(f'Task {upid} did not complete within {timeout} seconds.'))
+                results[upid] = TaskResult(
+                    upid=upid,
+                    node=self.parse_node(upid),
+                    status='running',
+                    duration=time.monotonic() - started[upid]
+                )
+            elif not results[upid].ok:
+                logging.error(crayons.red(f'Task {upid} failed: {results[upid].exitstatus}'))
+        with self._lock:
+            for upid, result in results.items():
+                if not result.timed_out:
+                    self._pending.pop(upid, None)
+        if any(not result.timed_out for result in results.values()):
+            for callback in self.on_complete:
+                callback()
+        return results
+
+    def wait(self, upid, timeout=TASK_TIMEOUT):
+        if not self.is_upid(upid):
+            return None
+        return self.wait_all([upid], timeout=timeout).get(upid)
+
+    def wait_pending(self, timeout=TASK_TIMEOUT):
+        return self.wait_all(self.pending, timeout=timeout)
+
+
 class ProxmoxAPIClient:
-    def __init__(self, host, user, password, backend='https', verify_ssl=False):
+    def __init__(self, host, user, password, backend='https', verify_ssl=False, cache: MetadataCache = None):
+        self.host = host
         self.client = ProxmoxAPI(
             host=host,
             user=user,
@@ -27,6 +285,21 @@ class ProxmoxAPIClient:
             backend=backend,
             verify_ssl=verify_ssl
         )
+        self.cache = cache if cache else metadata_cache
+        self.tasks = ProxmoxTaskTracker(self.client)
+
+    def _cached(self, resource, fetch, *args):
+        return self.cache.get_or_fetch((self.host, resource, *args), fetch)
+
+    def invalidate_metadata(self, resource=None):
+        if resource:
+            self.cache.invalidate(self.host, resource)
+            return
+        self.cache.invalidate(self.host)
+
+    @property
+    def cache_stats(self):
+        return self.cache.stats()
 
     @staticmethod
     def api_client_factory(instance_type='vm'):
@@ -36,10 +309,14 @@ class ProxmoxAPIClient:
         }
         return types.get(instance_type)
 
+    def _get_all_resource_pools_verbose(self):
+        return self._cached('pools', self.client.pools.get)
+
     def get_resource_pools(self, poolid=None):
+        pools = self._get_all_resource_pools_verbose()
         if poolid:
-            return [pool.get('poolid') for pool in self.client.pools.get() if pool.get('poolid') == poolid][0]
-        return [pool.get('poolid') for pool in self.client.pools.get()]
+            return [pool.get('poolid') for pool in pools if pool.get('poolid') == poolid][0]
+        return [pool.get('poolid') for pool in pools]
 
     def get_pool_members(self, poolid):
         if self.get_resource_pools(poolid=poolid):
@@ -49,10 +326,11 @@ class ProxmoxAPIClient:
         if not name or (name in self.get_resource_pools()):
             return name
         self.client.pools.create(poolid=name)
+        self.invalidate_metadata('pools')
         return self.get_resource_pools(name)
 
     def get_cluster_nodes(self, node=None, verbose=False):
-        nodes = self.client.cluster.resources.get(type='node')
+        nodes = self._cached('nodes', lambda: self.client.cluster.resources.get(type='node'))
         if verbose:
             return nodes
 
@@ -140,8 +418,12 @@ class ProxmoxAPIClient:
 
     def _get_all_cluster_storage_verbose(self, storage_type: Storage = None):
         if not storage_type:
-            return self.client.storage.get()
-        return self.client.storage.get(type=storage_type.value)
+            return self._cached('storage', self.client.storage.get)
+        return self._cached(
+            'storage',
+            lambda: self.client.storage.get(type=storage_type.value),
+            storage_type.value
+        )
 
     def get_cluster_storage(self, storage_type: Storage = None, verbose=False):
         storages = self._get_all_cluster_storage_verbose(storage_type=storage_type)
@@ -173,7 +455,8 @@ class ProxmoxAPIClient:
         return {
             'name': storage_details.get('storage'),
             'path': path,
-            'content': content
+            'content': content,
+            'shared': bool(storage_details.get('shared'))
         }
 
     def get_storage_content_items(self, node, storage_type: Storage = None, verbose=False):
@@ -193,9 +476,36 @@ class ProxmoxAPIClient:
 
 
 class VMAPIClient(ProxmoxAPIClient):
+    def __init__(self, host, user, password, backend='https', verify_ssl=False, cache: MetadataCache = None):
+        super().__init__(host, user, password, backend=backend, verify_ssl=verify_ssl, cache=cache)
+        self._inventory = None
+        self._inventory_lock = threading.Lock()
+        self.tasks.on_complete.append(self.invalidate_vm_inventory)
+
+    def get_vm_inventory(self, refresh=False):
+        """
+        Shared VM snapshot. Fetched once, refreshed lazily after a mutating operation.
+        """
+        with self._inventory_lock:
+            if refresh or self._inventory is None:
+                vms = self.get_cluster_vms(verbose=True)
+                self._inventory = VMInventory([vm for vm in vms if vm.get('type', 'qemu') == 'qemu'])
+            return self._inventory
+
+    def invalidate_vm_inventory(self):
+        with self._inventory_lock:
+            self._inventory = None
+
+    def _mutated(self, upid):
+        """
+        Register the task of a mutating call. The inventory is dropped once the call has returned, and again when the task completes.
+        """
+        self.invalidate_vm_inventory()
+        return self.tasks.register(upid)
+
     def create_vm(self, vm_attributes: VMAttributes, vmid):
         node_resource = self._get_single_node_resource(vm_attributes.node)
-        return self.client.nodes(node_resource['name']).qemu.create(
+        return self._mutated(self.client.nodes(node_resource['name']).qemu.create(
             vmid=vmid,
             acpi=1,
             agent=1,
@@ -210,27 +520,27 @@ class VMAPIClient(ProxmoxAPIClient):
             cores=vm_attributes.cpus,
             storage=self.get_cluster_storage(storage_type=vm_attributes.storage_type)[0].get('name'),
             net0=f'model=virtio,bridge=vmbr0,firewall=1'
-        )
+        ))
 
     def start_vm(self, node, vmid):
         node_resource = self._get_single_node_resource(node)
-        return self.client.nodes(node_resource['name']).qemu(vmid).status.start.post()
+        return self._mutated(self.client.nodes(node_resource['name']).qemu(vmid).status.start.post())
 
     def shutdown_vm(self, node, vmid, timeout=20):
         node_resource = self._get_single_node_resource(node)
-        return self.client.nodes(node_resource['name']).qemu(vmid).status.shutdown.post(timeout=timeout)
+        return self._mutated(self.client.nodes(node_resource['name']).qemu(vmid).status.shutdown.post(timeout=timeout))
 
     def stop_vm(self, node, vmid, timeout=20):
         node_resource = self._get_single_node_resource(node)
-        return self.client.nodes(node_resource['name']).qemu(vmid).status.stop.post(timeout=timeout)
+        return self._mutated(self.client.nodes(node_resource['name']).qemu(vmid).status.stop.post(timeout=timeout))
 
     def destroy_vm(self, node, vmid):
         node_resource = self._get_single_node_resource(node)
-        return self.client.nodes(node_resource['name']).qemu(vmid).delete()
+        return self._mutated(self.client.nodes(node_resource['name']).qemu(vmid).delete())
 
     def export_vm_template(self, node, vmid):
         node_resource = self._get_single_node_resource(node)
-        self.client.nodes(node_resource['name']).qemu(vmid).template.post()
+        return self._mutated(self.client.nodes(node_resource['name']).qemu(vmid).template.post())
 
     @retry(retry_on_exception=ResourceException, wait_exponential_multiplier=1000, wait_exponential_max=10000)
     def clone_vm_from_template(
@@ -243,11 +553,13 @@ class VMAPIClient(ProxmoxAPIClient):
             pool='',
             full=False,
             storage: Storage = None,
-            storage_format: StorageFormat = StorageFormat.raw
+            storage_format: StorageFormat = StorageFormat.raw,
+            target=None
     ):
         """
         Parameter full creates a full disk clone of VM. For templates default is False: creates a linked clone.
         Full is used when instance storage is different to template storage.
+        Parameter target clones to another node. Proxmox allows it only for VMs on shared storage.
         """
         node_resource = self._get_single_node_resource(node)
         qemu_instance = self.client.nodes(node_resource['name']).qemu(source_vmid)
@@ -267,21 +579,33 @@ class VMAPIClient(ProxmoxAPIClient):
                 logging.error(crayons.red(f'Storage {storage.value} not found in PVE Cluster.'))
                 return None
 
-            return qemu_instance.clone.create(
+            return self._mutated(qemu_instance.clone.create(
                 newid=target_vmid,
                 name=name,
                 description=description,
                 pool=pool,
                 full='1',
                 storage=storage_name,
-                format=valid_format.value
-            )
-        return qemu_instance.clone.create(
+                format=valid_format.value,
+                **({'target': target} if target else {})
+            ))
+        return self._mutated(qemu_instance.clone.create(
             newid=target_vmid,
             name=name,
             description=description,
-            pool=pool
-        )
+            pool=pool,
+            **({'target': target} if target else {})
+        ))
+
+    def migrate_vm(self, node, vmid, target, online=False):
+        """
+        Migrate a VM to node target. Offline migration copies local disks too.
+        """
+        node_resource = self._get_single_node_resource(node)
+        return self._mutated(self.client.nodes(node_resource['name']).qemu(vmid).migrate.post(
+            target=target,
+            online=int(online)
+        ))
 
     def backup_vm(
             self,
@@ -306,18 +630,18 @@ class VMAPIClient(ProxmoxAPIClient):
             logging.error(crayons.red(f'Vmid missing and parameter "all" not specified.'))
             return None
         if all_vms:
-            return self.client.nodes(node_resource['name']).vzdump.create(
+            return self.tasks.register(self.client.nodes(node_resource['name']).vzdump.create(
                 all='1',
                 mode=backup_mode.value,
                 storage=storage,
                 remove= '1' if remove else '0'
-            )
-        return self.client.nodes(node_resource['name']).vzdump.create(
+            ))
+        return self.tasks.register(self.client.nodes(node_resource['name']).vzdump.create(
             vmid=vmid,
             mode=backup_mode.value,
             storage=storage,
             remove= '1' if remove else '0'
-        )
+        ))
 
     def get_vm_config(self, node, vmid, current=True):
         current_values = int(current)
@@ -347,31 +671,62 @@ class VMAPIClient(ProxmoxAPIClient):
             hotplug='0' if disable else hotplug
         )
 
+    @staticmethod
+    def iface_options(iface_ip, gateway, netmask='24'):
+        return {
+            'net1': f'model=virtio,bridge=vmbr0,firewall=1',
+            'ipconfig1': f'ip={iface_ip}/{netmask},gw={gateway}'
+        }
+
+    @staticmethod
+    def volume_options(volume, scsihw='virtio-scsi-pci', scsi=False, disk_size=5, drive_slot='0'):
+        drive = f'scsi{drive_slot}' if scsi else f'virtio{drive_slot}'
+        return {
+            'scsihw': scsihw,
+            drive: f'file={volume},size={disk_size}G'
+        }
+
+    @staticmethod
+    def cloudinit_drive_options(storage_name, drive_slot=2):
+        return {f'ide{drive_slot}': storage_name}
+
+    @staticmethod
+    def boot_disk_options(driver, boot: BootMedia = BootMedia.hard_disk):
+        return {
+            'boot': boot.value,
+            'bootdisk': driver
+        }
+
+    @staticmethod
+    def cloudinit_options(ssh_key_content, vm_ip, gateway, netmask='24'):
+        """
+        Returns (options, deleted keys) for cloudinit sshkeys and ipconfig0.
+        """
+        if ssh_key_content and vm_ip and gateway:
+            return {
+                'sshkeys': urllib.parse.quote(ssh_key_content, safe=''),
+                'ipconfig0': f'ip={vm_ip}/{netmask},gw={gateway}'
+            }, []
+        if ssh_key_content and (not vm_ip or not gateway):
+            return {'sshkeys': urllib.parse.quote(ssh_key_content, safe='')}, ['ipconfig0']
+        return {}, ['sshkeys', 'ipconfig0']
+
     @retry(retry_on_exception=ResourceException, wait_exponential_multiplier=1000, wait_exponential_max=10000)
     def attach_iface(self, node, vmid, iface_ip, gateway, netmask='24'):
         return self.update_vm_config(
             node=node,
             vmid=vmid,
             storage_operation=True,
-            net1=f'model=virtio,bridge=vmbr0,firewall=1',
-            ipconfig1=f'ip={iface_ip}/{netmask},gw={gateway}'
+            **self.iface_options(iface_ip, gateway, netmask=netmask)
         )
 
     @retry(retry_on_exception=ResourceException, wait_exponential_multiplier=1000, wait_exponential_max=10000)
     def attach_volume_to_vm(self, node, vmid, volume, scsihw='virtio-scsi-pci', scsi=False, disk_size=5, drive_slot='0'):
-        volume_details = f'file={volume},size={disk_size}G'
         return self.update_vm_config(
             node=node,
             vmid=vmid,
             storage_operation=True,
-            scsihw=scsihw,
-            **{f'scsi{drive_slot}': volume_details}
-        ) if scsi else self.update_vm_config(
-            node=node,
-            vmid=vmid,
-            storage_operation=True,
-            scsihw=scsihw,
-            **{f'virtio{drive_slot}': volume_details}
+            **self.volume_options(volume, scsihw=scsihw, scsi=scsi, disk_size=disk_size, drive_slot=drive_slot)
         )
 
     def add_cloudinit_drive(self, node, vmid, storage_name, drive_slot=2):
@@ -379,7 +734,7 @@ class VMAPIClient(ProxmoxAPIClient):
             node=node,
             vmid=vmid,
             storage_operation=True,
-            **{f'ide{drive_slot}': storage_name}
+            **self.cloudinit_drive_options(storage_name, drive_slot=drive_slot)
         )
 
     def set_boot_disk(self, node, vmid, driver, boot: BootMedia = BootMedia.hard_disk):
@@ -387,8 +742,7 @@ class VMAPIClient(ProxmoxAPIClient):
             node=node,
             vmid=vmid,
             storage_operation=True,
-            boot=boot.value,
-            bootdisk=driver
+            **self.boot_disk_options(driver, boot=boot)
         )
 
     def disable_backups(self, node, vmid, scsi=False, drive_slot=0):
@@ -418,65 +772,113 @@ class VMAPIClient(ProxmoxAPIClient):
         )
 
     def inject_vm_cloudinit(self, node, vmid, ssh_key_content, vm_ip, gateway, netmask='24'):
-        if ssh_key_content and vm_ip and gateway:
-            self.update_vm_config(
-                node=node,
-                vmid=vmid,
-                sshkeys=urllib.parse.quote(ssh_key_content, safe=''),
-                ipconfig0=f'ip={vm_ip}/{netmask},gw={gateway}'
-            )
-            return
-        if ssh_key_content and (not vm_ip or not gateway):
-            self.update_vm_config(
-                node=node,
-                vmid=vmid,
-                sshkeys=urllib.parse.quote(ssh_key_content, safe=''),
-                delete='ipconfig0'
-            )
-            return
+        options, deleted = self.cloudinit_options(ssh_key_content, vm_ip, gateway, netmask=netmask)
+        if deleted:
+            options['delete'] = ','.join(deleted)
         self.update_vm_config(
             node=node,
             vmid=vmid,
-            delete='sshkeys,ipconfig0'
+            **options
         )
 
-    def get_ip_config_from_vm_cloudinit(self, node, vmid, ipconfig_slot=0):
-        config = self.get_vm_config(node, vmid, current=False)
-        ip_config = config.get(f'ipconfig{ipconfig_slot}')
+    @staticmethod
+    def parse_ip_config(config: dict, ipconfig_slot=0):
+        """
+        Parse the comma separated key=value pairs of ipconfigN, e.g. ip=10.0.0.5/24,gw=10.0.0.1,ip6=auto.
+        The address is None for ip=dhcp or without an ip= key.
+        """
+        ip_config = config.get(f'ipconfig{ipconfig_slot}') if config else None
 
         if not ip_config or not ip_config.strip():
             return None, None, None
 
-        ip, gw = ip_config.split(',')
-        ip_address, netmask = ip.split('/')
-        ip_address = ip_address.split('=')[-1]
-        gateway = gw.split('=')[-1]
-        return ip_address, netmask, gateway
+        options = dict(
+            option.strip().split('=', 1) for option in ip_config.split(',') if '=' in option
+        )
+        gateway = options.get('gw')
+        ip = options.get('ip')
+        if not ip or ip == 'dhcp':
+            return None, None, gateway
+        ip_address, _, netmask = ip.partition('/')
+        return ip_address, netmask or None, gateway
+
+    def get_ip_config_from_vm_cloudinit(self, node, vmid, ipconfig_slot=0):
+        config = self.get_vm_config(node, vmid, current=False)
+        return self.parse_ip_config(config, ipconfig_slot=ipconfig_slot)
 
-    def get_all_vm_allocated_ips_all_nodes(self):
+    def get_vm_allocated_ips(self, node, vmid):
+        """
+        All cloudinit ipconfig0..N addresses of a VM, parsed from a single config fetch.
+        """
+        config = self.get_vm_config(node, vmid, current=False)
+        if not config:
+            return set()
         allocated = set()
-        try:
-            nodes = self.get_cluster_nodes()
-        except Exception as disconnected:
-            logging.warning(crayons.yellow(disconnected))
-            time.sleep(5)
-            nodes = self.get_cluster_nodes()
-
-        for node_instance in nodes:
-            node = node_instance.get('name')
-            vms = self.get_cluster_vms(node)
-            if not vms:
+        for key in config:
+            if not key.startswith('ipconfig'):
                 continue
-            for vm in vms:
-                ipconfig0 = self.get_ip_config_from_vm_cloudinit(node=node, vmid=vm.get('vmid'), ipconfig_slot=0)
-                ipconfig1 = self.get_ip_config_from_vm_cloudinit(node=node, vmid=vm.get('vmid'), ipconfig_slot=1)
-                allocated.add(ipconfig0[0])
-                allocated.add(ipconfig1[0])
+            ip_address, _, _ = self.parse_ip_config(config, ipconfig_slot=key[len('ipconfig'):])
+            if ip_address:
+                allocated.add(ip_address)
+        return allocated
 
-        allocated.remove(None)
+    def get_all_vm_allocated_ips_all_nodes(self, max_workers=IP_SCAN_WORKERS):
+        with timed('Cloudinit allocated ips scan'):
+            try:
+                inventory = self.get_vm_inventory(refresh=True)
+            except Exception as disconnected:
+                logging.warning(crayons.yellow(disconnected))
+                time.sleep(5)
+                inventory = self.get_vm_inventory(refresh=True)
+
+            allocated = set()
+            if len(inventory):
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(inventory))) as pool:
+                    futures = [
+                        pool.submit(self.get_vm_allocated_ips, node=vm.get('node'), vmid=vm.get('vmid'))
+                        for vm in inventory.vms
+                    ]
+                    for future in futures:
+                        allocated.update(future.result())
+        print(crayons.white(f'Cloudinit allocated ips: {allocated}'))
+        return frozenset(allocated)
+
+    def get_all_vm_allocated_ips_all_nodes_serial(self):
+        """
+        Sequential scan, two config fetches per VM. Kept for timing comparison.
+        """
+        allocated = set()
+        with timed('Cloudinit allocated ips scan (serial)'):
+            try:
+                nodes = self.get_cluster_nodes()
+            except Exception as disconnected:
+                logging.warning(crayons.yellow(disconnected))
+                time.sleep(5)
+                nodes = self.get_cluster_nodes()
+
+            for node_instance in nodes:
+                node = node_instance.get('name')
+                vms = self.get_cluster_vms(node)
+                if not vms:
+                    continue
+                for vm in vms:
+                    ipconfig0 = self.get_ip_config_from_vm_cloudinit(node=node, vmid=vm.get('vmid'), ipconfig_slot=0)
+                    ipconfig1 = self.get_ip_config_from_vm_cloudinit(node=node, vmid=vm.get('vmid'), ipconfig_slot=1)
+                    allocated.add(ipconfig0[0])
+                    allocated.add(ipconfig1[0])
+
+        allocated.discard(None)
         print(crayons.white(f'Cloudinit allocated ips: {allocated}'))
         return allocated
 
+    def agent_ping(self, node, vmid):
+        node_resource = self._get_single_node_resource(node)
+        try:
+            self.client.nodes(node_resource['name']).qemu(vmid).agent.ping.post()
+            return True
+        except ResourceException:
+            return False
+
     def agent_get_interfaces(self, node, vmid, verbose=False, filter_lo=True):
         node_resource = self._get_single_node_resource(node)
         try:
@@ -500,5 +902,65 @@ class VMAPIClient(ProxmoxAPIClient):
         return filtered if filter_lo else stripped
 
 
+class VMConfigBuilder:
+    """
+    Collects pending config changes of a single VM.
+    apply() writes them with one config POST, waits for its task, then runs the disk resizes,
+    which Proxmox only exposes through a separate endpoint.
+    """
+    def __init__(self, client: VMAPIClient, node, vmid):
+        self.client = client
+        self.node = node
+        self.vmid = vmid
+        self.options = {}
+        self.deleted = []
+        self.resizes = {}
+
+    @property
+    def pending(self):
+        return bool(self.options or self.deleted or self.resizes)
+
+    def set(self, **options):
+        for key in options:
+            if key in self.deleted:
+                self.deleted.remove(key)
+        self.options.update(options)
+        return self
+
+    def delete(self, *keys):
+        for key in keys:
+            self.options.pop(key, None)
+            if key not in self.deleted:
+                self.deleted.append(key)
+        return self
+
+    def resize(self, driver, disk_size):
+        self.resizes[driver] = disk_size
+        return self
+
+    def apply(self):
+        if not self.pending:
+            return None
+        response = None
+        if self.options or self.deleted:
+            options = dict(self.options)
+            if self.deleted:
+                options['delete'] = ','.join(self.deleted)
+            print(crayons.white(f'Update VM {self.vmid} config: {", ".join(sorted(options.keys()))}'))
+            response = self.client.update_vm_config(
+                node=self.node,
+                vmid=self.vmid,
+                storage_operation=True,
+                **options
+            )
+            result = self.client.tasks.wait(response)
+            if result is not None and not result.ok:
+                raise RuntimeError(f'Update VM {self.vmid} config failed: {result.exitstatus or result.status}')
+        for driver, disk_size in self.resizes.items():
+            self.client.resize_disk(node=self.node, vmid=self.vmid, driver=driver, disk_size=disk_size)
+        self.options, self.deleted, self.resizes = {}, [], {}
+        return response
+
+
 class LXCAPIClient(ProxmoxAPIClient):
     pass
\ No newline at end of file
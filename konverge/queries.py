@@ -1,10 +1,15 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import crayons
+
 from konverge.utils import (
     VMAttributes,
     human_readable_disk_size,
     Storage,
     get_id_prefix
 )
-from konverge.pve import VMAPIClient
+from konverge.pve import VMAPIClient, VMInventory
 from konverge.settings import node_scale
 from konverge.cloudinit import CloudinitTemplate
 from konverge.instance import InstanceClone
@@ -30,15 +35,14 @@ class VMQuery:
         self.find_name = lambda vm: self.name in self.reverse_name_from_vmid(vm)
         self.match_pool = lambda vm: self.pool == vm.get('pool')
 
+    @property
+    def inventory(self):
+        return self.client.get_vm_inventory()
+
     @property
     def all_vms(self):
-        all_instances = [vm for vm in self.client.get_cluster_vms(node=self.node, verbose=True)]
-        templates = filter(self.is_template, all_instances)
-        instances = filter(self.is_instance, all_instances)
-        return {
-            'templates': list(templates),
-            'instances': list(instances)
-        }
+        inventory = self.inventory
+        return inventory.split(inventory.by_node(self.node)) if self.node else inventory.split()
 
     @staticmethod
     def reverse_name_from_vmid(vm: dict):
@@ -61,17 +65,18 @@ class VMQuery:
                 return Storage.return_value(storage.get('type'))
 
     def get_vm(self, template=False):
-        vms = self.all_vms.get('templates') if template else self.all_vms.get('instances')
-        for vm in vms:
-            if int(vm.get('vmid')) == int(self.vmid):
-                return vm
+        vm = self.inventory.get(self.vmid)
+        if not vm or (self.node and vm.get('node') != self.node):
+            return None
+        return vm if self.is_template(vm) == template else None
 
     def filter_vms_by_name(self):
+        all_vms = self.all_vms
         if not self.name:
-            return self.all_vms
+            return all_vms
 
-        templates = filter(self.find_name, self.all_vms.get('templates'))
-        instances = filter(self.find_name, self.all_vms.get('instances'))
+        templates = filter(self.find_name, all_vms.get('templates'))
+        instances = filter(self.find_name, all_vms.get('instances'))
         return {
             'templates': list(templates),
             'instances': list(instances)
@@ -81,24 +86,20 @@ class VMQuery:
         if not self.pool:
             return self.all_vms
 
-        vms = self.client.get_pool_members(poolid=self.pool)
-        templates = filter(self.is_template, vms)
-        instances = filter(self.is_instance, vms)
-        return {
-            'templates': list(templates),
-            'instances': list(instances)
-        }
+        inventory = self.inventory
+        return inventory.split(inventory.by_pool(self.pool))
 
-    def serialize(self, vm: dict, template=False):
+    def serialize(self, vm: dict, template=False, config: dict = None):
+        """
+        Parameter config is a prefetched VM config, skips the config round trip when provided.
+        Configs hold the pending values: cloudinit ipconfig changes are pending until the next VM start.
+        """
         vmid, node, pool = self.reverse_vm(vm=vm)
-        vm_config = self.client.get_vm_config(node=node, vmid=vmid)
+        vm_config = config if config else self.client.get_vm_config(node=node, vmid=vmid, current=False)
         if not vm_config:
             return None
 
-        ip_address, netmask, gateway = self.client.get_ip_config_from_vm_cloudinit(
-            node=node,
-            vmid=int(vmid)
-        )
+        ip_address, netmask, gateway = self.client.parse_ip_config(vm_config)
         bootdisk = vm_config.get('bootdisk')
         storage_type = self.get_storage_type_from_volume(vm_config, driver=bootdisk)
 
@@ -137,11 +138,8 @@ class VMQuery:
         return instance_clone
 
     def update_instance_template(self, instance: InstanceClone):
-        if not self.node:
-            filter_templates_per_node = lambda tmpl: tmpl.get('node') == instance.vm_attributes.node
-            templates = list(filter(filter_templates_per_node, self.all_vms.get('templates')))
-        else:
-            templates = self.all_vms.get('templates')
+        filter_templates_per_node = lambda tmpl: tmpl.get('node') == instance.vm_attributes.node
+        templates = list(filter(filter_templates_per_node, self.inventory.templates))
 
         for template in templates:
             node, pool, vmid = self.reverse_vm(template)
@@ -166,7 +164,10 @@ class VMQuery:
 
     def execute(self, template=False):
         if self.vmid:
-            instance = self.serialize(vm=self.get_vm(template=template), template=template)
+            vm = self.get_vm(template=template)
+            if not vm:
+                return None
+            instance = self.serialize(vm=vm, template=template)
             if not template:
                 self.update_instance_template(instance=instance)
             return instance
@@ -179,3 +180,120 @@ class VMQuery:
             vms = self.filter_vms_by_pool()
             return self.process_to_instances(vms=vms, template=template)
 
+
+
+DEFAULT_QUERY_WORKERS = 8
+
+
+class ClusterQuery:
+    """
+    Bulk resolver for all desired instances of a cluster (templates, masters, worker groups).
+    Existence and vmid come from the shared inventory snapshot, VM configs are fetched concurrently,
+    once per VM, and each matched template is serialized only once.
+    """
+    def __init__(self, client: VMAPIClient, max_workers=DEFAULT_QUERY_WORKERS):
+        self.client = client
+        self.max_workers = max_workers
+        self.serializer = VMQuery(client=client)
+        self.configs = {}
+        self.templates = {}
+
+    def find_template(self, template: CloudinitTemplate):
+        vm = self.client.get_vm_inventory().get(template.vmid)
+        if not vm or not VMInventory.is_template(vm) or vm.get('node') != template.vm_attributes.node:
+            return None
+        return vm
+
+    def find_instance(self, instance: InstanceClone):
+        for vm in self.client.get_vm_inventory().by_name(instance.vm_attributes.name):
+            if not VMInventory.is_template(vm) and vm.get('node') == instance.vm_attributes.node:
+                return vm
+        return None
+
+    def _fetch_config(self, vm):
+        return int(vm.get('vmid')), self.client.get_vm_config(node=vm.get('node'), vmid=vm.get('vmid'), current=False)
+
+    def fetch_configs(self, vms):
+        pending = {int(vm.get('vmid')): vm for vm in vms if int(vm.get('vmid')) not in self.configs}
+        if not pending:
+            return self.configs
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as pool:
+            for vmid, config in pool.map(self._fetch_config, pending.values()):
+                self.configs[vmid] = config
+        return self.configs
+
+    def serialize_template(self, vm):
+        vmid = int(vm.get('vmid'))
+        if vmid not in self.templates:
+            self.templates[vmid] = self.serializer.serialize(vm=vm, template=True, config=self.configs.get(vmid))
+        return self.templates[vmid]
+
+    def match_templates(self, instance_vm):
+        config = self.configs.get(int(instance_vm.get('vmid'))) or {}
+        description = config.get('description') or ''
+        return [
+            template
+            for template in self.client.get_vm_inventory().templates
+            if template.get('node') == instance_vm.get('node') and (
+                template.get('name') in description or str(template.get('vmid')) in description
+            )
+        ]
+
+    def seed_instance(self, instance: InstanceClone, known: dict):
+        """
+        The desired instance itself, with the vmid and ip of a known VM (e.g. journaled clone), if that VM still exists.
+        Skips the config fetch and serialization of the VM.
+        """
+        entry = known.get(instance.vm_attributes.name)
+        vm = self.client.get_vm_inventory().get(entry.vmid) if entry and entry.vmid else None
+        if not vm or VMInventory.is_template(vm) or vm.get('name') != instance.vm_attributes.name:
+            return None
+        instance.vmid = int(entry.vmid)
+        instance.allowed_ip = entry.ip or instance.allowed_ip
+        return instance
+
+    def resolve(self, templates: list, instances: list, known: dict = None):
+        """
+        Returns a dict mapping id() of each desired object to its serialized existing VM, or None.
+        known: {instance name: entry with vmid and ip}, instances resolved without a Proxmox config query.
+        """
+        seeded = {id(instance): self.seed_instance(instance, known) for instance in instances} if known else {}
+        seeded = {key: instance for key, instance in seeded.items() if instance}
+        found_templates = {id(template): self.find_template(template) for template in templates}
+        found_instances = {id(instance): self.find_instance(instance) for instance in instances if id(instance) not in seeded}
+        found = [vm for vm in list(found_templates.values()) + list(found_instances.values()) if vm]
+        self.fetch_configs(found)
+
+        instance_templates = {key: self.match_templates(vm) for key, vm in found_instances.items() if vm}
+        self.fetch_configs([vm for matched in instance_templates.values() for vm in matched])
+
+        resolved = {}
+        for key, vm in found_templates.items():
+            resolved[key] = self.serialize_template(vm) if vm else None
+        for key, vm in found_instances.items():
+            if not vm:
+                resolved[key] = None
+                continue
+            instance = self.serializer.serialize(vm=vm, config=self.configs.get(int(vm.get('vmid'))))
+            for template_vm in instance_templates.get(key, []):
+                cloudinit_template = self.serialize_template(template_vm)
+                if not cloudinit_template:
+                    continue
+                instance.template = cloudinit_template
+                instance.username = cloudinit_template.username
+                instance.vm_attributes.os_type = cloudinit_template.vm_attributes.os_type
+            resolved[key] = instance
+        resolved.update(seeded)
+        return resolved
+
+    def execute(self, *cluster_serializers, known: dict = None):
+        """
+        Resolve every serializer in one pass and apply the results on each of them.
+        """
+        desired = [instance for serializer in cluster_serializers for instance in serializer.instances]
+        resolved = self.resolve(
+            templates=[instance for instance in desired if isinstance(instance, CloudinitTemplate)],
+            instances=[instance for instance in desired if not isinstance(instance, CloudinitTemplate)],
+            known=known
+        )
+        return [serializer.apply_query(resolved) for serializer in cluster_serializers]
@@ -0,0 +1,171 @@
+"""
+Guest readiness probes, used instead of fixed waits after a VM starts.
+
+A VM is ready when:
+- SSH port accepts TCP connections.
+- cloud-init reports done (cloud-init status --wait).
+The qemu-guest-agent ping is probed first, as an early boot signal. The agent is optional:
+a cloud image without qemu-guest-agent installed only logs a warning.
+"""
+import time
+import socket
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import crayons
+
+from konverge.pve import VMAPIClient
+from konverge.utils import FabricWrapper
+
+
+READINESS_WORKERS = 8
+PROBE_INTERVAL_INITIAL = 1
+PROBE_INTERVAL_MAX = 5
+
+
+class ReadinessDeadlines(NamedTuple):
+    agent: int = 60
+    ssh: int = 300
+    cloudinit: int = 600
+
+
+class ReadinessResult(NamedTuple):
+    name: str
+    ready: bool
+    agent: bool = False
+    ssh: bool = False
+    cloudinit: bool = False
+    duration: float = 0.0
+
+
+def poll_until(probe: callable, deadline, initial_interval=PROBE_INTERVAL_INITIAL, max_interval=PROBE_INTERVAL_MAX):
+    """
+    Call probe until it returns True or deadline (seconds) expires. Interval backs off up to max_interval.
+    """
+    expires = time.monotonic() + deadline
+    interval = initial_interval
+    while True:
+        if probe():
+            return True
+        remaining = expires - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
+def tcp_probe(host, port=22, timeout=3):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def wait_for_cloudinit(host, timeout=ReadinessDeadlines().cloudinit):
+    """
+    Block on the guest until cloud-init finishes. Exit code 2 (recoverable errors) counts as done.
+    """
+    try:
+        result = FabricWrapper(host=host).execute('cloud-init status --wait', warn=True, hide=True, timeout=timeout)
+    except Exception as cloudinit_error:
+        logging.warning(crayons.yellow(f'cloud-init status failed on {host}: {cloudinit_error}'))
+        return False
+    if not result:
+        return False
+    if result.return_code == 2:
+        logging.warning(crayons.yellow(f'cloud-init finished with recoverable errors on {host}'))
+    return result.return_code in (0, 2)
+
+
+class VMReadiness:
+    def __init__(
+            self,
+            name,
+            node,
+            vmid,
+            ip,
+            client: VMAPIClient,
+            ssh_host=None,
+            port=22,
+            cloudinit=True,
+            deadlines: ReadinessDeadlines = ReadinessDeadlines()
+    ):
+        """
+        ip: Address for the TCP probe. ssh_host: ~/.ssh/config entry used for the cloud-init check, defaults to name.
+        """
+        self.name = name
+        self.node = node
+        self.vmid = vmid
+        self.ip = ip
+        self.client = client
+        self.ssh_host = ssh_host if ssh_host else name
+        self.port = port
+        self.cloudinit = cloudinit
+        self.deadlines = deadlines
+
+    @classmethod
+    def from_instance(cls, instance, cloudinit=True, deadlines: ReadinessDeadlines = ReadinessDeadlines()):
+        """
+        Existing instances, not created in this run, have no allowed_ip: read it from the cloudinit config.
+        """
+        ip = instance.allowed_ip
+        if not ip:
+            ip, _, _ = instance.client.get_ip_config_from_vm_cloudinit(
+                node=instance.vm_attributes.node,
+                vmid=instance.vmid
+            )
+        return cls(
+            name=instance.vm_attributes.name,
+            node=instance.vm_attributes.node,
+            vmid=instance.vmid,
+            ip=ip,
+            client=instance.client,
+            cloudinit=cloudinit,
+            deadlines=deadlines
+        )
+
+    def wait(self):
+        start = time.monotonic()
+        probed = {'agent': False}
+
+        def booted():
+            probed['agent'] = probed['agent'] or self.client.agent_ping(node=self.node, vmid=self.vmid)
+            return probed['agent'] or (self.ip and tcp_probe(self.ip, port=self.port))
+
+        # Early boot signal: stops at the first agent ping or open SSH port, whichever comes first.
+        if not poll_until(booted, deadline=self.deadlines.agent):
+            logging.warning(crayons.yellow(f'No qemu-guest-agent response from {self.name} within {self.deadlines.agent} seconds'))
+        agent = probed['agent']
+
+        ssh = poll_until(lambda: tcp_probe(self.ip, port=self.port), deadline=self.deadlines.ssh) if self.ip else False
+        if not ssh:
+            logging.error(crayons.red(f'{self.name} ({self.ip}) port {self.port} not reachable within {self.deadlines.ssh} seconds'))
+            return ReadinessResult(name=self.name, ready=False, agent=agent, duration=time.monotonic() - start)
+
+        cloudinit = wait_for_cloudinit(self.ssh_host, timeout=self.deadlines.cloudinit) if self.cloudinit else True
+        duration = time.monotonic() - start
+        if cloudinit:
+            print(crayons.green(f'VM {self.name} {self.vmid} ready in {duration:.1f} seconds'))
+        else:
+            logging.error(crayons.red(f'cloud-init did not complete on {self.name} within {self.deadlines.cloudinit} seconds'))
+        return ReadinessResult(
+            name=self.name,
+            ready=cloudinit,
+            agent=agent,
+            ssh=ssh,
+            cloudinit=cloudinit,
+            duration=duration
+        )
+
+
+def wait_until_ready(probes: list, max_workers=READINESS_WORKERS):
+    """
+    Probe VMs concurrently. Returns {name: ReadinessResult}.
+    """
+    if not probes:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(probes))) as pool:
+        results = list(pool.map(lambda probe: probe.wait(), probes))
+    return {result.name: result for result in results}
@@ -0,0 +1,251 @@
+"""
+Dependency graph of tasks, executed concurrently as soon as their requirements complete.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import NamedTuple, Any
+
+import crayons
+
+from konverge.journal import RunJournal
+
+
+GRAPH_WORKERS = 16
+
+
+class Task:
+    def __init__(
+            self,
+            name,
+            function: callable,
+            requires: tuple = (),
+            groups: tuple = (),
+            journaled=False,
+            restore: callable = None
+    ):
+        """
+        groups: Concurrency groups the task belongs to, limited by GraphExecutor group_limits.
+        journaled: Record the task in the run journal, and skip it on rerun once done.
+        restore: Called with the recorded result, when a journaled task is skipped.
+        """
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
+        self.groups = tuple(sorted(groups))
+        self.journaled = journaled
+        self.restore = restore
+
+    def __repr__(self):
+        return f'Task({self.name})'
+
+
+class TaskRecord(NamedTuple):
+    name: str
+    ok: bool
+    result: Any = None
+    error: Any = None
+    started: float = 0.0
+    finished: float = 0.0
+    skipped: bool = False
+
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+
+class TaskGraph:
+    def __init__(self):
+        self.tasks = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def add(
+            self,
+            name,
+            function: callable,
+            requires: tuple = (),
+            groups: tuple = (),
+            journaled=False,
+            restore: callable = None
+    ):
+        if name in self.tasks:
+            raise ValueError(f'Duplicate task: {name}')
+        self.tasks[name] = Task(name, function, requires=requires, groups=groups, journaled=journaled, restore=restore)
+        return self.tasks[name]
+
+    def dependents(self):
+        dependents = {name: [] for name in self.tasks}
+        for task in self.tasks.values():
+            for requirement in task.requires:
+                dependents[requirement].append(task.name)
+        return dependents
+
+    def topological_order(self):
+        """
+        Kahn's algorithm. Raises ValueError on missing requirements or cycles.
+        """
+        for task in self.tasks.values():
+            missing = [requirement for requirement in task.requires if requirement not in self.tasks]
+            if missing:
+                raise ValueError(f'Task {task.name} requires unknown tasks: {", ".join(missing)}')
+        dependents = self.dependents()
+        remaining = {name: len(task.requires) for name, task in self.tasks.items()}
+        ready = [name for name, count in remaining.items() if count == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for dependent in dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+        if len(order) != len(self.tasks):
+            cyclic = sorted(name for name, count in remaining.items() if count > 0)
+            raise ValueError(f'Task graph has a cycle through: {", ".join(cyclic)}')
+        return order
+
+    def describe(self):
+        for name in self.topological_order():
+            requires = self.tasks[name].requires
+            print(crayons.white(f'{name}') + (crayons.cyan(f' <- {", ".join(requires)}') if requires else ''))
+
+
+class GraphExecutor:
+    def __init__(self, graph: TaskGraph, max_workers=GRAPH_WORKERS, group_limits: dict = None, journal: RunJournal = None):
+        self.graph = graph
+        self.journal = journal
+        self.max_workers = max_workers
+        self.semaphores = {
+            group: threading.BoundedSemaphore(max(1, limit))
+            for group, limit in (group_limits or {}).items()
+        }
+        self.records = {}
+
+    def _run(self, task: Task):
+        journal = self.journal if task.journaled else None
+        if journal and journal.done(task.name):
+            result = journal.get(task.name).data
+            task.restore(result) if task.restore else None
+            print(crayons.white(f'Task {task.name} done in a previous run. Skip.'))
+            now = time.monotonic()
+            return TaskRecord(name=task.name, ok=True, result=result, started=now, finished=now)
+
+        semaphores = [self.semaphores[group] for group in task.groups if group in self.semaphores]
+        for semaphore in semaphores:
+            semaphore.acquire()
+        started = time.monotonic()
+        try:
+            journal.begin(task.name) if journal else None
+            result = task.function()
+            journal.complete(task.name, data=result) if journal else None
+            return TaskRecord(name=task.name, ok=True, result=result, started=started, finished=time.monotonic())
+        except Exception as task_error:
+            logging.error(crayons.red(f'Task {task.name} failed: {task_error}'))
+            journal.fail(task.name, error=str(task_error)) if journal else None
+            return TaskRecord(name=task.name, ok=False, error=task_error, started=started, finished=time.monotonic())
+        finally:
+            for semaphore in reversed(semaphores):
+                semaphore.release()
+
+    def _skip(self, name, failed, dependents: dict):
+        """
+        Mark name and everything downstream of it as skipped.
+        """
+        pending = [name]
+        now = time.monotonic()
+        while pending:
+            current = pending.pop()
+            if current in self.records:
+                continue
+            self.records[current] = TaskRecord(
+                name=current,
+                ok=False,
+                error=f'Requirement {failed} failed',
+                started=now,
+                finished=now,
+                skipped=True
+            )
+            logging.warning(crayons.yellow(f'Skip task {current}: requirement {failed} failed'))
+            pending.extend(dependents[current])
+
+    def run(self):
+        """
+        Returns {name: TaskRecord}. Failed tasks skip their dependents, independent branches keep running.
+        """
+        self.graph.topological_order()
+        dependents = self.graph.dependents()
+        remaining = {name: set(task.requires) for name, task in self.graph.tasks.items()}
+        self.records = {}
+        self.start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+
+            def submit_ready():
+                for name in list(remaining.keys()):
+                    if not remaining[name] and name not in self.records:
+                        del remaining[name]
+                        print(crayons.blue(f'Start task: {name}'))
+                        running[pool.submit(self._run, self.graph.tasks[name])] = name
+
+            submit_ready()
+            while running:
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    record = future.result()
+                    self.records[name] = record
+                    if record.ok:
+                        print(crayons.green(f'Task {name} completed in {record.duration:.1f} seconds'))
+                        for dependent in dependents[name]:
+                            if dependent in remaining:
+                                remaining[dependent].discard(name)
+                    else:
+                        for dependent in dependents[name]:
+                            self._skip(dependent, name, dependents)
+                            remaining.pop(dependent, None)
+                for name in [name for name in remaining if name in self.records]:
+                    del remaining[name]
+                submit_ready()
+        self.finish = time.monotonic()
+        return self.records
+
+    def critical_path(self):
+        """
+        Chain of executed tasks that determined the total run time:
+        from the last finished task, follow the requirement that finished last.
+        """
+        executed = {name: record for name, record in self.records.items() if not record.skipped}
+        if not executed:
+            return []
+        current = max(executed.values(), key=lambda record: record.finished).name
+        path = [current]
+        while True:
+            requirements = [
+                executed[requirement] for requirement in self.graph.tasks[current].requires if requirement in executed
+            ]
+            if not requirements:
+                break
+            current = max(requirements, key=lambda record: record.finished).name
+            path.append(current)
+        return list(reversed(path))
+
+    def report(self):
+        failed = [record for record in self.records.values() if not record.ok and not record.skipped]
+        skipped = [record for record in self.records.values() if record.skipped]
+        print()
+        print(crayons.cyan(f'Task graph: {len(self.records)} tasks in {self.finish - self.start:.1f} seconds'))
+        print(crayons.cyan('Critical path:'))
+        for name in self.critical_path():
+            print(crayons.white(f'  {name}: {self.records[name].duration:.1f}s'))
+        for record in failed:
+            print(crayons.red(f'Failed: {record.name}: {record.error}'))
+        for record in skipped:
+            print(crayons.yellow(f'Skipped: {record.name}: {record.error}'))
+        return not failed and not skipped
@@ -154,7 +154,9 @@ KUBE_CLUSTER_SCHEMA = {
                     },
                     'required': ['size']
                 },
-                'scsi': {'type': 'boolean'}
+                'scsi': {'type': 'boolean'},
+                'golden': {'type': 'boolean'},
+                'prepull_images': {'type': 'boolean'}
             },
             'required': ['pve_storage', 'node']
         },
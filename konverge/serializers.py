@@ -7,7 +7,7 @@ from konverge import settings
 from konverge.cloudinit import CloudinitTemplate
 from konverge.instance import InstanceClone
 from konverge.kube import ControlPlaneDefinitions, KubeExecutor
-from konverge.queries import VMQuery
+from konverge.queries import ClusterQuery
 from konverge.utils import HelmVersion, KubeStorage, infer_full_versions_from_major, Storage, VMAttributes
 
 
@@ -169,6 +169,7 @@ class ClusterInstanceSerializer:
 
         self.instances = []
         self.state = {node: [] for node in self.nodes}
+        self.queried = False
 
     @property
     def hotplug_valid(self):
@@ -238,25 +239,34 @@ class ClusterInstanceSerializer:
                 }
             )
 
-    def query(self):
+    @property
+    def any_exists(self):
+        for node in self.nodes:
+            if any(item['exists'] for item in self.state[node]):
+                return True
+        return False
+
+    def query(self, refresh=False):
+        """
+        Results of a bulk ClusterQuery are reused, unless refresh is requested.
+        """
         if not self.instances:
             return False
-        for instance in self.instances:
+        if self.queried and not refresh:
+            return self.any_exists
+        ClusterQuery(client=settings.vm_client).execute(self)
+        return self.any_exists
+
+    def apply_query(self, resolved: dict):
+        for instance in list(self.instances):
             instance: InstanceClone
-            query = VMQuery(
-                client=settings.vm_client,
-                name=instance.vm_attributes.name,
-                pool=instance.vm_attributes.pool,
-                node=instance.vm_attributes.node
-            )
-            answer = query.execute()
-            answermsg = f'VMID: {answer[0].vmid}, Name: {answer[0].vm_attributes.name}' if answer else 'Not Found'
+            created_instance = resolved.get(id(instance))
+            answermsg = f'VMID: {created_instance.vmid}, Name: {created_instance.vm_attributes.name}' if created_instance else 'Not Found'
             print(
                 crayons.white(
                     f'Query instance {instance.vm_attributes.name}: {answermsg}'
                 )
             )
-            created_instance = answer[0] if answer else answer
             if created_instance:
                 vms_state = self.state[instance.vm_attributes.node]
                 match = lambda vm: vm.get('name') and vm.get('name') == created_instance.vm_attributes.name
@@ -269,23 +279,24 @@ class ClusterInstanceSerializer:
                         'vmid': created_instance.vmid,
                         'exists': True
                     }
-
-        for node in self.nodes:
-            if any(item['exists'] for item in self.state[node]):
-                return True
-        return False
+        self.queried = True
+        return self.any_exists
 
 
 class ClusterTemplateSerializer(ClusterInstanceSerializer):
     def __init__(
         self,
         config: dict,
-        cluster_attributes: ClusterAttributes
+        cluster_attributes: ClusterAttributes,
+        networking: str = None
     ):
         super().__init__(
             config=config,
             cluster_attributes=cluster_attributes
         )
+        self.golden = bool(self.config.get('golden', False))
+        self.prepull_images = bool(self.config.get('prepull_images', False))
+        self.networking = networking
         self.state = {
             node: {
                 'name': f'{node}-{self.name}' if self.name else None,
@@ -295,6 +306,31 @@ class ClusterTemplateSerializer(ClusterInstanceSerializer):
             for node in self.nodes
         }
 
+    @property
+    def golden_node(self):
+        """
+        Node that builds the golden template, replicated to all other nodes. None unless golden mode is enabled.
+        """
+        return self.nodes[0] if self.golden else None
+
+    def prepull_manifests(self):
+        """
+        Manifests whose images are pre-pulled into templates: the CNI, and the dashboard if enabled.
+        None if pre-pull is disabled.
+        """
+        if not self.prepull_images:
+            return None
+        version = (self.cluster_attributes.version or '').split('-')[0]
+        manifests = []
+        cni = settings.CNI_IMAGE_MANIFESTS.get(self.networking)
+        if cni:
+            manifests.append(cni.format(version=version))
+        elif self.networking:
+            logging.warning(crayons.yellow(f'No image manifest for CNI {self.networking}. Pre-pull control plane images only.'))
+        if self.cluster_attributes.dashboard:
+            manifests.append(settings.KUBE_DASHBOARD_URL)
+        return manifests
+
     def template_exists(self, node):
         if node in self.nodes:
             return self.state.get(node).get('exists')
@@ -347,24 +383,20 @@ class ClusterTemplateSerializer(ClusterInstanceSerializer):
             self.instances.append(template)
             self.state[node]['vmid'] = template.vmid
 
-    def query(self):
-        if not self.instances:
-            return False
-        for instance in self.instances:
+    @property
+    def any_exists(self):
+        return any([self.state[node]['exists'] for node in self.nodes])
+
+    def apply_query(self, resolved: dict):
+        for instance in list(self.instances):
             instance: CloudinitTemplate
-            query = VMQuery(
-                client=settings.vm_client,
-                name=instance.vm_attributes.name,
-                pool=instance.vm_attributes.pool,
-                node=instance.vm_attributes.node,
-                vmid=instance.vmid
-            )
-            created_instance = query.execute(template=isinstance(instance, CloudinitTemplate))
+            created_instance = resolved.get(id(instance))
             if created_instance:
                 self.instances[self.instances.index(instance)] = created_instance
                 self.state[instance.vm_attributes.node]['exists'] = True
                 self.state[instance.vm_attributes.node]['vmid'] = created_instance.vmid
-        return any([self.state[node]['exists'] for node in self.nodes])
+        self.queried = True
+        return self.any_exists
 
 
 class ClusterMasterSerializer(ClusterInstanceSerializer):
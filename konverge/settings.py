@@ -12,6 +12,8 @@ from requests.exceptions import SSLError
 from konverge.pve import ProxmoxAPIClient
 from konverge.pvecluster import ProxmoxClusterConfigFile, PVEClusterConfig
 from konverge.files import KubeClusterConfigFile
+from konverge.ipam import IPAllocationLedger, LEDGER_FILENAME
+from konverge.images import ImageCache, IMAGE_CACHE_DIRECTORY
 
 
 BASE_PATH = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -25,11 +27,22 @@ CNI = {
     'weave-default': "\"https://cloud.weave.works/k8s/net?k8s-version=$(kubectl version | base64 | tr -d '\n')\""
 }
 
+# Manifests the CNI images are read from, when pre-pulled into templates. Weave takes the version, as no cluster exists yet.
+CNI_IMAGE_MANIFESTS = {
+    'flannel': CNI['flannel'],
+    'calico': CNI['calico'],
+    'weave': 'https://cloud.weave.works/k8s/net?k8s-version={version}&env.NO_MASQ_LOCAL=1',
+    'weave-default': 'https://cloud.weave.works/k8s/net?k8s-version={version}'
+}
+
 KUBE_DASHBOARD_URL = 'https://raw.githubusercontent.com/kubernetes/dashboard/v2.0.0-beta4/aio/deploy/recommended.yaml'
 
 VMID_PLACEHOLDER = 9999
 allocated_vmids = set()
 
+ip_ledger = IPAllocationLedger(filename=os.path.join(WORKDIR, LEDGER_FILENAME))
+image_cache = ImageCache(directory=os.path.join(WORKDIR, IMAGE_CACHE_DIRECTORY))
+
 def cluster_config_factory(filename=None, config_type='pve'):
     cluster_type = {
         'pve': ProxmoxClusterConfigFile,
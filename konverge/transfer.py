@@ -0,0 +1,134 @@
+"""
+Bulk file transfer over the pooled SSH connections, instead of an scp process (and SSH handshake) per file.
+
+Files are sent in one SFTP session, or as a single tar archive for sudo hosts, as SFTP runs without sudo.
+Files whose remote sha256 already matches are skipped. Small remote files are read into memory.
+"""
+import io
+import os
+import uuid
+import shlex
+import hashlib
+import logging
+import tarfile
+
+import crayons
+
+from konverge.utils import FabricWrapper
+
+
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+REMOTE_READ_LIMIT = 1024 * 1024
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as local_file:
+        for chunk in iter(lambda: local_file.read(TRANSFER_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remote_checksums(wrapper: FabricWrapper, paths: list):
+    """
+    sha256 of the remote paths in one command: {path: digest}. Missing files are left out.
+    """
+    if not paths:
+        return {}
+    quoted = ' '.join(shlex.quote(path) for path in paths)
+    checked = wrapper.execute(f'sha256sum {quoted} 2>/dev/null', hide=True, warn=True)
+    if not checked:
+        return {}
+    checksums = {}
+    for line in checked.stdout.splitlines():
+        digest, _, path = line.strip().partition(' ')
+        if digest and path:
+            checksums[path.strip().lstrip('*')] = digest
+    return checksums
+
+
+def _put_sftp(wrapper: FabricWrapper, files: dict):
+    """
+    All files in one SFTP session. Each file is written to a partial file, then renamed in place.
+    """
+    directories = sorted({os.path.dirname(remote) for remote in files.values() if os.path.dirname(remote)})
+    if directories:
+        wrapper.execute(f'mkdir -p {" ".join(shlex.quote(directory) for directory in directories)}', hide=True)
+    with wrapper.session() as connection:
+        sftp = connection.sftp()
+        for local, remote in files.items():
+            part = f'{remote}.part'
+            sftp.put(local, part)
+            sftp.chmod(part, os.stat(local).st_mode & 0o7777)
+            sftp.posix_rename(part, remote)
+
+
+def _put_tar(wrapper: FabricWrapper, files: dict):
+    """
+    All files in one tar archive, uploaded to the login directory and extracted with sudo at /.
+    """
+    relative = [remote for remote in files.values() if not os.path.isabs(remote)]
+    if relative:
+        raise ValueError(f'Remote paths of sudo transfers must be absolute: {", ".join(relative)}')
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for local, remote in files.items():
+            archive.add(local, arcname=remote.lstrip('/'))
+    buffer.seek(0)
+    archive_name = f'.konverge-transfer-{uuid.uuid4().hex[:8]}.tar.gz'
+    wrapper.put(buffer, remote=archive_name)
+    extracted = wrapper.execute(
+        f'tar -xzf {archive_name} --no-same-owner -C / ; status=$? ; rm -f {archive_name} ; exit $status',
+        hide=True,
+        warn=True
+    )
+    if not extracted or not extracted.ok:
+        raise RuntimeError(f'Cannot extract {", ".join(files.values())} on {wrapper.host}')
+
+
+def put_files(wrapper: FabricWrapper, files: dict):
+    """
+    files: {local path: remote path}. Remote paths are relative to the login directory, or absolute.
+    Returns {remote path: 'present' | 'pushed'}. Raises on transfer errors.
+    """
+    digests = {remote: _sha256(local) for local, remote in files.items()}
+    existing = remote_checksums(wrapper, list(files.values()))
+    pending = {local: remote for local, remote in files.items() if existing.get(remote) != digests[remote]}
+    if pending:
+        if wrapper.sudo:
+            _put_tar(wrapper, pending)
+        else:
+            _put_sftp(wrapper, pending)
+    return {remote: 'pushed' if remote in pending.values() else 'present' for remote in files.values()}
+
+
+def send_files(wrapper: FabricWrapper, files: dict):
+    """
+    put_files, with errors logged. Returns True if all files are on the host.
+    """
+    try:
+        results = put_files(wrapper, files)
+    except (OSError, ValueError, RuntimeError) as transfer_error:
+        logging.error(crayons.red(f'Failed to send files to {wrapper.host}: {transfer_error}'))
+        return False
+    for remote, result in sorted(results.items()):
+        print(crayons.white(f'{remote} {result} on {wrapper.host}'))
+    return True
+
+
+def read_remote(wrapper: FabricWrapper, path, limit=REMOTE_READ_LIMIT):
+    """
+    Content of a small remote file, read into memory: over SFTP, or with sudo cat for root-only files
+    such as /etc/kubernetes/admin.conf. Returns None if the file cannot be read.
+    """
+    try:
+        if wrapper.sudo:
+            read = wrapper.execute(f'head -c {limit} {shlex.quote(path)}', hide=True, warn=True)
+            if not read or not read.ok:
+                raise OSError(read.stderr.strip() if read else 'no connection')
+            return read.stdout
+        with wrapper.session() as connection, connection.sftp().open(path, mode='r') as remote_file:
+            return remote_file.read(limit).decode()
+    except (OSError, UnicodeDecodeError) as read_error:
+        logging.error(crayons.red(f'Cannot read {path} on {wrapper.host}: {read_error}'))
+        return None
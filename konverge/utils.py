@@ -1,10 +1,15 @@
+import atexit
 import logging
 import os
 import math
 import time
+import fcntl
+import threading
+from contextlib import contextmanager
 from enum import Enum
 from functools import singledispatch
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, NamedTuple, Any
 
 import crayons
 from fabric2 import Connection, Config
@@ -328,6 +333,130 @@ class VMAttributes:
         return key_content
 
 
+SSH_POOL_MAX_IDLE = 300
+
+
+class PooledConnection:
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        self.stale = False
+
+
+class SSHConnectionPool:
+    """
+    Process-wide SSH connections, keyed by host, user, port and credentials.
+    Sudo and non-sudo wrappers of the same host share one transport: each command opens a channel on it.
+    Connections idle for longer than max_idle are closed on the next acquire, unless a lease is still running on them.
+    """
+    def __init__(self, max_idle=SSH_POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.opened = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(host, user=None, port=22, connect_kwargs: dict = None):
+        return host, user, port, tuple(sorted((connect_kwargs or {}).items()))
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if now - entry.last_used > self.max_idle and not entry.in_use and not entry.lock.locked():
+                entry.connection.close()
+                del self._entries[key]
+                self.evicted += 1
+
+    def _checkout(self, key, factory: callable):
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.get(key)
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = PooledConnection(factory())
+                self._entries[key] = entry
+            entry.in_use += 1
+        try:
+            with entry.lock:
+                if not entry.connection.is_connected:
+                    entry.connection.open()
+                    with self._lock:
+                        self.opened += 1
+                entry.last_used = time.monotonic()
+        except Exception:
+            self._release(entry)
+            raise
+        return entry
+
+    def _release(self, entry: PooledConnection):
+        with self._lock:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            close = entry.stale and not entry.in_use
+        if close:
+            entry.connection.close()
+
+    def acquire(self, key, factory: callable):
+        """
+        Returns the open Connection for key, created by factory() on first use.
+        Opening is serialized per connection, so concurrent callers never race on the handshake.
+        The connection is not leased: use lease() for operations that must not be evicted while they run.
+        """
+        entry = self._checkout(key, factory)
+        self._release(entry)
+        return entry.connection
+
+    @contextmanager
+    def lease(self, key, factory: callable):
+        """
+        The open Connection for key, held in use until the block exits: it is never evicted while a command runs on it.
+        """
+        entry = self._checkout(key, factory)
+        try:
+            yield entry.connection
+        finally:
+            self._release(entry)
+
+    def discard(self, key):
+        """
+        Drop the connection for key. A connection still in use is marked stale and closed on its last release.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry.in_use:
+                entry.stale = True
+                return
+        if entry:
+            entry.connection.close()
+
+    def close_all(self):
+        with self._lock:
+            entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            entry.connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'opened': self.opened,
+                'evicted': self.evicted
+            }
+
+
+ssh_pool = SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
+
+
 class FabricWrapper:
     def __init__(
             self,
@@ -337,52 +466,143 @@ class FabricWrapper:
             key_filename=None,
             key_passphrase=None,
             port=22,
-            sudo=False
+            sudo=False,
+            pool: SSHConnectionPool = None
     ):
         self.sudo = sudo
+        self.host = host
+        self.pool = pool if pool else ssh_pool
+        self.connect_kwargs = None
         if not user and not password and not key_filename:
             # Get details from ~/.ssh/config
-            self.connection = Connection(host)
+            self.connection_kwargs = {'host': host}
         elif key_filename and not password:
-            self.connection = Connection(
-                host=host,
-                user=user,
-                port=port,
-                connect_kwargs={
-                    'key_filename': key_filename,
-                    'passphrase': key_passphrase
-                }
-            )
+            self.connect_kwargs = {
+                'key_filename': key_filename,
+                'passphrase': key_passphrase
+            }
         elif not key_filename and password:
-            self.connection = Connection(
-                host=host,
-                user=user,
-                port=port,
-                connect_kwargs={
-                    'password': password
-                }
-            )
+            self.connect_kwargs = {
+                'password': password
+            }
         elif key_filename and password:
-            self.connection = Connection(
-                host=host,
-                user=user,
-                port=port,
-                connect_kwargs={
-                    'key_filename': key_filename,
-                    'passphrase': key_passphrase if key_passphrase else password
-                }
-            )
+            self.connect_kwargs = {
+                'key_filename': key_filename,
+                'passphrase': key_passphrase if key_passphrase else password
+            }
         else:
             logging.error(
                 crayons.red(f'You need to provide either a private key_filename or password to connect to {host} with user: {user}')
             )
-            self.connection = None
+            self.connection_kwargs = None
+        if self.connect_kwargs:
+            self.connection_kwargs = {
+                'host': host,
+                'user': user,
+                'port': port,
+                'connect_kwargs': self.connect_kwargs
+            }
+        self.key = SSHConnectionPool.key(host, user=user, port=port, connect_kwargs=self.connect_kwargs)
+
+    def _connection(self):
+        return Connection(**self.connection_kwargs)
 
-    def execute(self, command, **kwargs):
-        if not self.connection:
-            logging.error(crayons.red('No connection object instantiated.'))
+    @property
+    def connection(self):
+        """
+        Shared pooled connection, opened on first use. None if no credentials were provided.
+        """
+        if not self.connection_kwargs:
             return None
-        return self.connection.sudo(command, **kwargs) if self.sudo else self.connection.run(command, **kwargs)
+        return self.pool.acquire(self.key, self._connection)
+
+    def reset(self):
+        """
+        Drop the pooled connection, e.g. after a failed command on a rebooting host.
+        """
+        self.pool.discard(self.key)
+
+    @contextmanager
+    def session(self):
+        """
+        Pooled connection, leased for the duration of the block. Yields None if no credentials were provided.
+        """
+        if not self.connection_kwargs:
+            yield None
+            return
+        with self.pool.lease(self.key, self._connection) as connection:
+            yield connection
+
+    def execute(self, command, **kwargs):
+        with self.session() as connection:
+            if not connection:
+                logging.error(crayons.red('No connection object instantiated.'))
+                return None
+            return connection.sudo(command, **kwargs) if self.sudo else connection.run(command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        with self.session() as connection:
+            return connection.put(local, remote=remote, **kwargs)
+
+    def get(self, remote, local=None, **kwargs):
+        with self.session() as connection:
+            return connection.get(remote, local=local, **kwargs)
+
+
+GROUP_WORKERS = 8
+
+
+class HostResult(NamedTuple):
+    host: str
+    ok: bool
+    result: Any = None
+    error: Any = None
+    duration: float = 0.0
+
+
+class FabricWrapperGroup:
+    """
+    Fan-out over many hosts, with a bounded number of concurrent hosts. Similar to fabric ThreadingGroup,
+    but on pooled FabricWrapper connections. Results are keyed by host name, exceptions are captured per host.
+    """
+    def __init__(self, wrappers: dict, max_workers=GROUP_WORKERS):
+        """
+        wrappers: {name: FabricWrapper}
+        """
+        self.wrappers = wrappers
+        self.max_workers = max_workers
+
+    def _call(self, name, function: callable):
+        start = time.monotonic()
+        try:
+            result = function(name, self.wrappers[name])
+            ok = bool(getattr(result, 'ok', result))
+            return HostResult(host=name, ok=ok, result=result, duration=time.monotonic() - start)
+        except Exception as host_error:
+            return HostResult(host=name, ok=False, error=host_error, duration=time.monotonic() - start)
+
+    def map(self, function: callable, max_workers=None):
+        """
+        Run function(name, wrapper) on all hosts concurrently. Returns {name: HostResult}.
+        """
+        if not self.wrappers:
+            return {}
+        workers = min(max_workers or self.max_workers, len(self.wrappers))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {name: pool.submit(self._call, name, function) for name in self.wrappers}
+            return {name: future.result() for name, future in futures.items()}
+
+    def run(self, command, timeout=None, max_workers=None, **kwargs):
+        """
+        Run command on all hosts. timeout: Per-host command timeout in seconds.
+        """
+        if timeout:
+            kwargs['timeout'] = timeout
+        return self.map(lambda name, wrapper: wrapper.execute(command, **kwargs), max_workers=max_workers)
+
+    @staticmethod
+    def failed(results: dict):
+        return [name for name, result in results.items() if not result.ok]
 
 
 def get_id_prefix(id_prefix=1, proxmox_node_scale=3, node=None):
@@ -397,9 +617,26 @@ def get_id_prefix(id_prefix=1, proxmox_node_scale=3, node=None):
     return id_prefix
 
 
+_ssh_config_lock = threading.Lock()
+
+
+@contextmanager
+def ssh_config_lock(config_file):
+    """
+    Exclusive access to ~/.ssh/config, across provisioning threads and konverge processes.
+    """
+    with _ssh_config_lock:
+        with open(f'{config_file}.lock', mode='w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 def add_ssh_config_entry(host, user, identity, ip):
     """
-    Add host configuration locally on ~/.ssh/config
+    Add host configuration locally on ~/.ssh/config, as one append: concurrent entries never interleave.
     """
     local = LOCAL
     home = get_local_user()
@@ -407,20 +644,38 @@ def add_ssh_config_entry(host, user, identity, ip):
     if not os.path.exists(config_file):
         logging.warning(crayons.yellow(f'Did not find config file: {config_file}. Creating now.'))
         local.run(f'mkdir -p ~/.ssh')
+    entry = '\n'.join(
+        (
+            '',
+            f'Host {host}',
+            f'Hostname {ip}',
+            f'User {user}',
+            'Port 22',
+            f'IdentityFile {identity}',
+            'StrictHostKeyChecking no',
+            ''
+        )
+    )
     try:
-        local.run(f'echo "" >> {config_file}')
-        local.run(f'echo "Host {host}" >> {config_file}')
-        local.run(f'echo "Hostname {ip}" >> {config_file}')
-        local.run(f'echo "User {user}" >> {config_file}')
-        local.run(f'echo "Port 22" >> {config_file}')
-        local.run(f'echo "IdentityFile {identity}" >> {config_file}')
-        local.run(f'echo "StrictHostKeyChecking no" >> {config_file}')
+        with ssh_config_lock(config_file):
+            with open(config_file, mode='a') as ssh_config:
+                ssh_config.write(entry)
         print(crayons.green(f'Host: {host} added to ~/.ssh/config'))
     except Exception as generic:
         logging.error(crayons.red(f'Error during adding host to config: {generic}'))
 
 
 def remove_ssh_config_entry(host, ip, user='ubuntu'):
+    home = get_local_user()
+    config_file = f'/home/{home}/.ssh/config'
+    if not os.path.exists(config_file):
+        logging.error(crayons.red(f'Did not find config file: {config_file}. Exit.'))
+        return
+    with ssh_config_lock(config_file):
+        _remove_ssh_config_entry(host, ip, user=user)
+
+
+def _remove_ssh_config_entry(host, ip, user='ubuntu'):
     local = LOCAL
     home = get_local_user()
     config_file = f'/home/{home}/.ssh/config'
@@ -491,6 +746,18 @@ def sleep_intervals(wait_period=120, sleep_interval=5):
         time.sleep(sleep_interval)
 
 
+@contextmanager
+def timed(label):
+    """
+    Print elapsed wall-clock time of the enclosed block.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        print(crayons.white(f'{label}: ') + crayons.yellow(f'{time.monotonic() - start:.2f}') + crayons.white(' seconds.'))
+
+
 def human_readable_disk_size(size):
    if size == 0:
        return '0B'